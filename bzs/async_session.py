@@ -1,68 +1,121 @@
 
+import concurrent.futures
 import threading
-import queue
+import time
+import tornado.concurrent
 
-from . import utils
+from . import const
 
-class AsyncSessionType:
-    def __init__(self):
-        self.session_idx = dict()
-        self.running_sessions = 0
-        self.max_sessions = 1
-        self.pend_session_queue = queue.Queue()
-        self.lock = threading.Lock()
+class AsyncPoolType:
+    """ A pool of worker threads running blocking jobs off the I/O loop. Jobs
+    are handed back as futures, and the pool keeps track of how many jobs are
+    waiting and how long they had waited before being run. """
+
+    def __init__(self, name, max_workers):
+        self.name        = name
+        self.max_workers = max_workers
+        self.executor    = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.lock        = threading.Lock()
+        self.submitted   = 0
+        self.started     = 0
+        self.completed   = 0
+        self.failed      = 0
+        self.wait_total  = 0.0
+        self.wait_max    = 0.0
+        self.run_total   = 0.0
         return
-    def __session_thread(self, session_id, func, args, kwargs):
-        ret_res = func(*args, **kwargs)
-        self.session_idx[session_id] = (True, ret_res)
-        self.running_sessions -= 1
-        # Creating new session in case some are pending
+
+    def __run_job(self, submit_time, func, args, kwargs):
+        start_time = time.time()
+        wait_time = start_time - submit_time
         self.lock.acquire()
-        if not self.pend_session_queue.empty():
-            self.__spawn_session(self.pend_session_queue.get())
+        self.started += 1
+        self.wait_total += wait_time
+        self.wait_max = max(self.wait_max, wait_time)
         self.lock.release()
+        failed = False
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.lock.acquire()
+            self.completed += 1
+            self.failed += 1 if failed else 0
+            self.run_total += time.time() - start_time
+            self.lock.release()
         return
-    def __spawn_session(self, tup):
-        self.running_sessions += 1
-        threading.Thread(target=self.__session_thread, args=tup).start()
-        return
-    def create_session(self, func, *args, **kwargs):
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedule 'func' on this pool and returns a concurrent future. Safe
+        to call from any thread. """
         self.lock.acquire()
-        session_id = utils.get_new_uuid(None, self.session_idx)
-        self.session_idx[session_id] = (False, None)
-        if self.running_sessions < self.max_sessions:
-            self.__spawn_session((session_id, func, args, kwargs))
-        else:
-            self.pend_session_queue.put((session_id, func, args, kwargs))
+        self.submitted += 1
         self.lock.release()
-        return session_id
-    def query_state(self, session_id):
-        if session_id not in self.session_idx:
-            raise KeyError('Session ID does not exist')
+        return self.executor.submit(self.__run_job, time.time(), func, args, kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """ Schedule 'func' on this pool and returns a Tornado future, which
+        could be yielded in coroutines. Must be called on the I/O loop. """
+        t_future = tornado.concurrent.Future()
+        tornado.concurrent.chain_future(self.submit(func, *args, **kwargs), t_future)
+        return t_future
+
+    def metrics(self):
+        """ Returns the current statistics of this pool. """
         self.lock.acquire()
-        ret_val = self.session_idx[session_id][0]
+        ret_val = {
+            'workers': self.max_workers,
+            'queue-depth': self.submitted - self.started,
+            'running': self.started - self.completed,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait-time-avg': self.wait_total / self.started if self.started else 0.0,
+            'wait-time-max': self.wait_max,
+            'run-time-avg': self.run_total / self.completed if self.completed else 0.0,
+        }
         self.lock.release()
         return ret_val
-    def query_result(self, session_id):
-        if not self.query_state(session_id):
-            raise KeyError('Session not yet completed')
-        self.lock.acquire()
-        ret_val = self.session_idx[session_id][1]
-        del self.session_idx[session_id]
-        self.lock.release()
+    pass
+
+class AsyncSessionType:
+    def __init__(self):
+        self.io_pool = AsyncPoolType('io', const.get_const('async-io-threads'))
+        # CPU-bound jobs use a separate pool only if configured to.
+        if const.get_const('async-cpu-threads') > 0:
+            self.cpu_pool = AsyncPoolType('cpu', const.get_const('async-cpu-threads'))
+        else:
+            self.cpu_pool = self.io_pool
+        return
+
+    def metrics(self):
+        ret_val = dict()
+        for pool in {self.io_pool, self.cpu_pool}:
+            ret_val[pool.name] = pool.metrics()
         return ret_val
     pass
 
 AsyncSession = AsyncSessionType()
 
-def create_session(function, *args, **kwargs):
-    """ Creates a multithreaded session and returns the session ID. """
-    return AsyncSession.create_session(function, *args, **kwargs)
+def run(function, *args, **kwargs):
+    """ Runs a blocking function in the I/O pool, returns a Tornado future. """
+    return AsyncSession.io_pool.run(function, *args, **kwargs)
+
+def run_cpu(function, *args, **kwargs):
+    """ Runs a CPU-bound function in the CPU pool, returns a Tornado future. """
+    return AsyncSession.cpu_pool.run(function, *args, **kwargs)
+
+def submit(function, *args, **kwargs):
+    """ Runs a blocking function in the I/O pool, returns a concurrent future.
+    For use outside of the I/O loop. """
+    return AsyncSession.io_pool.submit(function, *args, **kwargs)
 
-def completed(session_id):
-    """ Queries asynchronously the state of the session, returns boolean. """
-    return AsyncSession.query_state(session_id)
+def submit_cpu(function, *args, **kwargs):
+    """ Runs a CPU-bound function in the CPU pool, returns a concurrent future.
+    For use outside of the I/O loop. """
+    return AsyncSession.cpu_pool.submit(function, *args, **kwargs)
 
-def get_result(session_id):
-    """ Queries asynchronously the result of the session. """
-    return AsyncSession.query_result(session_id)
+def get_metrics():
+    """ Queue depth and wait times of each pool. """
+    return AsyncSession.metrics()
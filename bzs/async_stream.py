@@ -0,0 +1,163 @@
+
+import collections
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+
+from . import async_session
+
+read_ahead_depth = 4 # Blocks read ahead of the client at most
+read_block_min = 64 * 1024
+read_block_max = 1024 * 1024
+
+class ReadAheadStream:
+    """ Reads ranges of a file stream on the I/O pool ahead of the client, so
+    that reading from the database and sending to the socket overlap. Blocks
+    are read one at a time, as streams could not be read concurrently, and
+    the next is started as soon as the last is done, until 'depth' blocks
+    wait to be sent, which bounds the memory held for slow clients.
+
+    Blocks start at 'read_block_min' bytes. They grow whenever the client
+    has to wait for a block, so that fast clients need fewer reads, and
+    shrink whenever all blocks wait for a slow client. The stream is closed
+    as soon as the last block is read, even though the client may still be
+    receiving the content.
+
+    Blocks are memoryviews of buffers owned by the reader, which the stream
+    reads into. A block given back by release() once sent has its buffer
+    read into again, so no more than 'depth' + 1 buffers are allocated for
+    the whole download, however long it is.
+
+    All methods must be called on the I/O loop. """
+
+    def __init__(self, stream, ranges, close_stream=None, depth=read_ahead_depth):
+        self.stream       = stream
+        self.close_stream = close_stream or stream # Closed after reading
+        self.ranges       = collections.deque(ranges) # (first, last) left to read
+        self.offset       = None # Position of the next block in the current range
+        self.depth        = depth
+        self.block_size   = read_block_min
+        self.ready        = collections.deque() # Blocks read, not yet taken
+        self.buffers      = list() # Released buffers, to be read into again
+        self.reading      = None # Future of the block being read
+        self.waiter       = None # Future the client waits on for a block
+        self.error        = None
+        self.closed       = False # No longer read by the client
+        self.done         = False # Stream closed, all blocks read
+        self.io_loop      = tornado.ioloop.IOLoop.current()
+        self.__schedule()
+        return
+
+    def __read_block(self, offset, size, buffer):
+        """ Runs on the I/O pool. """
+        self.stream.seek(offset, 0)
+        length = self.stream.readinto(memoryview(buffer)[:size])
+        return memoryview(buffer)[:length]
+
+    def __get_buffer(self, size):
+        """ A released buffer of at least 'size' bytes, or a new one. Smaller
+        ones are dropped, as blocks only grow while the client keeps up. """
+        while self.buffers:
+            buffer = self.buffers.pop()
+            if len(buffer) >= size:
+                return buffer
+        return bytearray(size)
+
+    def __schedule(self):
+        """ Start reading the next block, if there is room for it. """
+        if self.reading or self.closed or self.error or len(self.ready) >= self.depth:
+            return
+        if not self.ranges:
+            self.__close_stream()
+            return
+        first, last = self.ranges[0]
+        if self.offset is None:
+            self.offset = first
+        size = min(self.block_size, last - self.offset + 1)
+        buffer = self.__get_buffer(size)
+        self.reading = async_session.run(self.__read_block, self.offset, size, buffer)
+        self.io_loop.add_future(self.reading, self.__on_read)
+        return
+
+    def __on_read(self, future):
+        self.reading = None
+        if self.closed:
+            return
+        try:
+            block = future.result()
+        except Exception as err:
+            self.error = err
+            block = b''
+        if not self.error:
+            self.offset += len(block)
+            if not block or self.offset > self.ranges[0][1]:
+                # Range done, or content is shorter than recorded
+                self.ranges.popleft()
+                self.offset = None
+            if block:
+                self.ready.append(block)
+            else:
+                self.release(block)
+            # All blocks waiting for the client
+            if len(self.ready) >= self.depth:
+                self.block_size = max(read_block_min, self.block_size // 2)
+        self.__wake()
+        self.__schedule()
+        return
+
+    def __wake(self):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.waiter = None
+        return
+
+    def __close_stream(self):
+        if self.done:
+            return
+        self.done = True
+        if not self.reading:
+            async_session.submit(self.close_stream.close)
+        else:
+            # Closed once the block being read is done
+            self.io_loop.add_future(self.reading, lambda future: async_session.submit(self.close_stream.close))
+        return
+
+    @tornado.gen.coroutine
+    def read(self):
+        """ Returns the next block of the ranges, in order, or b'' once all of
+        them were read. Blocks should be given back by release() once sent. """
+        while not self.ready:
+            if self.error:
+                raise self.error
+            if self.closed or (not self.ranges and not self.reading):
+                return b''
+            # The client waits for the storage
+            self.block_size = min(read_block_max, self.block_size * 2)
+            self.waiter = tornado.concurrent.Future()
+            yield self.waiter
+        block = self.ready.popleft()
+        self.__schedule()
+        return block
+
+    def release(self, block):
+        """ The client is done with 'block', its buffer may be read into
+        again. The block must no longer be used. """
+        if not isinstance(block, memoryview):
+            return
+        buffer = block.obj
+        block.release()
+        if not self.closed:
+            self.buffers.append(buffer)
+        return
+
+    def close(self):
+        """ Stop reading ahead and close the stream, if not yet closed. Must
+        be called once the client is done or gone. """
+        self.closed = True
+        self.ranges.clear()
+        self.ready.clear()
+        self.buffers.clear()
+        self.__close_stream()
+        self.__wake()
+        return
+    pass
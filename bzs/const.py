@@ -10,7 +10,11 @@ else:
     db_url = None
 
 universal_options_list = {
+    'async-cpu-threads': int(os.environ.get('BZS_ASYNC_CPU_THREADS', 0)), # 0 to share the I/O pool
+    'async-io-threads': int(os.environ.get('BZS_ASYNC_IO_THREADS', 8)),
     'author': '@ht35268',
+    'blob-link-lifetime': float(os.environ.get('BZS_BLOB_LINK_LIFETIME', 3600.0)), # Links stay valid for one to two lifetimes
+    'blob-link-secret': os.environ.get('BZS_BLOB_LINK_SECRET', ''), # Generated once and kept in the database if not given
     'copyright': 'Copyright 2016, @ht35268. All lefts reversed.',
     'db-name': db_url.path[1:] if db_url
         else 'db_bzshare',
@@ -22,14 +26,37 @@ universal_options_list = {
         else '127.0.0.1',
     'db-host-port': db_url.port if db_url
         else '8079',
+    'db-pool-check-interval': 60.0,
+    'db-pool-max-size': int(os.environ.get('BZS_DB_POOL_MAX_SIZE', 8)),
+    'db-pool-min-size': int(os.environ.get('BZS_DB_POOL_MIN_SIZE', 1)),
+    'db-pool-timeout': 30.0,
+    'db-raw-pool-max-size': int(os.environ.get('BZS_DB_RAW_POOL_MAX_SIZE', 32)), # Large objects being written
     'license': 'GNU GPL v3',
     'max-body-size': 256 * 1024 * 1024,
     'server-admin-password': os.environ.get('BZS_SERVER_ADMIN_PASSWORD', '12345678'),
     'server-name': 'Tornado/4.4',
     'server-port': int(os.environ.get('PORT',80)),
     'server-threads': 1,
+    'sqlfs-blob-path': os.environ.get('BZS_SQLFS_BLOB_PATH', './blobs/'),
+    'sqlfs-compression': os.environ.get('BZS_SQLFS_COMPRESSION', ''), # '' to disable, 'gzip', or 'xz' for rarely read shares
+    'sqlfs-gc-budget': int(os.environ.get('BZS_SQLFS_GC_BUDGET', 256 * 1024**2)), # Bytes moved or unlinked per run
+    'sqlfs-gc-interval': float(os.environ.get('BZS_SQLFS_GC_INTERVAL', 3600.0)), # 0 to disable
+    'sqlfs-hash-threads': int(os.environ.get('BZS_SQLFS_HASH_THREADS', 0)), # 0 for one per CPU, 1 to hash in the caller
+    'sqlfs-lazy-load': int(os.environ.get('BZS_SQLFS_LAZY_LOAD', 0)) != 0,
+    'sqlfs-permission-cache-size': int(os.environ.get('BZS_SQLFS_PERMISSION_CACHE_SIZE', 100000)), # 0 to disable
+    'sqlfs-resident-nodes': int(os.environ.get('BZS_SQLFS_RESIDENT_NODES', 1000000)),
+    'sqlfs-scrub-budget': int(os.environ.get('BZS_SQLFS_SCRUB_BUDGET', 1024**3)), # Bytes verified per run
+    'sqlfs-scrub-interval': float(os.environ.get('BZS_SQLFS_SCRUB_INTERVAL', 600.0)), # 0 to disable
+    'sqlfs-scrub-quarantine': int(os.environ.get('BZS_SQLFS_SCRUB_QUARANTINE', 0)) != 0,
+    'sqlfs-scrub-rate': int(os.environ.get('BZS_SQLFS_SCRUB_RATE', 8 * 1024**2)), # Bytes read per second, 0 for unlimited
+    'sqlfs-scrub-threads': int(os.environ.get('BZS_SQLFS_SCRUB_THREADS', 2)),
+    'sqlfs-snapshot-interval': float(os.environ.get('BZS_SQLFS_SNAPSHOT_INTERVAL', 600.0)),
+    'sqlfs-snapshot-path': os.environ.get('BZS_SQLFS_SNAPSHOT_PATH', ''), # Empty to disable snapshots
+    'sqlfs-storage-engine': os.environ.get('BZS_SQLFS_STORAGE_ENGINE', 'lobject'), # 'lobject', 'chunked' or 'blob'
     'time-format': '%a %d/%m/%Y, %H:%M:%S',
     'time-zone': 'Asia/Shanghai',
+    'upload-challenge-lifetime': float(os.environ.get('BZS_UPLOAD_CHALLENGE_LIFETIME', 300.0)),
+    'upload-challenge-size': int(os.environ.get('BZS_UPLOAD_CHALLENGE_SIZE', 64 * 1024)), # Bytes hashed to prove having content
     'users-invite-code': os.environ.get('BZS_USERS_INVITE_CODE', '571428'),
     'users-max-groups-allowed': 3,
     'version': 'r0.115'
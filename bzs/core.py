@@ -11,14 +11,17 @@ import tornado.ioloop
 import tornado.process
 import tornado.web
 
+from . import async_session
 from . import const
 from . import db
+from . import sqlfs
 from . import utils
 
 from . import module_error
 from . import module_files
 from . import module_home
 from . import module_index
+from . import module_metrics
 from . import module_preview
 from . import module_settings
 from . import module_static
@@ -39,7 +42,9 @@ def main():
             (r'^/files/?()$', module_files.FilesListHandler),
             (r'^/files/list/(.*)/?', module_files.FilesListHandler),
             (r'^/files/download/(.*)/(.*)/?$', module_files.FilesDownloadHandler),
+            (r'^/blob/([0-9a-f]{64})/(.*)$', module_files.BlobDownloadHandler),
             (r'^/files/upload/(.*)/(.*)/?$', module_files.FilesUploadHandler),
+            (r'^/files/upload_hash/(.*)/(.*)/?$', module_files.FilesUploadHashHandler),
             (r'^/files/operation/?', module_files.FilesOperationHandler),
             (r'^/preview/(.*?)/(.*)/?$', module_preview.PreviewHandler),
             (r'^/user/(.*)/?$', module_user.UserActivityHandler),
@@ -49,7 +54,8 @@ def main():
             (r'^/settings/usergroups/?$', module_settings.UsergroupHandler),
             (r'^/settings/usergroups_edit/(.*)/?$', module_settings.UsergroupEditHandler),
             (r'^/settings/dynamic-interface/?$', module_settings.DynamicInterfaceHandler),
-            (r'^/settings/dynamic-interface_edit/(.*)/?$', module_settings.DynamicInterfaceHandler)
+            (r'^/settings/dynamic-interface_edit/(.*)/?$', module_settings.DynamicInterfaceHandler),
+            (r'^/settings/metrics/?$', module_metrics.MetricsHandler)
             # (r'.*', module_error.ErrorHandler)
         ],
         xsrf_cookies=False, # True to prevent CSRF third party attacks
@@ -67,6 +73,21 @@ def main():
         max_body_size=const.get_const('max-body-size'),
         xheaders=True)
     web_server.add_sockets(web_sockets)
+    # Saving snapshots of SQLFS in the background
+    if const.get_const('sqlfs-snapshot-path') and const.get_const('sqlfs-snapshot-interval') > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: async_session.submit(sqlfs.save_snapshot),
+            const.get_const('sqlfs-snapshot-interval') * 1000).start()
+    # Collecting garbage of SQLFS storage in the background
+    if const.get_const('sqlfs-gc-interval') > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: async_session.submit(sqlfs.collect_garbage),
+            const.get_const('sqlfs-gc-interval') * 1000).start()
+    # Verifying content of SQLFS storage in the background
+    if const.get_const('sqlfs-scrub-interval') > 0:
+        tornado.ioloop.PeriodicCallback(
+            lambda: async_session.submit(sqlfs.scrub_storage),
+            const.get_const('sqlfs-scrub-interval') * 1000).start()
     # Boot I/O thread for asynchronous purposes
     tornado.ioloop.IOLoop.instance().start()
     return
@@ -1,13 +1,252 @@
 
 import io
+import os
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import threading
+import time
 
 from . import const
 from . import utils
 
 ################################################################################
 
+class ConnectionPool:
+    """ A bounded, thread-safe pool of PostgreSQL connections. At least
+    'min_size' connections are kept open, and no more than 'max_size' would
+    ever be opened at once. Borrowers wait at most 'timeout' seconds before
+    giving up, and connections idle for more than 'check_interval' seconds are
+    probed before being handed out again. Connections are opened and probed
+    without holding the pool lock, in a slot reserved for the borrower.
+
+    Connections are never shared with forked processes: a process other than
+    the one that created the pool starts over with no connections. """
+
+    def __init__(self, connect_params, min_size=1, max_size=8, timeout=30.0, check_interval=60.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise AttributeError('Invalid pool size boundaries')
+        self.connect_params = connect_params
+        self.min_size       = min_size
+        self.max_size       = max_size
+        self.timeout        = timeout
+        self.check_interval = check_interval
+        self.idle_conns     = list() # [(connection, time of return), ...]
+        self.used_conns     = set()
+        self.reserved       = 0 # Slots of connections being opened or probed
+        self.inherited      = list() # Connections of the parent process, never used nor closed
+        self.pid            = os.getpid()
+        self.cond           = threading.Condition(threading.Lock())
+        # Pre-open the minimum amount of connections
+        for i in range(0, self.min_size):
+            self.idle_conns.append((self.__connect(), time.time()))
+        return
+
+    def __connect(self):
+        return psycopg2.connect(**self.connect_params)
+
+    def __check_pid(self):
+        """ Forget connections opened before the process was forked, which
+        the parent still uses. They are kept referenced, since closing them
+        would end the sessions of the parent. Must hold the lock. """
+        if self.pid == os.getpid():
+            return
+        self.inherited.extend(conn for conn, idle_since in self.idle_conns)
+        self.inherited.extend(self.used_conns)
+        self.idle_conns = list()
+        self.used_conns = set()
+        self.reserved = 0
+        self.pid = os.getpid()
+        return
+
+    def __discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+    def __healthy(self, conn, idle_since):
+        """ Whether a connection that was idle since 'idle_since' is still
+        usable. Only connections idle for long are probed. """
+        if conn.closed:
+            return False
+        if time.time() - idle_since < self.check_interval:
+            return True
+        try:
+            with conn.cursor() as l_cur:
+                l_cur.execute('SELECT 1;')
+            conn.rollback()
+        except Exception:
+            return False
+        return True
+
+    def getconn(self, timeout=None):
+        """ Borrow a connection from the pool, waiting at most 'timeout'
+        seconds (or the pool default) if all connections are in use. """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout
+        conn, idle_since = None, None
+        self.cond.acquire()
+        try:
+            self.__check_pid()
+            while True:
+                # Reuse idle connections, most recently returned first
+                if self.idle_conns:
+                    conn, idle_since = self.idle_conns.pop()
+                    break
+                # Otherwise open a new one if boundaries allow
+                if len(self.used_conns) + self.reserved < self.max_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError('Timed out waiting for a database connection')
+                self.cond.wait(remaining)
+            self.reserved += 1
+        finally:
+            self.cond.release()
+        # Slow connects and probes of dead sockets stall this borrower only
+        try:
+            if conn is not None and not self.__healthy(conn, idle_since):
+                self.__discard(conn)
+                conn = None
+            if conn is None:
+                conn = self.__connect()
+        except Exception:
+            self.cond.acquire()
+            self.reserved -= 1
+            self.cond.notify()
+            self.cond.release()
+            raise
+        self.cond.acquire()
+        self.reserved -= 1
+        self.used_conns.add(conn)
+        self.cond.release()
+        return conn
+
+    def putconn(self, conn, close=False):
+        """ Return a borrowed connection to the pool. Connections left in an
+        unknown state or marked with 'close' are discarded. """
+        self.cond.acquire()
+        try:
+            self.__check_pid()
+            if conn not in self.used_conns:
+                return
+            self.used_conns.remove(conn)
+            if not close and not conn.closed:
+                try:
+                    # Whatever not committed by the borrower is dropped
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                except Exception:
+                    close = True
+            if close or conn.closed or len(self.idle_conns) >= self.max_size:
+                self.__discard(conn)
+            else:
+                self.idle_conns.append((conn, time.time()))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+        return
+
+    def closeall(self):
+        """ Close all idle connections, borrowed ones are closed upon return. """
+        self.cond.acquire()
+        self.__check_pid()
+        for conn, idle_since in self.idle_conns:
+            self.__discard(conn)
+        self.idle_conns = list()
+        self.cond.release()
+        return
+
+    def stats(self):
+        """ Returns the number of idle and borrowed connections. """
+        self.cond.acquire()
+        ret_val = dict(idle=len(self.idle_conns), used=len(self.used_conns),
+            min_size=self.min_size, max_size=self.max_size)
+        self.cond.release()
+        return ret_val
+    pass
+
+class DatabaseTransaction:
+    """ A unit of work on a single pooled connection. Statements which do not
+    fetch results are queued and sent in one batch, right before the next
+    statement that requires results or the final commit. Use it through
+    DatabaseType.transaction() only. """
+
+    def __init__(self, database):
+        self.db    = database
+        self.conn  = None
+        self.depth = 0
+        self.queue = list()
+        self.after = list() # Run once committed
+        self.undo  = list() # Run once rolled back, latest first
+        return
+
+    def __enter__(self):
+        l_tx = getattr(self.db.local, 'transaction', None)
+        if not l_tx:
+            l_tx = self
+            l_tx.conn = self.db.pool.getconn()
+            self.db.local.transaction = l_tx
+        l_tx.depth += 1
+        self.outer = l_tx
+        return l_tx
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        l_tx = self.outer
+        l_tx.depth -= 1
+        if l_tx.depth > 0:
+            return False
+        # Outermost context, committing or rolling back
+        self.db.local.transaction = None
+        after, l_tx.after = l_tx.after, list()
+        undo, l_tx.undo = l_tx.undo, list()
+        try:
+            if exc_type is None:
+                l_tx.flush()
+                l_tx.conn.commit()
+            else:
+                l_tx.queue = list()
+                l_tx.conn.rollback()
+        except Exception:
+            self.db.pool.putconn(l_tx.conn, close=True)
+            l_tx.conn = None
+            for func in reversed(undo):
+                func()
+            raise
+        self.db.pool.putconn(l_tx.conn)
+        l_tx.conn = None
+        for func in (after if exc_type is None else reversed(undo)):
+            func()
+        return False
+
+    def flush(self):
+        """ Send all queued statements in one round-trip. """
+        if not self.queue:
+            return
+        batch = b';\n'.join(self.queue) + b';'
+        self.queue = list()
+        with self.conn.cursor() as l_cur:
+            l_cur.execute(batch)
+        return
+
+    def execute(self, command, args=None, fetch_func='all'):
+        with self.conn.cursor() as l_cur:
+            if not fetch_func:
+                stmt = l_cur.mogrify(command, args).strip().rstrip(b';')
+                self.queue.append(stmt)
+                return None
+            self.flush()
+            try:
+                l_cur.execute(command, args)
+            except psycopg2.ProgrammingError as err:
+                print('Exception occured in PostgreSQL while executing the command:\n    %s: %s\n    %s\n' % (type(err), err, command))
+                raise err
+            final_arr = self.db.fetch(l_cur, fetch_func)
+        return final_arr
+    pass
+
 class DatabaseType:
     def __init__(self):
         self.connect_params = dict(
@@ -18,34 +257,117 @@ class DatabaseType:
             port=const.get_const('db-host-port')
         )
         psycopg2.extras.register_uuid()
+        self.local = threading.local()
+        self.pool = ConnectionPool(self.connect_params,
+            min_size=const.get_const('db-pool-min-size'),
+            max_size=const.get_const('db-pool-max-size'),
+            timeout=const.get_const('db-pool-timeout'),
+            check_interval=const.get_const('db-pool-check-interval'))
+        # Large objects are written on connections held for a whole upload,
+        # which must not starve statements of connections
+        self.raw_pool = ConnectionPool(self.connect_params,
+            min_size=0,
+            max_size=const.get_const('db-raw-pool-max-size'),
+            timeout=const.get_const('db-pool-timeout'),
+            check_interval=const.get_const('db-pool-check-interval'))
         self.init_db(False)
+        self.upgrade_db()
+        # Links signed before a restart, or by other processes, stay valid
+        if not const.get_const('blob-link-secret'):
+            const.universal_options_list['blob-link-secret'] = self.get_secret('blob_link_secret')
         return
 
     def execute(self, command, args=None, fetch_func='all'):
-        with psycopg2.connect(**self.connect_params) as l_db:
+        """ Execute 'command' and fetch 'one', 'all' or no (None) results. When
+        called inside a transaction(), statements that fetch nothing are queued
+        and sent along with the next fetching statement or the final commit.
+        Errors in statements are raised either way. """
+        l_tx = getattr(self.local, 'transaction', None)
+        if l_tx:
+            return l_tx.execute(command, args, fetch_func)
+        l_db = self.pool.getconn()
+        try:
             with l_db.cursor() as l_cur:
                 try:
                     l_cur.execute(command, args)
                 except psycopg2.ProgrammingError as err:
                     print('Exception occured in PostgreSQL while executing the command:\n    %s: %s\n    %s\n' % (type(err), err, command))
-                    # raise err
-                try:
-                    if fetch_func == 'one':
-                        final_arr = l_cur.fetchone()
-                    elif fetch_func == 'all':
-                        final_arr = l_cur.fetchall()
-                    else:
-                        final_arr = None
-                except Exception:
-                    final_arr = None
+                    raise err
+                final_arr = self.fetch(l_cur, fetch_func)
+            l_db.commit()
+        except Exception:
+            self.pool.putconn(l_db, close=True)
+            raise
+        self.pool.putconn(l_db)
         return final_arr
 
+    def fetch(self, l_cur, fetch_func='all'):
+        """ Fetch results from cursor according to 'fetch_func'. """
+        try:
+            if fetch_func == 'one':
+                final_arr = l_cur.fetchone()
+            elif fetch_func == 'all':
+                final_arr = l_cur.fetchall()
+            else:
+                final_arr = None
+        except Exception:
+            final_arr = None
+        return final_arr
+
+    def transaction(self):
+        """ Returns a context in which all statements executed by this thread
+        are sent in one transaction and committed once upon leaving. Contexts
+        may be nested, only the outermost one commits. Should any exception
+        be raised inside, the whole transaction is rolled back. """
+        return DatabaseTransaction(self)
+
+    def on_commit(self, func):
+        """ Call 'func' once the transaction of this thread is committed, or
+        right away if there is none. It would not be called on rollback. Used
+        for changes outside the database that must not happen unless the
+        database agrees, such as removing files. """
+        l_tx = getattr(self.local, 'transaction', None)
+        if not l_tx:
+            func()
+            return
+        l_tx.after.append(func)
+        return
+
+    def on_rollback(self, func):
+        """ Call 'func' if the transaction of this thread is rolled back, and
+        never if there is none. Used to forget changes made in memory to
+        follow the database, such as newly created rows. Functions are called
+        in the reverse order they were given, so that each of them sees memory
+        as it was when given. """
+        l_tx = getattr(self.local, 'transaction', None)
+        if l_tx:
+            l_tx.undo.append(func)
+        return
+
     def execute_raw(self):
-        return psycopg2.connect(**self.connect_params)
+        """ Borrow a connection for manual operations such as large objects,
+        from a pool of its own, apart from the one serving statements. Must
+        be given back through release_raw(). """
+        return self.raw_pool.getconn()
+
+    def release_raw(self, conn, close=False):
+        """ Give back a connection borrowed through execute_raw(). """
+        self.raw_pool.putconn(conn, close=close)
+        return
+
+    def get_secret(self, index):
+        """ Random secret kept in 'core' under 'index', generated on first use,
+        so that it is the same across restarts and processes. """
+        self.execute("INSERT INTO core (index, data) SELECT %s, %s WHERE NOT EXISTS (SELECT index FROM core WHERE index = %s);",
+            (index, os.urandom(32).hex().encode('utf-8'), index), fetch_func=None)
+        # Should several processes generate one at once, all take the same
+        res = self.execute("SELECT data FROM core WHERE index = %s ORDER BY data LIMIT 1;", (index,), fetch_func='one')
+        return bytes(res[0]).decode('utf-8')
 
     def init_db(self, force=True):
         # If database already initialized, and not forced to init, then ignore
-        if not force and self.execute("SELECT data FROM core WHERE index = %s;", ('db_initialized',)):
+        if not force and self.execute("SELECT to_regclass('core');")[0][0] and \
+                self.execute("SELECT data FROM core WHERE index = %s;", ('db_initialized',)):
             return True
         print('Initializing PostgreSQL database.')
         # Purge database of obsolete tables
@@ -56,10 +378,21 @@ class DatabaseType:
             'forums',
             'file_storage',
             'file_storage_sparse',
-            'file_system'
+            'file_storage_chunk',
+            'file_storage_manifest',
+            'file_storage_pack',
+            'file_storage_quarantine',
+            'file_system',
+            'file_system_legacy',
+            'file_system_node'
         ]
         for nam in all_databases:
             self.execute("DROP TABLE IF EXISTS %s;" % (nam,))
+        # Generation of the tree starts over at random, so that snapshots of
+        # the purged tree would not match the new one
+        self.execute("DROP SEQUENCE IF EXISTS sqlfs_generation;", fetch_func=None)
+        self.execute("CREATE SEQUENCE sqlfs_generation;", fetch_func=None)
+        self.execute("SELECT setval('sqlfs_generation', (random() * 1e15)::BIGINT + 1);", fetch_func=None)
         # Creating new tables in order to function
         # TIMESTAMPs has lower precision than DOUBLE, so we are using DOUBLE PRECISION instead.
         self.execute("""
@@ -101,15 +434,6 @@ class DatabaseType:
                 sub_content BYTEA[],
                 unused      BIGINT[]
             );
-            CREATE TABLE file_system(
-                uuid        UUID,
-                file_name   TEXT,
-                owner       TEXT,
-                permissions TEXT[][],
-                upload_time DOUBLE PRECISION,
-                sub_folders UUID[],
-                sub_files   TEXT[][]
-            );
         """)
         # Marking this database as initialized
         self.execute("INSERT INTO core (index, data) VALUES ('db_initialized', %s)",
@@ -118,6 +442,84 @@ class DatabaseType:
         self.execute("INSERT INTO core (index, data) VALUES ('db_home_info', %s)",
             (b'\x80\x03X\x00\x00\x00\x00q\x00.',))
         return True
+
+    def upgrade_db(self):
+        """ Create tables and indexes introduced after the database had been
+        initialized. Every statement here must be safe to run repeatedly. """
+        for command in [
+            # One row per filesystem node, superseding 'file_system' which
+            # held every child of a directory in arrays of the directory row.
+            # Data in the old table is migrated by the filesystem upon loading.
+            """CREATE TABLE IF NOT EXISTS file_system_node (
+                uuid        UUID PRIMARY KEY,
+                parent_uuid UUID,
+                file_name   TEXT,
+                is_dir      BOOLEAN,
+                owner       TEXT,
+                permissions TEXT[][],
+                upload_time DOUBLE PRECISION,
+                f_uuid      UUID
+            );""",
+            "CREATE UNIQUE INDEX IF NOT EXISTS file_system_node_name_idx ON file_system_node (parent_uuid, file_name);",
+            "CREATE INDEX IF NOT EXISTS file_system_node_f_uuid_idx ON file_system_node (f_uuid);",
+            # Indexes for lookups that were sequential scans
+            "CREATE INDEX IF NOT EXISTS core_index_idx ON core (index);",
+            "CREATE INDEX IF NOT EXISTS users_handle_idx ON users (handle);",
+            "CREATE INDEX IF NOT EXISTS usergroups_handle_idx ON usergroups (handle);",
+            "CREATE INDEX IF NOT EXISTS file_storage_uuid_idx ON file_storage (uuid);",
+            "CREATE INDEX IF NOT EXISTS file_storage_hash_idx ON file_storage (hash);",
+            "CREATE INDEX IF NOT EXISTS file_storage_sparse_uuid_idx ON file_storage_sparse (uuid);",
+            # Content-defined chunks, and files stored as manifests of chunks.
+            # Large files with no engine are stored in large objects.
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS engine TEXT;",
+            """CREATE TABLE IF NOT EXISTS file_storage_chunk (
+                hash        TEXT PRIMARY KEY,
+                size        BIGINT,
+                count       BIGINT,
+                content     BYTEA
+            );""",
+            """CREATE TABLE IF NOT EXISTS file_storage_manifest (
+                uuid        UUID PRIMARY KEY,
+                chunk_hash  TEXT[],
+                chunk_size  BIGINT[]
+            );""",
+            # Append-only pack segments of small files, each a large object.
+            # Packed files refer to their segment with 'content', and 'used'
+            # counts the bytes of the segment still referred to.
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS pack_offset BIGINT;",
+            """CREATE TABLE IF NOT EXISTS file_storage_pack (
+                oid         OID PRIMARY KEY,
+                size        BIGINT,
+                used        BIGINT
+            );""",
+            # Compressed files, with the compressed size of each block of the
+            # original content, and the size of the content as stored.
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS codec TEXT;",
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS codec_blocks BIGINT[];",
+            "ALTER TABLE file_storage ADD COLUMN IF NOT EXISTS stored_size BIGINT;",
+            # Files of which the content no longer matches the hash, found by
+            # the integrity scrubber. New uploads are not deduplicated against.
+            """CREATE TABLE IF NOT EXISTS file_storage_quarantine (
+                uuid        UUID PRIMARY KEY,
+                hash        TEXT,
+                reason      TEXT,
+                time        DOUBLE PRECISION
+            );""",
+            # Increased upon every change to the filesystem tree, so snapshots of
+            # the tree could tell whether they are up to date. A sequence, so
+            # that writers do not wait on each other to increase it. Carried
+            # over from the row of 'core' it used to be kept in, or starts
+            # randomly so that a re-initialized database would not match old
+            # snapshots.
+            "CREATE SEQUENCE IF NOT EXISTS sqlfs_generation;",
+            """SELECT setval('sqlfs_generation', COALESCE(
+                    (SELECT convert_from(data, 'UTF8')::BIGINT FROM core WHERE index = 'sqlfs_generation'),
+                    (random() * 1e15)::BIGINT + 1))
+                WHERE NOT (SELECT is_called FROM sqlfs_generation);""",
+            "DELETE FROM core WHERE index = 'sqlfs_generation';",
+        ]:
+            self.execute(command, fetch_func=None)
+        return True
     pass
 
 Database = DatabaseType()
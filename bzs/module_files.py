@@ -6,8 +6,10 @@ import re
 import time
 import tornado
 import urllib
+import uuid
 
 from . import async_session
+from . import async_stream
 from . import const
 from . import sqlfs
 from . import users
@@ -51,18 +53,14 @@ class FilesListHandler(tornado.web.RequestHandler):
                 disabled=(i == len(files_hierarchy) - 1)))
             continue
 
-        sessid = async_session.create_session(sqlfs.list_directory, target_path, user=working_user)
-        while not async_session.completed(sessid):
-            time.sleep(0.001)
-        ls_dir = async_session.get_result(sessid)
+        ls_dir = yield async_session.run(sqlfs.list_directory, target_path, user=working_user)
+        # Getting current directory permissions
+        cwd_writable = yield async_session.run(sqlfs.writable, target_path, working_user)
 
         # Another concurrency blob...
         future = tornado.concurrent.Future()
 
         def get_final_html_async(target_path, file_temp, files_hierarchy, files_hierarchy_cwd, files_hierarchy_list, ls_dir):
-            # Getting current directory permissions
-            cwd_writable = sqlfs.writable(target_path, working_user)
-
             files_attrib_list = list()
             for f_handle in ls_dir:
                 try:
@@ -89,7 +87,7 @@ class FilesListHandler(tornado.web.RequestHandler):
                     if attrib['mime-type'] == 'directory/folder':
                         attrib['target-link'] = '/files/list/%s' % utils.encode_str_to_hexed_b64(actual_path + '/')
                     else:
-                        attrib['target-link'] = '/files/download/%s/%s' % (utils.encode_str_to_hexed_b64(actual_path), attrib['file-name-url'])
+                        attrib['target-link'] = utils.get_blob_link(f_handle['file-hash'], file_name)
                     attrib['preview-link'] = '/preview/view/%s' % utils.encode_str_to_hexed_b64(actual_path)
                     # Encoding UUID
                     attrib['uuid'] = utils.encode_str_to_hexed_b64(actual_path)
@@ -146,58 +144,141 @@ class FilesDownloadHandler(tornado.web.RequestHandler):
         if not file_path:
             raise tornado.web.HTTPError(404)
 
-        # Asynchronous web request...
-        file_block_size = 64 * 1024 # 64 KiB / Chunk
-        file_block = bytes()
-        file_data = None
+        file_stream, file_stat = yield async_session.run(sqlfs.get_content_stat, file_path, user=working_user)
 
-        future = tornado.concurrent.Future()
-        def inquire_data_async(working_user):
-            file_stream = sqlfs.get_content(file_path, user=working_user)
-            future.set_result(file_stream)
-        tornado.ioloop.IOLoop.instance().add_callback(
-            inquire_data_async, working_user)
-        file_stream = yield future
-
-        # Detecting sent receival of ranges
-        try:
-            recv_range_str = re.sub('bytes=', '', self.request.headers['Range'])
-            recv_range_tuple = recv_range_str.split('-')
-            recv_range = int(recv_range_tuple[0])
-        except:
-            recv_range = 0
+        # Links carrying the hash of the content never change (see utils.get_download_link)
+        file_version = self.get_argument('v', '')
+        if file_stat and len(file_version) >= 16 and file_stat['file-hash'].startswith(file_version):
+            file_cache = utils.http_immutable
+        else:
+            file_cache = 'max-age=0'
+        yield self.send_content(file_stream, file_stat, file_cache)
+        return
 
-        if recv_range <= 0:
+    @tornado.gen.coroutine
+    def send_content(self, file_stream, file_stat, file_cache):
+        """Send content of 'file_stream', of which attributes are 'file_stat',
+        or None if unknown, honouring ranges and conditional requests, and
+        closes the stream."""
+        file_etag = '"%s"' % file_stat['file-hash'] if file_stat else None
+        file_mtime = int(file_stat['upload-time']) if file_stat and file_stat['upload-time'] else None
+
+        # Content is identified by its hash, so a cached copy of the same hash is valid
+        if file_stat and utils.http_not_modified(self.request.headers, [file_etag, '"%s-gzip"' % file_stat['file-hash']], file_mtime):
+            self.set_status(304, "Not Modified")
+            self.add_header('Cache-Control', file_cache)
+            self.add_header('ETag', file_etag)
+            if file_mtime:
+                self.add_header('Last-Modified', utils.format_http_date(file_mtime))
+            self.add_header('Vary', 'Accept-Encoding')
+            self.finish()
+            yield async_session.run(file_stream.close)
+            return
+
+        # Ranges are ignored unless the client has the same content (If-Range)
+        file_ranges = utils.parse_http_range(self.request.headers.get('Range', None), file_stream.length)
+        if file_ranges is not None and 'If-Range' in self.request.headers:
+            if_range = self.request.headers['If-Range'].strip()
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                # Weak entity tags never match
+                if if_range != file_etag:
+                    file_ranges = None
+            elif utils.parse_http_date(if_range) != file_mtime:
+                file_ranges = None
+        if file_ranges == []:
+            self.set_status(416, "Range Not Satisfiable")
+            self.add_header('Content-Range', 'bytes */%d' % file_stream.length)
+            self.finish()
+            yield async_session.run(file_stream.close)
+            return
+
+        # Content stored compressed with gzip is sent as it is, if accepted
+        accept_encoding = list(enc.split(';')[0].strip() for enc in self.request.headers.get('Accept-Encoding', '').split(',')
+            if not re.search(r'q=0(\.0*)?\s*$', enc))
+        file_output = file_stream
+        if file_ranges is None and 'gzip' in accept_encoding:
+            file_output = file_stream.get_encoded('gzip') or file_stream
+
+        if file_ranges is None:
             self.set_status(200, "OK")
             self.set_header('Connection', 'close')
+            file_ranges = [(0, file_output.length - 1)] if file_output.length > 0 else list()
         else:
             self.set_status(206, "Partial Content")
             self.set_header('Connection', 'keep-alive')
+        file_parts = [b''] * len(file_ranges) # Headers of each part
+        file_tail = b''
         self.add_header('Accept-Ranges', 'bytes')
-        self.add_header('Cache-Control', 'max-age=0')
-        self.set_header('Content-Type', 'application/x-download')
-        self.add_header('Content-Length', file_stream.length - recv_range)
-        self.add_header('Content-Range', 'bytes %d-%d/%d' % (recv_range, file_stream.length - 1, file_stream.length))
-
-        file_stream.seek(recv_range, 0)
-        while file_stream.tell() < file_stream.length:
-            # Entry to the concurrency worker
-            future = tornado.concurrent.Future()
-            # Concurrent worker
-            def retrieve_data_async():
-                block = file_stream.read(file_block_size)
-                future.set_result(block)
-            # Injection and pending
-            tornado.ioloop.IOLoop.instance().add_callback(retrieve_data_async)
-            # Reset or read
-            file_block = yield future
-            self.write(file_block)
-            self.flush()
-        self.finish()
+        self.add_header('Cache-Control', file_cache)
+        self.add_header('Vary', 'Accept-Encoding')
+        if file_stat:
+            self.add_header('ETag', file_etag if file_output is file_stream else '"%s-gzip"' % file_stat['file-hash'])
+        if file_mtime:
+            self.add_header('Last-Modified', utils.format_http_date(file_mtime))
+        if file_output is not file_stream:
+            self.set_header('Content-Encoding', 'gzip')
+        if self.get_status() == 206 and len(file_ranges) > 1:
+            # Each range is sent as a part of a multipart response
+            file_boundary = uuid.uuid4().hex
+            self.set_header('Content-Type', 'multipart/byteranges; boundary=%s' % file_boundary)
+            file_parts = list(('\r\n--%s\r\nContent-Type: application/x-download\r\nContent-Range: bytes %d-%d/%d\r\n\r\n'
+                % (file_boundary, first, last, file_stream.length)).encode('utf-8') for first, last in file_ranges)
+            file_tail = ('\r\n--%s--\r\n' % file_boundary).encode('utf-8')
+        else:
+            self.set_header('Content-Type', 'application/x-download')
+            if self.get_status() == 206:
+                self.add_header('Content-Range', 'bytes %d-%d/%d' % (file_ranges[0][0], file_ranges[0][1], file_stream.length))
+        self.add_header('Content-Length', sum(last - first + 1 for first, last in file_ranges) +
+            sum(len(part) for part in file_parts) + len(file_tail))
+
+        # Only the requested bytes are read from storage, ahead of the client,
+        # and the next block is not sent until the last one left the socket.
+        # Blocks are views of buffers reused by the reader, which are written
+        # to the connection as they are, since self.write() would copy them
+        # into bytes; the headers are sent first.
+        file_reader = async_stream.ReadAheadStream(file_output, file_ranges, close_stream=file_stream)
+        try:
+            yield self.flush()
+            for (first, last), part in zip(file_ranges, file_parts):
+                if part:
+                    yield self.request.connection.write(part)
+                file_left = last - first + 1
+                while file_left > 0:
+                    file_block = yield file_reader.read()
+                    if not file_block:
+                        break # Content is shorter than recorded
+                    file_left -= len(file_block)
+                    yield self.request.connection.write(file_block)
+                    file_reader.release(file_block)
+            if file_tail:
+                yield self.request.connection.write(file_tail)
+            self.finish()
+        finally:
+            file_reader.close()
+        return
+
+    pass
 
-        # Release memory...
-        file_stream = None
-        file_data = None
+################################################################################
+
+class BlobDownloadHandler(FilesDownloadHandler):
+    """Serves content by its hash to anyone with a link signed when listing a
+    directory, so the same content has the same link whatever its path and
+    whoever lists it, and is cached once by clients and proxies."""
+
+    @tornado.web.asynchronous
+    @tornado.gen.coroutine
+    def get(self, file_hash, file_name):
+        """/blob/SHA256_OF_CONTENT/ACTUAL_FILENAME?e=EXPIRY&t=TOKEN"""
+        if not utils.check_blob_link(file_hash, self.get_argument('e', ''), self.get_argument('t', '')):
+            raise tornado.web.HTTPError(403)
+
+        file_stream = yield async_session.run(sqlfs.get_content_by_hash, file_hash)
+        if file_stream is None:
+            raise tornado.web.HTTPError(404)
+        # Content of a hash never changes, so it is cached for long
+        file_stat = {'file-hash': file_hash, 'upload-time': None}
+        yield self.send_content(file_stream, file_stat, utils.http_immutable_public)
         return
 
     pass
@@ -214,7 +295,6 @@ class FilesOperationHandler(tornado.web.RequestHandler):
         # Another concurrency blob...
         working_user = users.get_user_by_cookie(
             self.get_cookie('user_active_login', default=''))
-        future = tornado.concurrent.Future()
 
         operation_content_raw = self.request.body
         operation_content = json.loads(operation_content_raw.decode('utf-8', 'ignore'))
@@ -241,32 +321,17 @@ class FilesOperationHandler(tornado.web.RequestHandler):
         # Done assigning values, now attempting to perform operation
         if action == 'copy':
             for source in sources:
-                sessid = async_session.create_session(sqlfs.copy, source, target, user=working_user)
-                while not async_session.completed(sessid):
-                    yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-                async_session.get_result(sessid)
+                yield async_session.run(sqlfs.copy, source, target, user=working_user)
         elif action == 'move':
             for source in sources:
-                sessid = async_session.create_session(sqlfs.move, source, target, user=working_user)
-                while not async_session.completed(sessid):
-                    yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-                async_session.get_result(sessid)
+                yield async_session.run(sqlfs.move, source, target, user=working_user)
         elif action == 'delete':
             for source in sources:
-                sessid = async_session.create_session(sqlfs.remove, source, user=working_user)
-                while not async_session.completed(sessid):
-                    yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-                async_session.get_result(sessid)
+                yield async_session.run(sqlfs.remove, source, user=working_user)
         elif action == 'rename':
-            sessid = async_session.create_session(sqlfs.rename, sources, target, user=working_user)
-            while not async_session.completed(sessid):
-                yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-            async_session.get_result(sessid)
+            yield async_session.run(sqlfs.rename, sources, target, user=working_user)
         elif action == 'new-folder':
-            sessid = async_session.create_session(sqlfs.create_directory, sources, target, user=working_user)
-            while not async_session.completed(sessid):
-                yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-            async_session.get_result(sessid)
+            yield async_session.run(sqlfs.create_directory, sources, target, user=working_user)
 
         file_temp = ''
 
@@ -289,23 +354,47 @@ class FilesOperationHandler(tornado.web.RequestHandler):
 class FilesUploadHandler(tornado.web.RequestHandler):
     SUPPORTED_METHODS = ['POST']
 
+    file_handle = None
+    file_writing = None # Future of the chunk being written
+    file_claimed = False # Handle closed by post(), or discarded
+
+    @tornado.gen.coroutine
     def prepare(self):
         """Creates file handle to write on."""
         content_length = self.request.headers['Content-Length']
-        self.file_handle = sqlfs.create_file_handle(
+        self.file_handle = yield async_session.run(sqlfs.create_file_handle,
             mode       = 'write',
             est_length = int(content_length)
         )
+        # The client might have gone while creating the handle
+        if self.file_claimed:
+            self.file_claimed = False
+            self.on_connection_close()
         # Done creating handle, proceeding.
         return
 
     @tornado.gen.coroutine
     def data_received(self, chunk):
         """Makes receival and push changes to handle."""
-        sessid = async_session.create_session(self.file_handle.write, chunk)
-        while not async_session.completed(sessid):
-            yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-        async_session.get_result(sessid)
+        self.file_writing = async_session.run(self.file_handle.write, chunk)
+        yield self.file_writing
+        return
+
+    def on_connection_close(self):
+        """Discards content of an aborted upload, which also gives back the
+        connection of a large object being written, once the chunk being
+        written is done."""
+        if self.file_claimed:
+            return
+        self.file_claimed = True
+        file_handle = self.file_handle
+        if not file_handle:
+            return # Discarded by prepare() once created
+        if self.file_writing and not self.file_writing.done():
+            tornado.ioloop.IOLoop.current().add_future(self.file_writing,
+                lambda future: async_session.submit(file_handle.destroy))
+            return
+        async_session.submit(file_handle.destroy)
         return
 
     @tornado.web.asynchronous
@@ -317,14 +406,11 @@ class FilesUploadHandler(tornado.web.RequestHandler):
             self.get_cookie('user_active_login', default=''))
 
         target_path = utils.decode_hexed_b64_to_str(target_path)
-        sessid = async_session.create_session(self.file_handle.close)
-        while not async_session.completed(sessid):
-            yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-        async_session.get_result(sessid)
-        sessid = async_session.create_session(sqlfs.create_file, target_path, file_name, self.file_handle, user=working_user)
-        while not async_session.completed(sessid):
-            yield tornado.gen.Task(tornado.ioloop.IOLoop.instance().add_timeout, time.time() + 0.001)
-        async_session.get_result(sessid)
+        if self.file_claimed:
+            return # Discarded as the client had gone
+        self.file_claimed = True
+        yield async_session.run(self.file_handle.close)
+        yield async_session.run(sqlfs.create_file, target_path, file_name, self.file_handle, user=working_user)
 
         response_temp = 'bzs_upload_success'
 
@@ -340,3 +426,64 @@ class FilesUploadHandler(tornado.web.RequestHandler):
         self.finish()
         return
     pass
+
+################################################################################
+
+class FilesUploadHashHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ['POST']
+
+    @tornado.web.asynchronous
+    @tornado.gen.coroutine
+    def post(self, target_path, file_name):
+        """/files/upload_hash/HEXED_BASE64_STRING_OF_PATH_OF_PARENT/ACTUAL_FILENAME
+
+        Pre-flight of an upload, the body being a JSON object of 'hash' and
+        'size' of the content, hashed as sqlfs does. A challenge is returned as
+        a JSON object of 'offset', 'length', 'expiry' and 'token', whether or
+        not the content is stored, so that only those having the content could
+        learn that it is. The client posts again, adding the challenge and the
+        'proof', which is the hex SHA256 of the token followed by 'length'
+        bytes of the content from 'offset'. If the content is stored and the
+        proof holds, the file is created right away with nothing else
+        uploaded, and 'bzs_upload_success' is returned. Otherwise
+        'bzs_upload_required' tells the client to upload the content with
+        FilesUploadHandler."""
+        working_user = users.get_user_by_cookie(
+            self.get_cookie('user_active_login', default=''))
+
+        try:
+            target_path = utils.decode_hexed_b64_to_str(target_path)
+            upload_info = json.loads(self.request.body.decode('utf-8', 'ignore'))
+            f_hash = str(upload_info['hash']).lower()
+            f_size = int(upload_info['size'])
+            proof = upload_info.get('proof', None)
+            if proof is not None:
+                proof = str(proof).lower()
+                challenge = dict((key, int(upload_info[key])) for key in ['offset', 'length', 'expiry'])
+                challenge['token'] = str(upload_info['token'])
+        except Exception:
+            raise tornado.web.HTTPError(400)
+        if not re.match(r'^[0-9a-f]{64}$', f_hash) or f_size < 0:
+            raise tornado.web.HTTPError(400)
+
+        if proof is None:
+            usr_handle = working_user.handle if working_user else 'public'
+            response_temp = json.dumps(utils.make_upload_challenge(f_hash, f_size, usr_handle))
+            content_type = 'application/json; charset=UTF-8'
+        else:
+            res = yield async_session.run(sqlfs.create_file_by_hash, target_path, file_name, f_hash, f_size, challenge, proof, user=working_user)
+            response_temp = 'bzs_upload_success' if res else 'bzs_upload_required'
+            content_type = 'text/html; charset=UTF-8'
+
+        self.set_status(200, "OK")
+        self.add_header('Cache-Control', 'max-age=0')
+        self.add_header('Connection', 'close')
+        self.set_header('Content-Type', content_type)
+        self.add_header('Content-Length', str(len(response_temp)))
+
+        # Push result to client in one blob
+        self.write(response_temp)
+        self.flush()
+        self.finish()
+        return
+    pass
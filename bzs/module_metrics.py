@@ -0,0 +1,44 @@
+
+import json
+import tornado
+
+from . import async_session
+from . import db
+from . import sqlfs
+from . import users
+
+class MetricsHandler(tornado.web.RequestHandler):
+    SUPPORTED_METHODS = ['GET', 'HEAD']
+
+    def get(self):
+        """/settings/metrics/"""
+        working_user = users.get_user_by_cookie(
+            self.get_cookie('user_active_login', default=''))
+        # Only the kernel is allowed to peek into server internals
+        if working_user.handle != 'kernel':
+            raise tornado.web.HTTPError(403)
+
+        file_data = json.dumps({
+            'async-session': async_session.get_metrics(),
+            'database-pool': db.Database.pool.stats(),
+            'database-raw-pool': db.Database.raw_pool.stats(),
+            'sqlfs-compression': sqlfs.get_compression_report(),
+            'sqlfs-gc': sqlfs.get_gc_metrics(),
+            'sqlfs-scrub': sqlfs.get_scrub_metrics(),
+            'sqlfs-scrub-failures': sqlfs.get_scrub_failures(),
+        }, indent=4, sort_keys=True)
+
+        self.set_status(200, "OK")
+        self.add_header('Cache-Control', 'max-age=0')
+        self.add_header('Connection', 'close')
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.add_header('Content-Length', str(len(file_data)))
+
+        # Push result to client in one blob
+        self.write(file_data)
+        self.flush()
+        self.finish()
+        return
+
+    head=get
+    pass
@@ -4,6 +4,7 @@ import re
 import tornado
 import urllib
 
+from . import async_session
 from . import const
 from . import users
 from . import utils
@@ -18,6 +19,23 @@ class PreviewHandler(tornado.web.RequestHandler):
         working_user = users.get_user_by_cookie(
             self.get_cookie('user_active_login', default=''))
 
+        # Content is linked to by hash, so the page only changes with the link,
+        # the user or the templates
+        try:
+            file_path = utils.decode_hexed_b64_to_str(file_hash)
+            file_stat = yield async_session.run(sqlfs.get_stat, file_path, working_user)
+        except Exception:
+            file_stat = None
+        file_link = utils.get_blob_link(file_stat['file-hash'], file_stat['file-name']) if file_stat else ''
+        file_etag = 'W/' + utils.make_etag(('%s/%s/%s/%s/%s' % (mode, file_hash,
+            file_link, working_user.handle, utils.http_boot_tag)).encode('utf-8'))
+        if utils.http_not_modified(self.request.headers, [file_etag]):
+            self.set_status(304, "Not Modified")
+            self.add_header('Cache-Control', 'max-age=0')
+            self.add_header('ETag', file_etag)
+            self.finish()
+            return self
+
         # In case it does not exist.
         future = tornado.concurrent.Future()
         def get_index_html_async(working_user, file_hash):
@@ -38,6 +56,7 @@ class PreviewHandler(tornado.web.RequestHandler):
                     file_hash=file_hash,
                     file_name=file_name,
                     file_name_url=urllib.parse.quote(file_name),
+                    file_link=file_link,
                     file_mime=file_mime,
                     xsrf_form_html=self.xsrf_form_html()
                 )
@@ -53,6 +72,7 @@ class PreviewHandler(tornado.web.RequestHandler):
                     file_hash=file_hash,
                     file_name=file_name,
                     file_name_url=urllib.parse.quote(file_name),
+                    file_link=file_link,
                     file_mime=file_mime,
                     xsrf_form_html=self.xsrf_form_html()
                 )
@@ -67,6 +87,7 @@ class PreviewHandler(tornado.web.RequestHandler):
                     file_hash=file_hash,
                     file_name=file_name,
                     file_name_url=urllib.parse.quote(file_name),
+                    file_link=file_link,
                     file_name_escaped=cgi.escape(file_name),
                     file_mime=file_mime,
                     xsrf_form_html=self.xsrf_form_html()
@@ -88,6 +109,7 @@ class PreviewHandler(tornado.web.RequestHandler):
         self.set_status(200, "OK")
         self.add_header('Cache-Control', 'max-age=0')
         self.add_header('Connection', 'close')
+        self.add_header('ETag', file_etag)
         self.set_header('Content-Type', 'text/html; charset=UTF-8')
         self.add_header('Content-Length', str(len(file_data)))
 
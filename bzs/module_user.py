@@ -129,11 +129,21 @@ class UserAvatarHandler(tornado.web.RequestHandler):
         tornado.ioloop.IOLoop.instance().add_callback(
             get_avatar_async, working_user, user_name)
         file_mime, file_data = yield future
+        file_etag = utils.make_etag(file_data)
+
+        # Avatar unchanged since last fetched
+        if utils.http_not_modified(self.request.headers, [file_etag]):
+            self.set_status(304, "Not Modified")
+            self.add_header('Cache-Control', 'max-age=0')
+            self.add_header('ETag', file_etag)
+            self.finish()
+            return self
 
         # File actually exists, sending data
         self.set_status(200, "OK")
         self.add_header('Cache-Control', 'max-age=0')
         self.add_header('Connection', 'close')
+        self.add_header('ETag', file_etag)
         self.set_header('Content-Type', file_mime)
         self.add_header('Content-Length', str(len(file_data)))
 
@@ -2,89 +2,161 @@
 import re
 import threading
 
+from . import file_hash
 from . import file_storage
+from . import file_storage_gc
+from . import file_storage_scrub
 from . import file_system
+from . import file_system_lock
 from . import file_system_permissions
+from . import file_system_snapshot
 
+from .. import const
 from .. import db
 from .. import utils
 
+# Threads hashing uploads
+
+file_hash.HashPool.configure(const.get_const('sqlfs-hash-threads'))
+
+# Load snapshot of the tree and storage, if it is up to date
+
+FilesystemSnapshot = file_system_snapshot.FilesystemSnapshot(
+    database = db.Database,
+    path     = const.get_const('sqlfs-snapshot-path'))
+
+snapshot = FilesystemSnapshot.load() if not const.get_const('sqlfs-lazy-load') else None
+
 # Initialize file storage system
 
 FileStorage = file_storage.FileStorage(
     database      = db.Database,
-    utils_package = utils)
+    utils_package = utils,
+    engine        = const.get_const('sqlfs-storage-engine'),
+    blob_path     = const.get_const('sqlfs-blob-path'),
+    codec         = const.get_const('sqlfs-compression'),
+    snapshot      = snapshot)
 
 # Initialize filesystem
 
 Filesystem = file_system.Filesystem(
-    database      = db.Database,
-    filestorage   = FileStorage,
-    utils_package = utils)
+    database       = db.Database,
+    filestorage    = FileStorage,
+    utils_package  = utils,
+    lazy_load      = const.get_const('sqlfs-lazy-load'),
+    resident_nodes = const.get_const('sqlfs-resident-nodes'),
+    snapshot       = snapshot)
 
 # Initialize permission manager
 
 FilesystemPermissions = file_system_permissions.FilesystemPermissions(
+    filesystem = Filesystem,
+    cache_size = const.get_const('sqlfs-permission-cache-size'))
+
+# Initialize tree locks
+
+FilesystemLock = file_system_lock.FilesystemLock(
     filesystem = Filesystem)
 
-FilesystemLock = threading.Lock()
+# Initialize garbage collector of file storage
+
+FileStorageCollector = file_storage_gc.FileStorageCollector(
+    database = db.Database,
+    budget   = const.get_const('sqlfs-gc-budget'))
+
+# Initialize integrity scrubber of file storage
+
+FileStorageScrubber = file_storage_scrub.FileStorageScrubber(
+    database   = db.Database,
+    threads    = const.get_const('sqlfs-scrub-threads'),
+    rate       = const.get_const('sqlfs-scrub-rate'),
+    budget     = const.get_const('sqlfs-scrub-budget'),
+    quarantine = const.get_const('sqlfs-scrub-quarantine'))
+
+Filesystem.bind_lock(FilesystemLock)
+FilesystemSnapshot.bind(Filesystem, FileStorage, FilesystemLock)
+FileStorageCollector.bind(Filesystem, FileStorage, FilesystemLock)
+FileStorageScrubber.bind(FileStorage)
+del snapshot
 
 ################################################################################
 # Exported file-system functions, permission-safe.
 
 def create_file_handle(mode='read', est_length=1024**8, obj_oid=0, obj_data=b''):
     """Returns a new file stream object which does nothing to the filesystem
-    unless been invoked to be injected into filesystem."""
-    FilesystemLock.acquire()
+    unless been invoked to be injected into filesystem. Large files are written
+    in chunks if FileStorage uses the 'chunked' engine, and files are written to
+    local filesystem with the 'blob' engine."""
     ret_val = file_stream.FileStream(
         mode=mode,
         est_length=est_length,
         obj_oid=obj_oid,
         obj_data=obj_data,
-        database=db.Database)
-    FilesystemLock.release()
+        database=db.Database,
+        chunk_store=FileStorage.st_chunks if FileStorage.st_engine == 'chunked' and mode == 'write' else None,
+        blob_store=FileStorage.st_blobs if FileStorage.st_engine == 'blob' and mode == 'write' else None)
     return ret_val
 
 def create_file(path_parent, file_name, content_stream, user=None):
     """Inject object into filesystem, while passing in content. The content
     itself would be indexed in FileStorage. If 'path-parent' is not writable,
     then the creation would be denied."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.writable(path_parent, user):
-        FilesystemLock.release()
-        return False
+    # Content read back to be hashed, or compressed, is not read while holding
+    # locks
+    FileStorage.st_hash_algo(content_stream)
+    FileStorage.encode(content_stream, file_name)
+    with FilesystemLock.exclusive(path_parent) as (path_parent,):
+        if user and not FilesystemPermissions.writable(path_parent, user):
+            return False
+        usr_handle = user.handle if user else 'public'
+        with db.Database.transaction():
+            ret_result = Filesystem.create_file(path_parent, file_name, usr_handle, content_stream)
+    return ret_result
+
+def create_file_by_hash(path_parent, file_name, f_hash, f_size, challenge, proof, user=None):
+    """Inject object into filesystem, with content that is already stored,
+    identified by its hash and size. No content needs to be transferred, but
+    the user must prove having it: 'proof' is the hex SHA256 of the token of
+    'challenge', made by utils.make_upload_challenge(), followed by the range
+    of content it asks for. False is returned if the content is unknown, the
+    proof does not hold or 'path_parent' is not writable."""
     usr_handle = user.handle if user else 'public'
-    ret_result = Filesystem.create_file(path_parent, file_name, usr_handle, content_stream)
-    FilesystemLock.release()
+    if not utils.check_upload_challenge(f_hash, f_size, usr_handle, challenge):
+        return False
+    # Content read back for the proof is not read while holding locks
+    if not FileStorage.check_proof(f_hash, f_size, int(challenge['offset']), int(challenge['length']), str(challenge['token']).encode('utf-8'), proof):
+        return False
+    with FilesystemLock.exclusive(path_parent) as (path_parent,):
+        if user and not FilesystemPermissions.writable(path_parent, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.create_file_by_hash(path_parent, file_name, usr_handle, f_hash, f_size)
     return ret_result
 
 def create_directory(path_parent, file_name, user=None):
     """Create directory under path_parent into filesystem. If 'path-parent' is
     not writable, then the creation would be denied."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.writable(path_parent, user):
-        FilesystemLock.release()
-        return False
-    usr_handle = user.handle if user else 'public'
-    ret_result = Filesystem.create_directory(path_parent, file_name, usr_handle)
-    FilesystemLock.release()
+    with FilesystemLock.exclusive(path_parent) as (path_parent,):
+        if user and not FilesystemPermissions.writable(path_parent, user):
+            return False
+        usr_handle = user.handle if user else 'public'
+        with db.Database.transaction():
+            ret_result = Filesystem.create_directory(path_parent, file_name, usr_handle)
     return ret_result
 
 def copy(source, target_parent, user=None):
     """Copies content of 'source' (recursively) and hang the target object
     that was copied under the node 'target_parent'. Destination can be the
     same as source folder."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.readable(source, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable(target_parent, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.copy_with_handle(source, target_parent, new_owner=None)
-    if user:
-        FilesystemPermissions.copy_reown(ret_result, user)
-    FilesystemLock.release()
+    with FilesystemLock.lock(shared=[source], exclusive=[target_parent]) as (source, target_parent):
+        if user and not FilesystemPermissions.readable(source, user):
+            return False
+        if user and not FilesystemPermissions.writable(target_parent, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.copy_with_handle(source, target_parent, new_owner=None)
+            if user:
+                FilesystemPermissions.copy_reown(ret_result, user)
     return True if ret_result != None else False
 
 def move(source, target_parent, user=None):
@@ -92,67 +164,56 @@ def move(source, target_parent, user=None):
     that was moved under the node 'target_parent'. Destination should not
     at all be the same as source folder, otherwise operation would not be
     executed."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.readable(source, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_all(source, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_self(source, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable(target_parent, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.move_with_handle(source, target_parent)
-    if user:
-        FilesystemPermissions.copy_reown(ret_result, user)
-    FilesystemLock.release()
+    with FilesystemLock.lock(exclusive=[target_parent], exclusive_parent=[source]) as (target_parent, source):
+        if user and not FilesystemPermissions.readable(source, user):
+            return False
+        if user and not FilesystemPermissions.writable_all(source, user):
+            return False
+        if user and not FilesystemPermissions.writable_self(source, user):
+            return False
+        if user and not FilesystemPermissions.writable(target_parent, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.move_with_handle(source, target_parent)
+            if user:
+                FilesystemPermissions.copy_reown(ret_result, user)
     return True if ret_result != None else False
 
 def remove(path, user=None):
     """Removes (recursively) all content of the folder / file itself and
     all its subdirectories. Must have read and write access."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.readable(path, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_self(path, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_all(path, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.remove(path)
-    FilesystemLock.release()
+    with FilesystemLock.lock(exclusive_parent=[path]) as (path,):
+        if user and not FilesystemPermissions.readable(path, user):
+            return False
+        if user and not FilesystemPermissions.writable_self(path, user):
+            return False
+        if user and not FilesystemPermissions.writable_all(path, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.remove(path)
     return ret_result
 
 def rename(path, file_name, user=None):
     """Renames object 'path' into file_name. Must have read and write access."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.read_writable(path, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_self(path, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.rename(path, file_name)
-    FilesystemLock.release()
+    with FilesystemLock.lock(exclusive_parent=[path]) as (path,):
+        if user and not FilesystemPermissions.read_writable(path, user):
+            return False
+        if user and not FilesystemPermissions.writable_self(path, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.rename(path, file_name)
     return ret_result
 
 def change_ownership(path, owner, user=None):
     """Assign owner of 'path' to new owner, recursively. Must have both read
     and write access to itself and all subfiles."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.read_writable_all(path, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_self(path, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.change_ownership(path, owner)
-    FilesystemLock.release()
+    with FilesystemLock.exclusive(path) as (path,):
+        if user and not FilesystemPermissions.read_writable_all(path, user):
+            return False
+        if user and not FilesystemPermissions.writable_self(path, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.change_ownership(path, owner)
     return ret_result
 
 def change_permissions(path, permissions, recursive=False, user=None):
@@ -168,24 +229,22 @@ def change_permissions(path, permissions, recursive=False, user=None):
         directory.
     In 'write' mode, sub_files would not be writable if and only if it
         itself is not writable or its parent does not allow its writing."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.read_writable_all(path, user):
-        FilesystemLock.release()
-        return False
-    if user and not FilesystemPermissions.writable_self(path, user):
-        FilesystemLock.release()
-        return False
-    ret_result = Filesystem.change_permissions(path, permissions, recursive)
-    FilesystemLock.release()
+    with FilesystemLock.exclusive(path) as (path,):
+        if user and not FilesystemPermissions.read_writable_all(path, user):
+            return False
+        if user and not FilesystemPermissions.writable_self(path, user):
+            return False
+        with db.Database.transaction():
+            ret_result = Filesystem.change_permissions(path, permissions, recursive)
     return ret_result
 
 def expunge_user_ownership(handle):
     """Must only be called from kernel / system, used when removing a usergroup
     or a user. Its ownership is expunged from the system, and replaced by the
     file node's parent."""
-    FilesystemLock.acquire()
-    ret_result = Filesystem.expunge_user_ownership(handle)
-    FilesystemLock.release()
+    with FilesystemLock.exclusive('/'):
+        with db.Database.transaction():
+            ret_result = Filesystem.expunge_user_ownership(handle)
     return ret_result
 
 def list_directory(path, user=None):
@@ -194,6 +253,7 @@ def list_directory(path, user=None):
 
         file-name   - File name
         file-size   - File size
+        file-hash   - Hash of the content, None for directories
         is-dir      - Whether is directory
         owner       - The handle of the owner
         upload-time - Time uploaded, in float since epoch.
@@ -201,27 +261,135 @@ def list_directory(path, user=None):
 
     The result should always be a list, and please index it with your own
     habits or modify the code."""
-    FilesystemLock.acquire()
-    fil_ls = Filesystem.list_directory(path)
-    ret_result = list()
-    for item in fil_ls:
-        if user and not FilesystemPermissions.readable(item['file-name'], user, parent=path):
-            continue
-        if user:
-            item['writable'] = FilesystemPermissions.writable_self(item['file-name'], user, parent=path)
-        ret_result.append(item)
-    FilesystemLock.release()
+    with FilesystemLock.shared(path) as (path,):
+        fil_ls = Filesystem.list_directory(path)
+        ret_result = list()
+        for item in fil_ls:
+            if user and not FilesystemPermissions.readable(item['file-name'], user, parent=path):
+                continue
+            if user:
+                item['writable'] = FilesystemPermissions.writable_self(item['file-name'], user, parent=path)
+            ret_result.append(item)
     return ret_result
 
 def get_content(path, user):
     """Gets binary content of the object (must be file) and returns the
     actual content in bytes."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.readable(path, user):
-        FilesystemLock.release()
-        return file_stream.EmptyFileStream
-    ret_result = Filesystem.get_content(path)
-    FilesystemLock.release()
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.readable(path, user):
+            return file_stream.EmptyFileStream
+        ret_result = Filesystem.get_content(path)
+    return ret_result
+
+def get_content_stat(path, user):
+    """Gets binary content of the object (must be file) as get_content() does,
+    along with its attributes as of the same moment, which are the same as of
+    list_directory(). The attributes are None if the content could not be
+    read."""
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.readable(path, user):
+            return file_stream.EmptyFileStream, None
+        ret_result = (Filesystem.get_content(path), Filesystem.stat(path))
+    return ret_result
+
+def get_content_by_hash(f_hash):
+    """Gets binary content of the file with hash 'f_hash', wherever it is in
+    the tree, or None if there is no such file. Access must be checked by the
+    caller beforehand."""
+    f_uuid = FileStorage.find_by_hash(f_hash)
+    if not f_uuid:
+        return None
+    ret_result = FileStorage.get_content(f_uuid)
+    if not ret_result:
+        return None # Removed meanwhile
+    return ret_result
+
+def get_stat(path, user):
+    """Gets attributes of the object (must be file), the same as of
+    list_directory(), or None if it could not be read."""
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.readable(path, user):
+            return None
+        ret_result = Filesystem.stat(path)
+    return ret_result
+
+def save_snapshot():
+    """Write snapshot of the tree and storage to disk if it had changed since
+    last saved. Writers are blocked while the tree is being walked."""
+    ret_result = FilesystemSnapshot.save()
+    return ret_result
+
+def collect_garbage():
+    """Correct reference counts, compact sparse rows and pack segments, and
+    unlink unreferenced large objects, within the I/O budget of a run. Returns
+    bytes reclaimed, or None if a collection is already running."""
+    ret_result = FileStorageCollector.collect()
+    return ret_result
+
+def scrub_storage():
+    """Verify content of stored files against their hashes, from where the
+    last run stopped, within the I/O budget of a run. Returns the number of
+    files verified, or None if a run is already going on."""
+    ret_result = FileStorageScrubber.scrub()
+    return ret_result
+
+def get_scrub_failures():
+    """Files found damaged by the scrubber, by UUID."""
+    ret_result = FileStorageScrubber.get_failures()
+    return ret_result
+
+def get_scrub_metrics():
+    """Progress of the current pass and totals of the scrubber."""
+    ret_result = FileStorageScrubber.get_metrics()
+    return ret_result
+
+def get_compression_report():
+    """Number of files, original size and stored size of files by codec."""
+    ret_result = FileStorage.compression_report()
+    return ret_result
+
+def get_gc_metrics():
+    """Bytes reclaimed and other totals of the garbage collector."""
+    ret_result = FileStorageCollector.get_metrics()
+    return ret_result
+
+def migrate_to_blobs(callback=None):
+    """Move content of all files in large objects, sparse rows or chunks to
+    the blob store on local filesystem, one file per transaction, so it could
+    be interrupted and resumed. 'callback(done, total, moved)' is called after
+    each file. Returns the number of files moved."""
+    uuids = FileStorage.list_migratable()
+    ret_result = 0
+    for idx in range(0, len(uuids)):
+        with FilesystemLock.shared('/'), FileStorage.st_lock, db.Database.transaction():
+            moved = FileStorage.migrate_to_blob(uuids[idx])
+            if moved:
+                Filesystem.bump_generation() # Snapshots hold the engine of files
+        ret_result += 1 if moved else 0
+        if callback:
+            callback(idx + 1, len(uuids), moved)
+    return ret_result
+
+def verify_storage(callback=None):
+    """Hash content of all stored files again and compare with their recorded
+    hashes, while the server may keep running. 'callback(done, total, ok)' is
+    called after each file. Returns UUIDs of files that did not match or
+    could not be read, and were not removed meanwhile."""
+    files = FileStorage.list_files()
+    ret_result = list()
+    for idx in range(0, len(files)):
+        f_uuid, f_hash, f_size = files[idx]
+        try:
+            stream = FileStorage.get_content(f_uuid)
+            digest = file_hash.hash_stream(stream)
+            stream.close()
+        except Exception:
+            digest = None
+        ok = digest == f_hash or not FileStorage.exists(f_uuid)
+        if not ok:
+            ret_result.append(f_uuid)
+        if callback:
+            callback(idx + 1, len(files), ok)
     return ret_result
 
 def get_file_name(path):
@@ -234,27 +402,21 @@ def get_file_name(path):
 
 def readable(path, user):
     """Whether the user has read access to this file."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.readable(path, user):
-        FilesystemLock.release()
-        return False
-    FilesystemLock.release()
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.readable(path, user):
+            return False
     return True
 
 def writable(path, user):
     """Whether the user has write access to this file."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.writable(path, user):
-        FilesystemLock.release()
-        return False
-    FilesystemLock.release()
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.writable(path, user):
+            return False
     return True
 
 def writable_self(path, user):
     """Whether the user has write access to this file from the parent."""
-    FilesystemLock.acquire()
-    if user and not FilesystemPermissions.writable_self(path, user):
-        FilesystemLock.release()
-        return False
-    FilesystemLock.release()
+    with FilesystemLock.shared(path) as (path,):
+        if user and not FilesystemPermissions.writable_self(path, user):
+            return False
     return True
@@ -0,0 +1,217 @@
+
+import io
+import mmap
+import os
+import threading
+import uuid as uuid_package
+
+class BlobStore:
+    """Stores content as files on the local filesystem, named by the hash of
+    the content and sharded into directories by its leading characters:
+
+        <path>/ab/cd/abcd...    - Content of hash 'abcd...'
+        <path>/tmp/             - Uploads in progress
+
+    Uploads are written to a temporary file, which is renamed atomically into
+    place once the hash is known, so a blob is either complete or absent.
+    Directories are created when first written to."""
+
+    def __init__(self, path=''):
+        if not path:
+            raise AttributeError('Must provide a path')
+        self.path = path
+        self.tmp_path = os.path.join(path, 'tmp')
+        self.writing = set() # Temporary files of uploads in progress
+        self.lock = threading.Lock()
+        return
+
+    def __fsync_dir(self, path):
+        """Make a rename in 'path' durable, where supported."""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+        return
+
+    def blob_path(self, hash_):
+        return os.path.join(self.path, hash_[0:2], hash_[2:4], hash_)
+
+    def writer(self):
+        """Returns a BlobWriter to a new temporary file."""
+        os.makedirs(self.tmp_path, exist_ok=True)
+        tmp_path = os.path.join(self.tmp_path, uuid_package.uuid4().hex + '.part')
+        with self.lock:
+            self.writing.add(tmp_path)
+        return BlobWriter(tmp_path)
+
+    def commit(self, tmp_path, hash_):
+        """Move a finished upload into place as the blob of 'hash_'."""
+        final_path = self.blob_path(hash_)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+        with self.lock:
+            self.writing.discard(tmp_path)
+        self.__fsync_dir(os.path.dirname(final_path))
+        return final_path
+
+    def discard(self, tmp_path):
+        """Drop an upload that would not be stored."""
+        with self.lock:
+            self.writing.discard(tmp_path)
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        return
+
+    def remove(self, hash_):
+        try:
+            os.remove(self.blob_path(hash_))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def exists(self, hash_):
+        return os.path.isfile(self.blob_path(hash_))
+
+    def list_uploads(self):
+        """Size and time last modified of temporary files, by path, leaving out
+        uploads in progress in this process."""
+        ret_result = dict()
+        with self.lock:
+            writing = set(self.writing)
+        try:
+            names = os.listdir(self.tmp_path)
+        except FileNotFoundError:
+            return ret_result
+        for name in names:
+            tmp_path = os.path.join(self.tmp_path, name)
+            if not name.endswith('.part') or tmp_path in writing:
+                continue
+            try:
+                st = os.stat(tmp_path)
+            except FileNotFoundError:
+                continue
+            ret_result[tmp_path] = (st.st_size, st.st_mtime)
+        return ret_result
+
+    def list_blobs(self):
+        """Size of every blob, by hash."""
+        ret_result = dict()
+        for dir_path, dir_names, file_names in os.walk(self.path):
+            if dir_path == self.path and 'tmp' in dir_names:
+                dir_names.remove('tmp')
+            for name in file_names:
+                if len(name) < 4 or os.path.dirname(self.blob_path(name)) != dir_path:
+                    continue
+                try:
+                    ret_result[name] = os.path.getsize(os.path.join(dir_path, name))
+                except FileNotFoundError:
+                    continue
+        return ret_result
+
+    def reader(self, hash_):
+        """Returns a BlobReader of the blob of 'hash_'."""
+        return BlobReader(self.blob_path(hash_))
+    pass
+
+class BlobWriter:
+    """File-like object writing an upload to a temporary file. The content
+    must be written sequentially."""
+
+    def __init__(self, path):
+        self.path = path
+        self.content_obj = open(path, 'wb')
+        self.length = 0
+        self.closed = False
+        return
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.content_obj.write(data)
+        self.length += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """Only seeking to the end is supported."""
+        target = offset + [0, self.length, self.length][whence]
+        if target != self.length:
+            raise io.UnsupportedOperation('blobs could only be written sequentially')
+        return self.length
+
+    def close(self):
+        """Flush content to disk, so that it could be renamed into place."""
+        if self.closed:
+            return
+        self.content_obj.flush()
+        os.fsync(self.content_obj.fileno())
+        self.content_obj.close()
+        self.closed = True
+        return
+    pass
+
+class BlobReader:
+    """File-like object reading a blob through a read-only memory map, so
+    reads are copied once from the page cache, with no system call."""
+
+    def __init__(self, path):
+        self.path = path
+        self.content_file = open(path, 'rb')
+        self.length = os.fstat(self.content_file.fileno()).st_size
+        # Empty files could not be mapped
+        self.content_map = mmap.mmap(self.content_file.fileno(), 0, access=mmap.ACCESS_READ) if self.length > 0 else b''
+        self.pos = 0
+        self.closed = False
+        return
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.length - self.pos
+        ret_result = self.content_map[self.pos:self.pos + size]
+        self.pos += len(ret_result)
+        return ret_result
+
+    def readinto(self, buffer):
+        """Copy straight from the memory map into 'buffer'."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        size = max(0, min(len(buffer), self.length - self.pos))
+        if size > 0:
+            with memoryview(self.content_map) as view:
+                memoryview(buffer)[:size] = view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.pos = max(0, offset + [0, self.pos, self.length][whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def fileno(self):
+        return self.content_file.fileno()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.length > 0:
+            self.content_map.close()
+        self.content_file.close()
+        self.closed = True
+        return
+    pass
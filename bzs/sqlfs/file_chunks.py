@@ -0,0 +1,388 @@
+
+import array
+import bisect
+import hashlib
+import io
+import re
+import threading
+
+min_chunk_size = 16 * 1024 # No boundaries before 16 KB into a chunk
+max_chunk_size = 256 * 1024 # Chunks are cut at 256 KB regardless of content
+chunk_mask_bits = 15 # Boundary chance at each byte is 1 / 2**15, averaging 48 KB
+prefetch_chunks = 16 # Chunks fetched at once when reading
+
+# Gear table of the rolling hash. It must never change, otherwise boundaries
+# and hence stored chunks would no longer match new uploads.
+gear_table = list(int.from_bytes(hashlib.sha256(b'bzs-gear-' + bytes([i])).digest()[:8], 'little') for i in range(0, 256))
+
+def make_boundary_pattern():
+    """Each byte is hashed to one bit per position of the window, taken from
+    the gear table, and a boundary follows the window where all bits are set.
+    As a rolling hash this would be checked byte by byte, which is slow in
+    Python, so the window is matched with a regular expression instead, where
+    position k of the window is the set of bytes with bit k set."""
+    pattern = b''
+    for k in range(0, chunk_mask_bits):
+        pattern += b'[' + b''.join(re.escape(bytes([i])) for i in range(0, 256) if (gear_table[i] >> k) & 1) + b']'
+    return re.compile(pattern)
+
+boundary_pattern = make_boundary_pattern()
+
+class Chunker:
+    """Splits a stream of bytes into content-defined chunks with a rolling
+    hash over the last 15 bytes. Boundaries depend on nearby content only, so
+    an insertion or deletion only changes the chunks around it."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0 # Beginning of the current chunk in buffer
+        self.pos = 0 # Where the next search begins, relative to 'start'
+        return
+
+    def feed(self, data):
+        """Append data, returning a list of chunks completed."""
+        ret_result = list()
+        buf = self.buffer
+        buf += data
+        while True:
+            start = self.start
+            avail = len(buf) - start
+            if avail < min_chunk_size:
+                break
+            # Windows ending before the minimum size are not searched
+            begin = max(self.pos, min_chunk_size - chunk_mask_bits)
+            end = min(avail, max_chunk_size)
+            match = boundary_pattern.search(buf, start + begin, start + end)
+            if match:
+                cut = match.end()
+            elif avail < max_chunk_size:
+                # A window may span over the next data
+                self.pos = max(begin, end - chunk_mask_bits + 1)
+                break
+            else:
+                cut = start + max_chunk_size
+            ret_result.append(bytes(buf[start:cut]))
+            self.start = cut
+            self.pos = 0
+        # Compacting once per call
+        if self.start > 0:
+            del buf[:self.start]
+            self.start = 0
+        return ret_result
+
+    def finish(self):
+        """Returns the trailing chunk, or None if there is nothing left."""
+        ret_result = bytes(self.buffer[self.start:]) or None
+        self.buffer = bytearray()
+        self.start = 0
+        self.pos = 0
+        return ret_result
+    pass
+
+class ChunkStore:
+    """Stores each distinct chunk once in the table 'file_storage_chunk', keyed
+    by its SHA256 digest, along with a count of manifest entries referring to
+    it. Chunks are written as soon as they are cut from an upload, with no
+    reference yet; these are pinned in memory until the file is stored or
+    dropped, so that concurrent uploads could share them.
+
+    An index of all chunks is kept in memory:
+
+        size  - The chunk size, in bytes.
+        count - References from stored manifests.
+        pins  - References from uploads in progress.
+        storing - Set once the chunk is stored, None if it already was.
+    """
+
+    class Chunk:
+        __slots__ = ('size', 'count', 'pins', 'storing')
+
+        def __init__(self, size=0, count=0, pins=0):
+            self.size = size
+            self.count = count
+            self.pins = pins
+            self.storing = None
+            return
+        pass
+
+    def __init__(self, database=None):
+        if not database:
+            raise AttributeError('Must provide a database')
+        self.db = database
+        self.idx = dict() # digest -> Chunk
+        self.lock = threading.Lock()
+        for item in self.db.execute("SELECT hash, size, count FROM file_storage_chunk;"):
+            c_hash, c_size, c_count = item
+            self.idx[c_hash] = self.Chunk(c_size, c_count)
+        return
+
+    def __count(self, digests):
+        """Occurrences of each digest."""
+        ret_result = dict()
+        for digest in digests:
+            ret_result[digest] = ret_result.get(digest, 0) + 1
+        return ret_result
+
+    def __drop_unused(self, digests):
+        """Remove chunks that are neither referenced nor pinned."""
+        unused = list(d for d in set(digests) if d in self.idx and self.idx[d].count <= 0 and self.idx[d].pins <= 0)
+        dropped = list((digest, self.idx.pop(digest)) for digest in unused)
+        if unused:
+            self.db.execute("DELETE FROM file_storage_chunk WHERE hash = ANY(%s) AND count <= 0;", (unused,), fetch_func=None)
+            self.db.on_rollback(lambda: self.__restore(dropped))
+        return len(unused)
+
+    def __restore(self, dropped):
+        """Index again chunks of which the removal was rolled back."""
+        with self.lock:
+            for digest, chunk in dropped:
+                self.idx.setdefault(digest, chunk)
+        return
+
+    def __add_counts(self, counts, sign):
+        """Add 'counts' of references to chunks, or remove them if 'sign' is
+        negative."""
+        with self.lock:
+            for digest, n in counts.items():
+                chunk = self.idx.get(digest, None)
+                if chunk:
+                    chunk.count += sign * n
+        return
+
+    def pin(self, digest, data):
+        """Pin chunk of 'digest' for an upload, storing 'data' if the chunk is
+        new. Returns whether the data was stored. The data is stored without
+        holding the lock, while uploads of the same chunk wait for it."""
+        while True:
+            with self.lock:
+                chunk = self.idx.get(digest, None)
+                if not chunk:
+                    chunk = self.Chunk(len(data), 0, 1)
+                    chunk.storing = threading.Event()
+                    self.idx[digest] = chunk
+                    break
+                if not chunk.storing:
+                    chunk.pins += 1
+                    return False
+                storing = chunk.storing
+            storing.wait()
+        try:
+            self.db.execute("""
+                INSERT INTO file_storage_chunk (hash, size, count, content)
+                    VALUES (%s, %s, 0, %s) ON CONFLICT (hash) DO NOTHING;""",
+                (digest, len(data), data), fetch_func=None)
+        except Exception:
+            # Uploads waiting for it would store the chunk themselves
+            with self.lock:
+                if self.idx.get(digest, None) is chunk:
+                    del self.idx[digest]
+            chunk.storing.set()
+            raise
+        with self.lock:
+            storing = chunk.storing
+            chunk.storing = None
+        storing.set()
+        return True
+
+    def unpin(self, digests):
+        """Release pins of an upload, removing chunks no one refers to."""
+        with self.lock:
+            for digest, n in self.__count(digests).items():
+                chunk = self.idx.get(digest, None)
+                if chunk:
+                    chunk.pins -= n
+            ret_result = self.__drop_unused(digests)
+        return ret_result
+
+    def acquire(self, digests):
+        """Add references from a stored manifest."""
+        counts = self.__count(digests)
+        with self.lock:
+            for digest, n in counts.items():
+                self.idx[digest].count += n
+            self.db.execute("""
+                UPDATE file_storage_chunk AS c SET count = c.count + n.cnt
+                    FROM unnest(%s::TEXT[], %s::BIGINT[]) AS n (hash, cnt)
+                    WHERE c.hash = n.hash;""",
+                (list(counts.keys()), list(counts.values())), fetch_func=None)
+            self.db.on_rollback(lambda: self.__add_counts(counts, -1))
+        return
+
+    def release(self, digests):
+        """Remove references from a stored manifest, deleting chunks that are
+        no longer used. Returns the number of chunks deleted."""
+        counts = self.__count(digests)
+        with self.lock:
+            for digest, n in counts.items():
+                chunk = self.idx.get(digest, None)
+                if chunk:
+                    chunk.count -= n
+            self.db.execute("""
+                UPDATE file_storage_chunk AS c SET count = c.count - n.cnt
+                    FROM unnest(%s::TEXT[], %s::BIGINT[]) AS n (hash, cnt)
+                    WHERE c.hash = n.hash;""",
+                (list(counts.keys()), list(counts.values())), fetch_func=None)
+            self.db.on_rollback(lambda: self.__add_counts(counts, 1))
+            ret_result = self.__drop_unused(list(counts.keys()))
+        return ret_result
+
+    def drop_unreferenced(self, digests):
+        """Delete chunks of 'digests' that are neither referenced nor pinned,
+        such as those left by uploads that never completed, whether indexed
+        or not. Returns the number of chunks and bytes reclaimed."""
+        with self.lock:
+            unused = list(d for d in set(digests) if d not in self.idx or (self.idx[d].count <= 0 and self.idx[d].pins <= 0))
+            if not unused:
+                return 0, 0
+            res = self.db.execute("DELETE FROM file_storage_chunk WHERE hash = ANY(%s) AND count <= 0 RETURNING size;", (unused,))
+            dropped = list((digest, self.idx.pop(digest)) for digest in unused if digest in self.idx)
+            self.db.on_rollback(lambda: self.__restore(dropped))
+        res = res or list()
+        return len(res), sum(item[0] for item in res)
+
+    def fetch(self, digests):
+        """Retrieve content of chunks, returns a dict() of digest -> bytes."""
+        ret_result = dict()
+        for item in self.db.execute("SELECT hash, content FROM file_storage_chunk WHERE hash = ANY(%s);", (list(set(digests)),)):
+            ret_result[item[0]] = bytes(item[1])
+        return ret_result
+
+    def stored_size(self):
+        """Total size of distinct chunks stored."""
+        with self.lock:
+            ret_result = sum(chunk.size for chunk in self.idx.values())
+        return ret_result
+    pass
+
+class ChunkWriter:
+    """File-like object that cuts written content into chunks and pins them in
+    the chunk store. The content must be written sequentially."""
+
+    def __init__(self, store):
+        self.store = store
+        self.chunker = Chunker()
+        self.digests = list()
+        self.sizes = array.array('q')
+        self.length = 0
+        self.closed = False
+        return
+
+    def __put(self, chunk):
+        digest = hashlib.sha256(chunk).hexdigest()
+        self.store.pin(digest, chunk)
+        self.digests.append(digest)
+        self.sizes.append(len(chunk))
+        return
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        for chunk in self.chunker.feed(data):
+            self.__put(chunk)
+        self.length += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """Only seeking to the end is supported, as chunks are already cut."""
+        target = offset + [0, self.length, self.length][whence]
+        if target != self.length:
+            raise io.UnsupportedOperation('chunked streams could only be written sequentially')
+        return self.length
+
+    def close(self):
+        if self.closed:
+            return
+        chunk = self.chunker.finish()
+        if chunk:
+            self.__put(chunk)
+        self.closed = True
+        return
+
+    def discard(self):
+        """Drop the pins of an upload that would not be stored."""
+        self.close()
+        self.store.unpin(self.digests)
+        self.digests = list()
+        return
+
+    def manifest(self):
+        """Returns chunk digests and sizes, in order."""
+        return (self.digests, list(self.sizes))
+    pass
+
+class ChunkReader:
+    """File-like object that reads the content of a manifest, fetching a few
+    chunks at a time from the chunk store."""
+
+    def __init__(self, store, manifest):
+        self.store = store
+        self.digests, sizes = manifest
+        self.offsets = array.array('q', [0])
+        for size in sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.length = self.offsets[-1]
+        self.pos = 0
+        self.cache = dict() # Index of chunk -> bytes
+        self.closed = False
+        return
+
+    def __chunk(self, idx):
+        """Content of chunk 'idx', fetching it along with the following ones."""
+        if idx not in self.cache:
+            idx_end = min(idx + prefetch_chunks, len(self.digests))
+            fetched = self.store.fetch(self.digests[idx:idx_end])
+            self.cache = dict((i, fetched[self.digests[i]]) for i in range(idx, idx_end))
+        return self.cache[idx]
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.length - self.pos
+        size = min(size, self.length - self.pos)
+        ret_result = list()
+        while size > 0:
+            idx = bisect.bisect_right(self.offsets, self.pos) - 1
+            chunk = self.__chunk(idx)
+            begin = self.pos - self.offsets[idx]
+            part = chunk[begin:begin + size]
+            ret_result.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return b''.join(ret_result)
+
+    def readinto(self, buffer):
+        """Copy parts of chunks into 'buffer', without joining them first."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        view = memoryview(buffer)
+        size = min(len(view), self.length - self.pos)
+        done = 0
+        while done < size:
+            idx = bisect.bisect_right(self.offsets, self.pos) - 1
+            begin = self.pos - self.offsets[idx]
+            part = memoryview(self.__chunk(idx))[begin:begin + size - done]
+            if not part:
+                break # Content is shorter than recorded
+            view[done:done + len(part)] = part
+            self.pos += len(part)
+            done += len(part)
+        return done
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.pos = max(0, offset + [0, self.pos, self.length][whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.cache = dict()
+        self.closed = True
+        return
+    pass
@@ -0,0 +1,147 @@
+
+import array
+import lzma
+import zlib
+
+# Content is compressed in blocks of this size, each decompressed on its own,
+# so that compressed files could be read from any position. It must never
+# change, otherwise files already compressed could no longer be read.
+codec_block_size = 256 * 1024
+codec_sample_size = 64 * 1024 # Compressed to tell if content is worth compressing
+codec_min_size = 1024 # Smaller files are stored as they are
+codec_max_ratio = 0.9 # Content is compressed if the sample shrinks below this
+
+# Content of these types is already compressed
+incompressible_types = ('image/', 'video/', 'audio/', 'application/zip',
+    'application/x-gzip', 'application/gzip', 'application/x-bzip2',
+    'application/x-xz', 'application/x-7z-compressed', 'application/x-rar-compressed',
+    'application/java-archive', 'application/vnd.openxmlformats-officedocument')
+# Content of these types is nearly always worth compressing
+compressible_types = ('text/', 'application/json', 'application/javascript',
+    'application/xml', 'application/x-sh', 'application/x-tex', 'application/sql',
+    'image/svg+xml', 'image/bmp', 'image/tiff', 'application/postscript')
+
+def choose_codec(codec, mime_type, sample):
+    """Returns 'codec' if content of 'mime_type', of which 'sample' is the
+    beginning, is worth compressing, otherwise None. Types known to compress
+    well are not checked any further."""
+    if not codec or len(sample) < codec_min_size:
+        return None
+    if mime_type.startswith(compressible_types):
+        return codec
+    if mime_type.startswith(incompressible_types):
+        return None
+    ratio = len(zlib.compress(sample, 1)) / len(sample)
+    return codec if ratio < codec_max_ratio else None
+
+def compress_block(codec, block):
+    """Compress 'block' on its own. Blocks compressed with 'gzip' are members
+    of a gzip file, and those with 'xz' are streams of an xz file, so that the
+    content as stored is a valid file of either format."""
+    if codec == 'gzip':
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return comp.compress(block) + comp.flush()
+    if codec == 'xz':
+        return lzma.compress(block, format=lzma.FORMAT_XZ, preset=6)
+    raise ValueError('Unknown codec %s' % codec)
+
+def decompress_block(codec, data):
+    if codec == 'gzip':
+        return zlib.decompress(data, 31)
+    if codec == 'xz':
+        return lzma.decompress(data, format=lzma.FORMAT_XZ)
+    raise ValueError('Unknown codec %s' % codec)
+
+def compress_stream(codec, src, dest):
+    """Compress content of readable 'src' into writable 'dest' from where they
+    are. Returns the compressed size of each block."""
+    ret_result = list()
+    while True:
+        block = src.read(codec_block_size)
+        if not block:
+            break
+        data = compress_block(codec, block)
+        dest.write(data)
+        ret_result.append(len(data))
+    return ret_result
+
+class CodecReader:
+    """File-like object reading the original content of 'raw', a readable
+    stream of content compressed in blocks, of which 'blocks' are the
+    compressed sizes. Only the block being read is held decompressed."""
+
+    def __init__(self, raw, codec, blocks, length):
+        self.raw = raw
+        self.codec = codec
+        self.offsets = array.array('q', [0])
+        for size in blocks:
+            self.offsets.append(self.offsets[-1] + size)
+        self.length = length
+        self.raw_length = self.offsets[-1]
+        self.pos = 0
+        self.cache_idx = -1
+        self.cache = b''
+        self.closed = False
+        return
+
+    def __block(self, idx):
+        if idx != self.cache_idx:
+            self.raw.seek(self.offsets[idx], 0)
+            self.cache = decompress_block(self.codec, self.raw.read(self.offsets[idx + 1] - self.offsets[idx]))
+            self.cache_idx = idx
+        return self.cache
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.length - self.pos
+        size = min(size, self.length - self.pos)
+        ret_result = list()
+        while size > 0:
+            idx = self.pos // codec_block_size
+            block = self.__block(idx)
+            begin = self.pos - idx * codec_block_size
+            part = block[begin:begin + size]
+            if not part:
+                break # Content is shorter than recorded
+            ret_result.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return b''.join(ret_result)
+
+    def readinto(self, buffer):
+        """Copy from decompressed blocks into 'buffer'."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        view = memoryview(buffer)
+        size = min(len(view), self.length - self.pos)
+        done = 0
+        while done < size:
+            idx = self.pos // codec_block_size
+            begin = self.pos - idx * codec_block_size
+            part = memoryview(self.__block(idx))[begin:begin + size - done]
+            if not part:
+                break # Content is shorter than recorded
+            view[done:done + len(part)] = part
+            self.pos += len(part)
+            done += len(part)
+        return done
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.pos = max(0, offset + [0, self.pos, self.length][whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.cache = b''
+        self.raw.close()
+        self.closed = True
+        return
+    pass
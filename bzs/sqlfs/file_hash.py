@@ -0,0 +1,147 @@
+
+import collections
+import concurrent.futures
+import hashlib
+import os
+import threading
+
+hash_chunk_size = 8192 # Chunk size of fs_st_sha256() in file_storage
+hash_block_size = 1024 * 1024 # Whole chunks hashed by one task
+hash_pending = 2 # Tasks in flight per thread, which bounds memory
+
+class HashPoolType:
+    """Threads shared by all TreeHashers. SHA256 of a chunk releases the GIL,
+    so digests of chunks are computed in parallel by threads. With less than
+    two threads, chunks are hashed by the caller instead."""
+
+    def __init__(self, threads=0):
+        self.threads = threads if threads > 0 else (os.cpu_count() or 1)
+        self.executor = None
+        self.lock = threading.Lock()
+        return
+
+    def configure(self, threads):
+        with self.lock:
+            if self.executor:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+            self.threads = threads if threads > 0 else (os.cpu_count() or 1)
+        return
+
+    def get_executor(self):
+        """Returns the executor, or None if hashing is not parallel."""
+        if self.threads < 2:
+            return None
+        with self.lock:
+            if not self.executor:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+            ret_result = self.executor
+        return ret_result
+    pass
+
+HashPool = HashPoolType()
+
+def chunk_digests(block):
+    """Hex digests of the chunks in 'block', concatenated. The length of
+    'block' must be a multiple of the chunk size."""
+    view = memoryview(block)
+    ret_result = b''.join(hashlib.sha256(view[i:i + hash_chunk_size]).hexdigest().encode('utf-8')
+        for i in range(0, len(view), hash_chunk_size))
+    view.release()
+    return ret_result
+
+class TreeHasher:
+    """Incremental form of fs_st_sha256(): content is cut into chunks of 8 KB,
+    the last one being shorter and possibly empty, and the digest is the
+    SHA256 of the concatenated hex digests of all chunks. The result does not
+    depend on how content is split between calls of update().
+
+    Whole chunks are gathered into blocks of 1 MB, and each block is hashed by
+    a thread of the HashPool while more content comes in. Digests of blocks
+    are collected in order, waiting for the oldest block once there are too
+    many in flight, so memory held is bounded."""
+
+    def __init__(self, pool=None):
+        self.executor = (pool or HashPool).get_executor()
+        self.max_pending = hash_pending * ((pool or HashPool).threads)
+        self.hash_concat = hashlib.sha256() # Of concatenated chunk digests
+        self.buffer = bytearray() # Whole chunks not yet hashed, and the incomplete chunk
+        self.pending = collections.deque() # Futures of blocks, in order
+        self.length = 0 # Bytes fed in so far
+        return
+
+    def __submit(self, block):
+        if not self.executor:
+            self.hash_concat.update(chunk_digests(block))
+            return
+        self.pending.append(self.executor.submit(chunk_digests, block))
+        while len(self.pending) > self.max_pending:
+            self.hash_concat.update(self.pending.popleft().result())
+        return
+
+    def __update_serial(self, data):
+        """Hash whole chunks right away, without copying them."""
+        view = memoryview(data)
+        off = 0
+        # Complete the pending chunk first
+        if self.buffer:
+            off = min(len(view), hash_chunk_size - len(self.buffer))
+            self.buffer += view[:off]
+            if len(self.buffer) < hash_chunk_size:
+                return
+            self.hash_concat.update(chunk_digests(self.buffer))
+            self.buffer = bytearray()
+        whole = off + (len(view) - off) // hash_chunk_size * hash_chunk_size
+        self.hash_concat.update(chunk_digests(view[off:whole]))
+        self.buffer += view[whole:]
+        view.release()
+        return
+
+    def update(self, data):
+        """Feed 'data' into the hash."""
+        self.length += len(data)
+        if not self.executor:
+            self.__update_serial(data)
+            return
+        self.buffer += data
+        while len(self.buffer) >= hash_block_size:
+            block = self.buffer[:hash_block_size]
+            del self.buffer[:hash_block_size]
+            self.__submit(block)
+        return
+
+    def hexdigest(self):
+        """Digest of the content fed in. The hasher could not be used
+        afterwards."""
+        while self.pending:
+            self.hash_concat.update(self.pending.popleft().result())
+        # Less than a block is left, which is not worth a task
+        whole = len(self.buffer) - len(self.buffer) % hash_chunk_size
+        self.hash_concat.update(chunk_digests(self.buffer[:whole]))
+        self.hash_concat.update(hashlib.sha256(self.buffer[whole:]).hexdigest().encode('utf-8'))
+        ret_result = self.hash_concat.hexdigest()
+        self.buffer = None
+        return ret_result
+    pass
+
+def hash_stream(stream, block_size=hash_block_size, buffer=None, pool=None):
+    """Hash content of a readable 'stream' from where it is, the same way as
+    fs_st_sha256(), reading 'block_size' bytes at a time. Streams that could
+    'readinto' are read into 'buffer', or a buffer allocated once, which
+    could be given again to hash more streams without allocating."""
+    hasher = TreeHasher(pool)
+    if not hasattr(stream, 'readinto'):
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            hasher.update(block)
+        return hasher.hexdigest()
+    view = memoryview(buffer if buffer is not None else bytearray(block_size))
+    while True:
+        size = stream.readinto(view)
+        if not size:
+            break
+        hasher.update(view[:size])
+    view.release()
+    return hasher.hexdigest()
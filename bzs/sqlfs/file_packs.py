@@ -0,0 +1,94 @@
+
+import heapq
+import threading
+
+class PackAllocator:
+    """Keeps track of the room left at the end of each pack segment, so that
+    a segment with room for a small file is chosen without querying the
+    database. Segments are kept in a heap by their size, so the one with the
+    most room is found in O(log n): if it could not hold a file, no other
+    segment could.
+
+    Other processes append to the same segments, so sizes here might be out
+    of date: a reservation only holds once confirmed by the database, and
+    the size is corrected with resync() otherwise.
+
+    Entries of the heap are not removed when a segment grows or is dropped,
+    but are skipped once found to be out of date. Segments are append-only,
+    so their size only grows, and full segments are forgotten."""
+
+    def __init__(self, limit=64 * 1024 * 1024):
+        self.limit = limit
+        self.sizes = dict() # oid -> size
+        self.heap = list() # (size, oid), possibly out of date
+        self.lock = threading.Lock()
+        return
+
+    def __push(self, oid, size):
+        self.sizes[oid] = size
+        heapq.heappush(self.heap, (size, oid))
+        return
+
+    def __compact(self):
+        """Rebuild the heap once most of its entries are out of date."""
+        if len(self.heap) > 2 * len(self.sizes) + 64:
+            self.heap = list((size, oid) for oid, size in self.sizes.items())
+            heapq.heapify(self.heap)
+        return
+
+    def add(self, oid, size=0):
+        """Track segment 'oid', which is 'size' bytes long."""
+        with self.lock:
+            if size < self.limit:
+                self.__push(oid, size)
+        return
+
+    def drop(self, oid):
+        """Stop appending to segment 'oid'."""
+        with self.lock:
+            self.sizes.pop(oid, None)
+            self.__compact()
+        return
+
+    def resync(self, oid, size=None):
+        """Correct the size of segment 'oid' to 'size', as found in the
+        database, or forget the segment if it is gone."""
+        with self.lock:
+            self.sizes.pop(oid, None)
+            if size is not None and size < self.limit:
+                self.__push(oid, size)
+            self.__compact()
+        return
+
+    def reserve(self, n_size, exclude=()):
+        """Reserve 'n_size' bytes at the end of the segment with the most room
+        other than those in 'exclude'. Returns the OID of the segment and the
+        offset, or None if no segment has enough room."""
+        ret_result = None
+        skipped = list()
+        with self.lock:
+            while self.heap:
+                size, oid = heapq.heappop(self.heap)
+                if self.sizes.get(oid, None) != size:
+                    continue # Out of date
+                if oid in exclude:
+                    skipped.append((size, oid))
+                    continue
+                if size + n_size <= self.limit:
+                    ret_result = (oid, size)
+                    size += n_size
+                if size < self.limit:
+                    self.__push(oid, size)
+                else:
+                    del self.sizes[oid]
+                break
+            for item in skipped:
+                heapq.heappush(self.heap, item)
+        return ret_result
+
+    def free_size(self):
+        """Total room left at the end of tracked segments."""
+        with self.lock:
+            ret_result = sum(self.limit - size for size in self.sizes.values())
+        return ret_result
+    pass
@@ -1,31 +1,59 @@
 
 import hashlib
+import hmac
 import io
 import threading
+import time
 import uuid as uuid_package
 
+from . import file_blobs
+from . import file_chunks
+from . import file_codec
+from . import file_hash
+from . import file_packs
 from . import file_stream
 
 def fs_st_sha256(stream):
     """This is not ordinary SHA256. It is based on a scheme where memory would
-    not be too much and buffer unavailable."""
-    hash_concat = ''
+    not be too much and buffer unavailable. Streams that were hashed while
+    being written are not read again, and chunks of those that are read back
+    are hashed in parallel, see file_hash.TreeHasher."""
     stream.close()
+    if stream.digest:
+        return stream.digest
     stream.reopen()
-    while True:
-        chunk = stream.read(8192)
-        hash_concat += hashlib.sha256(chunk).hexdigest()
-        if len(chunk) < 8192:
-            break
-    hash_final = hashlib.sha256(hash_concat.encode('utf-8', 'ignore')).hexdigest()
-    return hash_final
+    stream.digest = file_hash.hash_stream(stream)
+    stream.close() # Give back the connection held by large objects
+    return stream.digest
 
 class FileStorage:
     """This is a storage system built for bzs.sqlfs.file_system.Filesystem,
     which handles files for Filesystem, large files directly use LOBJECT, and
     small / sparsed files use BYTEA. This could handle a great amount of files
     through manipulation of the SQL database without the loss of a great many
-    rows. Sparse files should be disabled if server has no row limit."""
+    rows. Sparse files should be disabled if server has no row limit.
+
+    Small files are appended to pack segments, large objects of up to 64 MB
+    listed in 'file_storage_pack', and indexed in 'file_storage' by segment
+    and offset, so they are written and read at the cost of their own size.
+    Sparse rows of 'file_storage_sparse' are no longer written, but are still
+    read and removed from.
+
+    With the 'chunked' engine, large files are instead split into content-
+    defined chunks, each distinct chunk stored once in 'file_storage_chunk',
+    and the file is kept as a manifest of chunks in 'file_storage_manifest'.
+    With the 'blob' engine, files of all sizes are kept on local filesystem,
+    named by their hash, and the database only holds their metadata. Files
+    stored by any engine could be read regardless of the engine in use.
+
+    If a codec is given, content worth compressing is compressed before it is
+    stored, in blocks of 256 KB so that it could be read from any position.
+    The codec and compressed size of each block are kept in 'file_storage'.
+    Chunked files are not compressed.
+
+    Transactions on different subtrees of the filesystem run at the same
+    time, so reference counts are changed relative to the count in the
+    database, and new files are only deduplicated against once committed."""
 
     class UniqueFile:
         """This is a virtual file node on a virtual filesystem SQLFS. The
@@ -43,22 +71,26 @@ class FileStorage:
                            UUID in the sparsed file table.
             sparse_index - If file is in a sparsed row, then this indicated its
                            array subscript in the array of that row.
+            engine       - How a file is stored, None for a large object or a
+                           sparse row, 'chunked' for a manifest of chunks,
+                           'blob' for a file on local filesystem and 'pack'
+                           for a range of a pack segment.
+            codec        - How the content is compressed, None if it is not,
+                           'gzip' or 'xz'.
 
         Other data designed to maintain the content of the file includes:
 
             master   - The filesystem itself.
 
+        UniqueFiles use __slots__, as there is one for each distinct content.
+
         Do process with caution, and use exported methods only.
         """
 
-        uuid         = uuid_package.UUID('00000000-0000-0000-0000-000000000000')
-        size         = 0
-        count        = 0
-        hash         = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
-        sparse_uuid  = None
-        sparse_index = 0
+        __slots__ = ('master', 'uuid', 'size', 'count', 'hash', 'sparse_uuid',
+                     'sparse_index', 'engine', 'codec')
 
-        def __init__(self, uuid_=None, size=0, count=1, hash_=None, sparse_id=None, master=None):
+        def __init__(self, uuid_=None, size=0, count=1, hash_=None, sparse_id=None, engine=None, codec=None, master=None):
             self.master = master
             self.uuid = master.utils_pkg.get_new_uuid(uuid_, self.master.st_uuid_idx)
             self.master.st_uuid_idx[self.uuid] = self
@@ -73,12 +105,18 @@ class FileStorage:
             else:
                 self.sparse_uuid = None
                 self.sparse_index = 0
+            self.engine = engine
+            self.codec = codec
             # Will not contain content, would be indexed in SQL.
             return
         pass
 
-    def __init__(self, database=None, utils_package=None):
-        """Loads index of all stored UniqueFiles in database."""
+    def __init__(self, database=None, utils_package=None, engine='lobject', blob_path='', codec='', snapshot=None):
+        """Loads index of all stored UniqueFiles in database, or from
+        'snapshot' if given. New large files are stored with 'engine', either
+        'lobject', 'chunked' or 'blob', where blobs are kept under 'blob_path'.
+        New files are compressed with 'codec', either 'gzip' or 'xz', if
+        given."""
         if not database:
             raise AttributeError('Must provide a database')
         if not utils_package:
@@ -86,16 +124,34 @@ class FileStorage:
         self.st_uuid_idx         = dict()
         self.st_uuid_sparse_idx  = set()
         self.st_hash_idx         = dict()
+        self.st_quarantined      = set() # UUIDs of files with damaged content
         self.st_db               = database
         self.utils_pkg           = utils_package
         self.st_hash_algo        = fs_st_sha256 # Hashing algorithm, could be md5, sha1, sha224, sha256, sha384, sha512, while sha384 and sha512 are not recommended due to slow speeds on 32-bit computers
-        self.st_sparse_limit     = 16 * 1024 * 1024 # Create new sparse row if sparse row exceeded 16 MB
-        self.st_sparse_cnt_limit = 256 # No more than 256 files would appear in one sparse row
+        self.st_pack_limit       = 64 * 1024 * 1024 # Create new pack segment if none could hold a file within 64 MB
+        self.st_pack_attempts    = 3 # Segments tried before creating a new one, if others took their space first
+        self.st_packs            = file_packs.PackAllocator(limit=self.st_pack_limit) # Segments are not in snapshots
         self.st_sparse_size      = file_stream.sparse_size # Import from filestream manager
+        self.st_lock             = threading.RLock() # Guards indexes and counts in memory, never held waiting for rows of other transactions
+        self.st_pending          = dict() # Hash -> number of new files not yet committed
+        self.st_engine           = engine
+        self.st_chunks           = file_chunks.ChunkStore(database=database) # Chunks are not in snapshots
+        self.st_blobs            = file_blobs.BlobStore(path=blob_path) if blob_path else None
+        if engine == 'blob' and not self.st_blobs:
+            raise AttributeError('Must provide a blob path')
+        if codec and codec not in ('gzip', 'xz'):
+            raise AttributeError('Unknown codec %s' % codec)
+        self.st_codec            = codec
+        for item in self.st_db.execute("SELECT oid, size FROM file_storage_pack;"):
+            self.st_packs.add(item[0], item[1])
+        if snapshot:
+            self.__load_snapshot(snapshot)
+            self.__load_quarantine()
+            return
         # These are large files we are talking about.
-        for item in self.st_db.execute("SELECT uuid, size, count, hash FROM file_storage;"):
-            s_uuid, s_size, s_count, s_hash = item
-            s_fl = self.UniqueFile(s_uuid, s_size, s_count, s_hash, master=self)
+        for item in self.st_db.execute("SELECT uuid, size, count, hash, engine, codec FROM file_storage;"):
+            s_uuid, s_size, s_count, s_hash, s_engine, s_codec = item
+            s_fl = self.UniqueFile(s_uuid, s_size, s_count, s_hash, engine=s_engine, codec=s_codec, master=self)
             # Inject into indexer
             self.st_uuid_idx[s_uuid] = s_fl
             self.st_hash_idx[s_hash] = s_fl
@@ -114,217 +170,597 @@ class FileStorage:
             # Means there is a sparse file called this
             self.st_uuid_sparse_idx.add(s_uuid)
             continue
+        self.__load_quarantine()
         # Content would be ignored and later retrieved from SQL database.
         return
 
+    def __load_quarantine(self):
+        """Quarantined files are not deduplicated against."""
+        for item in self.st_db.execute("SELECT uuid FROM file_storage_quarantine;") or list():
+            if item[0] in self.st_uuid_idx:
+                self.__unindex_hash(self.st_uuid_idx[item[0]])
+                self.st_quarantined.add(item[0])
+        return
+
+    def __release_quarantine(self, s_fl):
+        """Forget that a removed file was quarantined."""
+        if s_fl.uuid in self.st_quarantined:
+            self.st_quarantined.discard(s_fl.uuid)
+            self.st_db.execute("DELETE FROM file_storage_quarantine WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+        return
+
+    def __quarantine(self, uuid_, reason):
+        """Stop deduplicating against file of 'uuid_', as its content is found
+        to be damaged, so that new uploads of the same content are stored
+        again. The damaged content is left as it is."""
+        s_fl = self.st_uuid_idx.get(uuid_, None)
+        if not s_fl or uuid_ in self.st_quarantined:
+            return False
+        self.__journal(s_fl)
+        self.__unindex_hash(s_fl)
+        self.st_quarantined.add(uuid_)
+        self.st_db.execute("""
+            INSERT INTO file_storage_quarantine (uuid, hash, reason, time)
+                VALUES (%s, %s, %s, %s) ON CONFLICT (uuid) DO NOTHING;""",
+            (uuid_, s_fl.hash, reason, time.time()), fetch_func=None)
+        return True
+
+    def __unindex_hash(self, s_fl):
+        """Remove 's_fl' from the hash index, unless another file with the same
+        content took its place."""
+        if self.st_hash_idx.get(s_fl.hash, None) is s_fl:
+            del self.st_hash_idx[s_fl.hash]
+        return
+
+    def __journal(self, s_fl, new=False):
+        """Restore 's_fl' as it is now, along with whether it is indexed and
+        quarantined, if the transaction is rolled back, so that memory agrees
+        with the database again. Must be called before 's_fl' is changed or
+        removed, or right after a 'new' file is created. Reference counts are
+        restored by __add_count() instead."""
+        state = (s_fl.sparse_uuid, s_fl.sparse_index, s_fl.engine, s_fl.codec)
+        indexed = not new and self.st_uuid_idx.get(s_fl.uuid, None) is s_fl
+        hashed = not new and self.st_hash_idx.get(s_fl.hash, None) is s_fl
+        quarantined = not new and s_fl.uuid in self.st_quarantined
+        def _restore():
+            with self.st_lock:
+                s_fl.sparse_uuid, s_fl.sparse_index, s_fl.engine, s_fl.codec = state
+                if indexed:
+                    self.st_uuid_idx[s_fl.uuid] = s_fl
+                elif self.st_uuid_idx.get(s_fl.uuid, None) is s_fl:
+                    del self.st_uuid_idx[s_fl.uuid]
+                if hashed:
+                    self.st_hash_idx[s_fl.hash] = s_fl
+                else:
+                    self.__unindex_hash(s_fl)
+                if quarantined:
+                    self.st_quarantined.add(s_fl.uuid)
+                else:
+                    self.st_quarantined.discard(s_fl.uuid)
+            return
+        self.st_db.on_rollback(_restore)
+        return
+
+    def __add_count(self, s_fl, delta):
+        """Add 'delta' to the reference count of 's_fl', relative to the count
+        in the database, as other transactions might change it meanwhile."""
+        s_fl.count += delta
+        def _restore():
+            with self.st_lock:
+                s_fl.count -= delta
+            return
+        self.st_db.on_rollback(_restore)
+        if s_fl.sparse_uuid:
+            self.st_db.execute("UPDATE file_storage_sparse SET sub_count[%s] = sub_count[%s] + %s WHERE uuid = %s;", (s_fl.sparse_index, s_fl.sparse_index, delta, s_fl.sparse_uuid), fetch_func=None)
+        else:
+            self.st_db.execute("UPDATE file_storage SET count = count + %s WHERE uuid = %s;", (delta, s_fl.uuid), fetch_func=None)
+        return
+
+    def __add_by_hash(self, n_hash):
+        """Adds an occurence to the file with content of 'n_hash', and returns
+        its UUID, or None if there is no such file."""
+        old_fl = self.st_hash_idx.get(n_hash, None)
+        if not old_fl:
+            return None
+        self.__add_count(old_fl, 1)
+        return old_fl.uuid
+
+    def __created(self, u_fl, encoded=None):
+        """Journal a new file right after its row is inserted, along with the
+        codec and sizes of compressed blocks in 'encoded'. Other transactions
+        only deduplicate against it once committed, as they could not update
+        its row before."""
+        self.__journal(u_fl, new=True)
+        if encoded:
+            u_fl.codec = encoded[0]
+            self.st_db.execute("UPDATE file_storage SET codec = %s, codec_blocks = %s, stored_size = %s WHERE uuid = %s;", (encoded[0], encoded[1], sum(encoded[1]), u_fl.uuid), fetch_func=None)
+        self.__unindex_hash(u_fl)
+        self.st_pending[u_fl.hash] = self.st_pending.get(u_fl.hash, 0) + 1
+        def _settle(committed):
+            with self.st_lock:
+                left = self.st_pending.pop(u_fl.hash, 1) - 1
+                if left > 0:
+                    self.st_pending[u_fl.hash] = left
+                if committed and self.st_uuid_idx.get(u_fl.uuid, None) is u_fl and u_fl.uuid not in self.st_quarantined:
+                    self.st_hash_idx.setdefault(u_fl.hash, u_fl)
+            return
+        self.st_db.on_commit(lambda: _settle(True))
+        self.st_db.on_rollback(lambda: _settle(False))
+        return
+
+    def __forget_sparse_row(self, sp_uuid):
+        """Forget a sparse row removed from the database."""
+        self.st_uuid_sparse_idx.remove(sp_uuid)
+        self.st_db.on_rollback(lambda: self.st_uuid_sparse_idx.add(sp_uuid))
+        return
+
+    def __drop_pack(self, p_oid):
+        """Forget a pack segment removed from the database."""
+        p_size = self.st_packs.sizes.get(p_oid, None)
+        self.st_packs.drop(p_oid)
+        if p_size is not None:
+            self.st_db.on_rollback(lambda: self.st_packs.add(p_oid, p_size))
+        return
+
+    def __load_snapshot(self, snap):
+        """Loads index of all stored UniqueFiles from a decoded snapshot."""
+        for s_uuid in snap.st_sparse_uuids:
+            self.st_uuid_sparse_idx.add(s_uuid)
+        for idx in range(0, len(snap.st_uuids)):
+            sparse_id = None
+            if snap.st_sparse[idx] >= 0:
+                sparse_id = (snap.st_sparse_uuids[snap.st_sparse[idx]], snap.st_subidx[idx])
+            engine = snap.strings[snap.st_engines[idx]] if snap.st_engines[idx] >= 0 else None
+            codec = snap.strings[snap.st_codecs[idx]] if snap.st_codecs[idx] >= 0 else None
+            self.UniqueFile(snap.st_uuids[idx], snap.st_sizes[idx], snap.st_counts[idx], snap.strings[snap.st_hashes[idx]], sparse_id=sparse_id, engine=engine, codec=codec, master=self)
+        return
+
     def __add_unique_file(self, uuid):
         if uuid not in self.st_uuid_idx:
             return False
-        fl = self.st_uuid_idx[uuid]
-        fl.count += 1
-        if fl.sparse_uuid:
-            self.st_db.execute("""
-                UPDATE file_storage_sparse SET sub_count[%s] = %s WHERE uuid = %s""",
-                (fl.sparse_index, fl.count, fl.sparse_uuid
-            ))
-        else:
-            self.st_db.execute("""
-                UPDATE file_storage SET count = %s WHERE uuid = %s""",
-                (fl.count, fl.uuid
-            ))
+        self.__add_count(self.st_uuid_idx[uuid], 1)
         return True
 
-    def __new_unique_file_sparse(self, n_uuid, n_size, n_count, n_hash, content_stream):
+    def __pack_reserve(self, n_size, exclude=()):
+        """Reserve 'n_size' bytes at the end of the pack segment with the most
+        room, other than those in 'exclude', creating a new segment if none
+        has enough room. Returns the OID of the segment and the offset."""
+        for i in range(0, self.st_pack_attempts):
+            selection = self.st_packs.reserve(n_size, exclude)
+            if not selection:
+                break
+            # Processes reserve in the same segments, the database decides
+            # who gets the space, waiting for others appending to it
+            p_oid, p_offset = selection
+            if self.st_db.execute("UPDATE file_storage_pack SET size = size + %s, used = used + %s WHERE oid = %s AND size = %s RETURNING size;", (n_size, n_size, p_oid, p_offset), fetch_func='one'):
+                # Size is restored along with the row if rolled back
+                self.st_db.on_rollback(lambda: self.st_packs.resync(p_oid, p_offset))
+                return selection
+            row = self.st_db.execute("SELECT size FROM file_storage_pack WHERE oid = %s;", (p_oid,), fetch_func='one')
+            self.st_packs.resync(p_oid, row[0] if row else None)
+        p_oid = self.st_db.execute("""
+            INSERT INTO file_storage_pack (oid, size, used)
+                VALUES (lo_create(0), %s, %s) RETURNING oid;""",
+            (n_size, n_size), fetch_func='one')[0]
+        self.st_packs.add(p_oid, n_size)
+        self.st_db.on_rollback(lambda: self.st_packs.drop(p_oid))
+        return (p_oid, 0)
+
+    def __new_unique_file_packed(self, n_uuid, n_size, n_count, n_hash, content_stream, encoded=None):
         """Creates a UniqueFile that is a sparsed file, which should be
-        determined by upstream functions that it is indeed a sparsed file. Then
-        we index this file in not large objects but direct raw strings. Returns
-        the new file's UUID."""
+        determined by upstream functions that it is indeed a sparsed file. The
+        content is appended to a pack segment, a large object shared by many
+        small files, and the file is indexed by its offset in the segment, so
+        storing a file costs no more than its own size. Returns the new file's
+        UUID."""
+        content = content_stream.get_content() # Compressed if the file is
         # Checking hash of the file.
+        with self.st_lock:
+            old_uuid = self.__add_by_hash(n_hash)
+        if old_uuid:
+            return old_uuid
+        # Reserved without holding the lock, as it might wait for others
+        # appending to the same segment
+        p_oid, p_offset = self.__pack_reserve(len(content))
+        with self.st_lock:
+            old_uuid = self.__add_by_hash(n_hash)
+            if old_uuid:
+                # Committed by another transaction meanwhile, leaving a hole
+                self.st_db.execute("UPDATE file_storage_pack SET used = used - %s WHERE oid = %s;", (len(content), p_oid), fetch_func=None)
+                return old_uuid
+            u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, engine='pack', master=self)
+            if len(content) > 0:
+                self.st_db.execute("SELECT lo_put(%s, %s, %s);", (p_oid, p_offset, content), fetch_func=None)
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content, engine, pack_offset) VALUES (%s, %s, %s, %s, %s, 'pack', %s)", (n_uuid, n_size, n_count, n_hash, p_oid, p_offset), fetch_func=None)
+            self.__created(u_fl, encoded)
+        return n_uuid
+
+    def __detach_packed(self, s_fl):
+        """Release the space of a packed file in its segment, removing the
+        segment if no other files are left there. Space in segments still in
+        use is only reclaimed by compaction. Must be called before the index
+        row of the file is changed."""
+        self.st_db.execute("""
+            UPDATE file_storage_pack AS p SET used = p.used - COALESCE(f.stored_size, f.size)
+                FROM file_storage AS f WHERE f.uuid = %s AND p.oid = f.content;""",
+            (s_fl.uuid,), fetch_func=None)
+        dropped = self.st_db.execute("""
+            WITH seg AS (
+                DELETE FROM file_storage_pack WHERE used <= 0
+                    AND oid = (SELECT content FROM file_storage WHERE uuid = %s)
+                    RETURNING oid)
+            SELECT oid, lo_unlink(oid) FROM seg;""",
+            (s_fl.uuid,), fetch_func='one')
+        if dropped:
+            self.__drop_pack(dropped[0])
+        return True
+
+    def __new_unique_file_chunked(self, n_uuid, n_size, n_count, n_hash, content_stream, encoded=None):
+        """Creates a UniqueFile from a chunked stream, whose chunks are already
+        stored and pinned. The manifest takes references to the chunks, and
+        returns the new file's UUID."""
+        digests, sizes = content_stream.get_content()
+        with self.st_lock:
+            # Checking hash of the file.
+            old_uuid = self.__add_by_hash(n_hash)
+            if old_uuid:
+                self.st_chunks.unpin(digests)
+                return old_uuid
+            u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, engine='chunked', master=self)
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content, engine) VALUES (%s, %s, %s, %s, NULL, 'chunked')", (n_uuid, n_size, n_count, n_hash), fetch_func=None)
+            self.st_db.execute("INSERT INTO file_storage_manifest (uuid, chunk_hash, chunk_size) VALUES (%s, %s, %s)", (n_uuid, digests, sizes), fetch_func=None)
+            self.__created(u_fl, encoded)
+            self.st_chunks.acquire(digests)
+            self.st_chunks.unpin(digests)
+        return n_uuid
+
+    def __new_unique_file_blob(self, n_uuid, n_size, n_count, n_hash, content_stream, encoded=None):
+        """Creates a UniqueFile from a stream written to local filesystem, which
+        is moved into place under its hash. Returns the new file's UUID."""
+        tmp_path = content_stream.get_content()
+        with self.st_lock:
+            # Checking hash of the file.
+            old_uuid = self.__add_by_hash(n_hash)
+            if old_uuid:
+                self.st_blobs.discard(tmp_path)
+                return old_uuid
+            # A blob left by a rolled back transaction would just be replaced
+            self.st_blobs.commit(tmp_path, n_hash)
+            u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, engine='blob', master=self)
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content, engine) VALUES (%s, %s, %s, %s, NULL, 'blob')", (n_uuid, n_size, n_count, n_hash), fetch_func=None)
+            self.__created(u_fl, encoded)
+        return n_uuid
+
+    def __remove_blob(self, hash_):
+        """Remove blob of 'hash_' once the removal is committed, unless the
+        same content had been stored again meanwhile, committed or not."""
+        def _remove():
+            with self.st_lock:
+                if hash_ in self.st_hash_idx or self.st_pending.get(hash_, 0):
+                    return
+                if not self.st_db.execute("SELECT uuid FROM file_storage WHERE engine = 'blob' AND hash = %s LIMIT 1;", (hash_,), fetch_func='one'):
+                    self.st_blobs.remove(hash_)
+            return
+        self.st_db.on_commit(_remove)
+        return
+
+    def __discard_stream(self, stream):
+        """Drop content of a closed stream that would not be stored."""
+        if stream.is_chunked:
+            self.st_chunks.unpin(stream.get_content()[0])
+        elif stream.is_blob:
+            self.st_blobs.discard(stream.get_content())
+        elif not stream.is_sparse:
+            self.st_db.execute("SELECT lo_unlink(%s);", (stream.get_content(),), fetch_func=None)
+        return
+
+    def __encode(self, content_stream, file_name):
+        """Compress content of a closed stream into a new stream if it is worth
+        compressing, which is kept in 'encoded' of the stream along with the
+        codec and sizes of compressed blocks. Done before taking locks, as it
+        might take long."""
+        content_stream.encoded = None
+        if not self.st_codec or content_stream.is_chunked:
+            return False
+        if self.st_hash_algo(content_stream) in self.st_hash_idx:
+            return False # Would not be stored anyway
+        mime_type = self.utils_pkg.guess_mime_type(file_name or '')
+        if content_stream.is_sparse:
+            content = content_stream.get_content()
+            codec = file_codec.choose_codec(self.st_codec, mime_type, content[:file_codec.codec_sample_size])
+            if not codec:
+                return False
+            blocks = list(file_codec.compress_block(codec, content[i:i + file_codec.codec_block_size])
+                for i in range(0, len(content), file_codec.codec_block_size))
+            dest = file_stream.FileStream(mode='write', obj_data=b''.join(blocks), database=self.st_db)
+            dest.close()
+            content_stream.encoded = (codec, dest, list(len(block) for block in blocks))
+            return True
+        content_stream.reopen()
         try:
-            if n_hash in self.st_hash_idx:
-                old_fl = self.st_hash_idx[n_hash]
-                old_fl.count += 1
-                self.st_db.execute("UPDATE file_storage_sparse SET sub_count[%s] = %s WHERE uuid = %s;", (old_fl.sparse_index, old_fl.count, old_fl.sparse_uuid))
-                return old_fl.uuid
-        except:
-            pass
-        # Hash not found or invalid.
-        selection = self.st_db.execute("SELECT uuid, size, count FROM file_storage_sparse WHERE size < %s AND count < %s;", (self.st_sparse_limit, self.st_sparse_cnt_limit))
-        f_uuid = None
-        try:
-            f_uuid, f_size, f_count = selection[0]
-        except Exception: pass
-        # In the case of having such an item that satisfies the limits, we insert.
-        if f_uuid:
-            # Attempt to discover unused chunk spaces in this sparse row
+            codec = file_codec.choose_codec(self.st_codec, mime_type, content_stream.read(file_codec.codec_sample_size))
+            if not codec:
+                return False
+            content_stream.seek(0, 0)
+            dest = file_stream.FileStream(mode='write', blob_store=self.st_blobs if content_stream.is_blob else None, database=self.st_db)
             try:
-                unused_arr = self.st_db.execute("SELECT unused FROM file_storage_sparse WHERE uuid = %s;", (f_uuid,))[0][0] # At non-discovery (which is impossible) this would raise...
-                unused_id = unused_arr[0] # At empty unused this would raise...
-                # Create file in tree structure
-                u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, sparse_id=(f_uuid, unused_id), master=self)
-                self.st_db.execute("""
-                    UPDATE file_storage_sparse SET
-                            size = %s, count = %s,
-                            sub_uuid[%s] = %s,
-                            sub_size[%s] = %s,
-                            sub_count[%s] = %s,
-                            sub_hash[%s] = %s,
-                            sub_content[%s] = %s,
-                            unused = unused[2 : %s]
-                        WHERE uuid = %s;""", (
-                    f_size + n_size, f_count + 1,
-                    unused_id, n_uuid,
-                    unused_id, n_size,
-                    unused_id, n_count,
-                    unused_id, n_hash,
-                    unused_id, content_stream.get_content(),
-                    len(unused_arr), f_uuid
-                ))
-                pass
-            except:
-                # Create file in tree structure
-                u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, sparse_id=(f_uuid, f_count + 1), master=self)
-                # Indexing file in SQL database
-                self.st_db.execute("""
-                    UPDATE file_storage_sparse SET
-                            size = %s, count = %s,
-                            sub_uuid = array_cat(sub_uuid, %s),
-                            sub_size = array_cat(sub_size, %s::BIGINT[]),
-                            sub_count = array_cat(sub_count, %s::BIGINT[]),
-                            sub_hash = array_cat(sub_hash, %s),
-                            sub_content = array_cat(sub_content, %s)
-                        WHERE uuid = %s;""", (
-                    f_size + n_size, f_count + 1,
-                    [n_uuid], [n_size], [n_count], [n_hash], [content_stream.get_content()],
-                    f_uuid
-                ))
-                pass
-            pass
-        # In the case we need to create a new sparse row.
-        else:
-            f_uuid = self.utils_pkg.get_new_uuid(None, self.st_uuid_sparse_idx)
-            self.st_uuid_sparse_idx.add(f_uuid)
-            # Creating file in tree structure
-            u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, sparse_id=(f_uuid, 1), master=self)
-            # Creating new sparse row with content of this file in SQL database
-            self.st_db.execute("""
-                INSERT INTO file_storage_sparse
-                        (uuid, size, count, sub_uuid, sub_size, sub_count, sub_hash, sub_content)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);""", (
-                f_uuid, n_size, 1,
-                [n_uuid], [n_size], [n_count], [n_hash], [content_stream.get_content()]
-            ))
-            pass
-        # Inserting file handle into tree
-        self.st_uuid_idx[n_uuid] = u_fl
-        self.st_hash_idx[n_hash] = u_fl
-        return n_uuid
+                blocks = file_codec.compress_stream(codec, content_stream, dest)
+            except Exception:
+                dest.destroy()
+                raise
+            dest.close()
+        finally:
+            content_stream.close()
+        content_stream.encoded = (codec, dest, blocks)
+        return True
 
     def __new_unique_file(self, content_stream):
-        """Creates a UniqueFile, and returns its UUID."""
+        """Creates a UniqueFile, and returns its UUID. If the content had been
+        compressed, the compressed content is stored instead."""
+        n_hash = self.st_hash_algo(content_stream)
+        encoded = content_stream.encoded
+        if not encoded:
+            ret_result = self.__new_unique_file_raw(content_stream, n_hash)
+            return ret_result
+        codec, enc_stream, blocks = encoded
+        content_stream.encoded = None
+        if n_hash in self.st_hash_idx:
+            self.__discard_stream(enc_stream)
+            ret_result = self.__new_unique_file_raw(content_stream, n_hash)
+            return ret_result
+        self.__discard_stream(content_stream)
+        enc_stream.length = content_stream.length # Size of the original content
+        ret_result = self.__new_unique_file_raw(enc_stream, n_hash, (codec, blocks))
+        return ret_result
+
+    def __new_unique_file_raw(self, content_stream, n_hash, encoded=None):
+        """Stores content of the stream as it is, and returns its UUID. If the
+        content is compressed, its codec and sizes of compressed blocks are in
+        'encoded'."""
         n_uuid = self.utils_pkg.get_new_uuid(None, self.st_uuid_idx)
         n_size = content_stream.length
         n_count = 1
-        n_hash = self.st_hash_algo(content_stream)
-        # If the size is too small, we sparse it
+        # If the size is too small, we pack it
         if content_stream.is_sparse:
-            return self.__new_unique_file_sparse(n_uuid, n_size, n_count, n_hash, content_stream)
-        # Checking hash of the file.
-        if n_hash in self.st_hash_idx:
-            old_fl = self.st_hash_idx[n_hash]
-            old_fl.count += 1
-            self.st_db.execute("UPDATE file_storage SET count = %s WHERE uuid = %s;", (old_fl.count, old_fl.uuid))
-            # We shall ignore the (1/2)**64 possibility of collisions...
-            return old_fl.uuid
-        # This is indeed a unique file that is large enough
-        u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, master=self)
-        # Done indexing, now proceeding to process content into SQL (RAW)
-        self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content) VALUES (%s, %s, %s, %s, %s)", (n_uuid, n_size, n_count, n_hash, content_stream.get_content()))
-        # Injecting file into main indexer
-        self.st_uuid_idx[n_uuid] = u_fl
-        self.st_hash_idx[n_hash] = u_fl
+            return self.__new_unique_file_packed(n_uuid, n_size, n_count, n_hash, content_stream, encoded)
+        if content_stream.is_chunked:
+            return self.__new_unique_file_chunked(n_uuid, n_size, n_count, n_hash, content_stream, encoded)
+        if content_stream.is_blob:
+            return self.__new_unique_file_blob(n_uuid, n_size, n_count, n_hash, content_stream, encoded)
+        with self.st_lock:
+            # Checking hash of the file.
+            old_uuid = self.__add_by_hash(n_hash)
+            if old_uuid:
+                # The uploaded copy is no longer needed
+                self.st_db.execute("SELECT lo_unlink(%s);", (content_stream.get_content(),), fetch_func=None)
+                # We shall ignore the (1/2)**64 possibility of collisions...
+                return old_uuid
+            # This is indeed a unique file that is large enough
+            u_fl = self.UniqueFile(n_uuid, n_size, n_count, n_hash, master=self)
+            # Done indexing, now proceeding to process content into SQL (RAW)
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content) VALUES (%s, %s, %s, %s, %s)", (n_uuid, n_size, n_count, n_hash, content_stream.get_content()), fetch_func=None)
+            self.__created(u_fl, encoded)
         return n_uuid
 
-    def __remove_unique_file_sparse(self, s_fl):
-        """Removes a unique file, and if its appearances drop below 1 ( <= 0 ),
-        remove the actual coincidence of this file and its content. Moreover,
-        if the sparse row containing it has its count drop below 1 ( <= 0 )
-        after deleting this file, we remove it as well."""
-        # Decrement the count of the file by 1
-        s_fl.count -= 1
-        # Update the decrement in SQL database
-        self.st_db.execute("UPDATE file_storage_sparse SET sub_count[%s] = %s WHERE uuid = %s;", (s_fl.sparse_index, s_fl.count, s_fl.sparse_uuid))
-        # Check if this file needs to be deleted or not
-        if s_fl.count >= 1:
-            return True
-        # Removing from filesystem
-        del self.st_uuid_idx[s_fl.uuid]
-        del self.st_hash_idx[s_fl.hash]
-        # Retrieve details of this sparse row
+    def __find_unique_file(self, hash_, size):
+        """Finds the UniqueFile with the given hash and size, and returns its
+        UUID, or None if there is no such file."""
+        s_fl = self.st_hash_idx.get(hash_, None)
+        if not s_fl or s_fl.size != size:
+            return None
+        return s_fl.uuid
+
+    def __detach_sparse(self, s_fl):
+        """Free the slot of a sparse file in its sparse row, removing the row
+        if no other files are left there."""
         if s_fl.sparse_uuid not in self.st_uuid_sparse_idx:
             return False
-        try:
-            sp_uuid, sp_size, sp_count = self.st_db.execute("SELECT uuid, size, count FROM file_storage_sparse WHERE uuid = %s;", (s_fl.sparse_uuid,))[0]
-            sp_size -= s_fl.size
-            sp_count -= 1
-        except: # There's really nothing I can do.
-            return False
         # Remove this file from the sparse row
-        self.st_db.execute("""
+        res = self.st_db.execute("""
             UPDATE file_storage_sparse SET
-                    size = %s, count = %s,
+                    size = size - %s, count = count - 1,
                     sub_uuid[%s] = '00000000-0000-0000-0000-000000000000',
                     sub_size[%s] = 0,
                     sub_count[%s] = 0,
                     sub_hash[%s] = 'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855',
                     sub_content[%s] = E'\\x',
                     unused = array_cat(unused, %s::BIGINT[])
-                WHERE uuid = %s;""", (sp_size, sp_count) +
-            (s_fl.sparse_index,) * 5 + ([s_fl.sparse_index], s_fl.sparse_uuid)
-        )
+                WHERE uuid = %s RETURNING count;""", (s_fl.size,) +
+            (s_fl.sparse_index,) * 5 + ([s_fl.sparse_index], s_fl.sparse_uuid),
+            fetch_func='one')
         # Now checking if we need to remove this row as well
-        if sp_count >= 1:
+        if not res or res[0] >= 1:
             return True
         # Really, we need to delete it.
-        self.st_db.execute("DELETE FROM file_storage_sparse WHERE uuid = %s;", (sp_uuid,))
-        self.st_uuid_sparse_idx.remove(sp_uuid)
+        self.st_db.execute("DELETE FROM file_storage_sparse WHERE uuid = %s;", (s_fl.sparse_uuid,), fetch_func=None)
+        with self.st_lock:
+            self.__forget_sparse_row(s_fl.sparse_uuid)
         # Done removing sparse file
         return True
 
     def __remove_unique_file(self, uuid_):
         """Removes a unique file, and if its appearances drop below 1 ( <= 0 ),
         remove the actual coincidence of this file and its content."""
-        if uuid_ not in self.st_uuid_idx:
-            return True
-        s_fl = self.st_uuid_idx[uuid_]
-        # If it's a sparse file, we call that function to delete it
+        with self.st_lock:
+            s_fl = self.st_uuid_idx.get(uuid_, None)
+            if not s_fl:
+                return True
+            self.__add_count(s_fl, -1)
+            # Checking coincidence
+            if s_fl.count >= 1:
+                return True
+            # Removing from filesystem
+            self.__journal(s_fl)
+            del self.st_uuid_idx[s_fl.uuid]
+            self.__unindex_hash(s_fl)
+            self.__release_quarantine(s_fl)
+        # No longer found by other transactions, content is dropped without
+        # holding the lock as it might wait for their rows
+        return self.__drop_content(s_fl)
+
+    def __drop_content(self, s_fl):
+        """Drop content and index row of a file removed from indexes."""
+        # If it's a sparse file, only its slot in the sparse row is freed
         if s_fl.sparse_uuid:
-            return self.__remove_unique_file_sparse(s_fl)
-        # Now we are deleting a file large enough to fit in.
-        s_fl.count -= 1
-        self.st_db.execute("UPDATE file_storage SET count = %s WHERE uuid = %s;", (s_fl.count, s_fl.uuid))
-        # Checking coincidence
-        if s_fl.count >= 1:
+            return self.__detach_sparse(s_fl)
+        if s_fl.engine == 'chunked':
+            digests = self.__get_manifest(s_fl)[0]
+            self.st_chunks.release(digests)
+            self.st_db.execute("DELETE FROM file_storage_manifest WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+            self.st_db.execute("DELETE FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+            return True
+        if s_fl.engine == 'blob':
+            self.st_db.execute("DELETE FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+            self.__remove_blob(s_fl.hash)
+            return True
+        if s_fl.engine == 'pack':
+            self.__detach_packed(s_fl)
+            self.st_db.execute("DELETE FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
             return True
-        # Removing from filesystem
-        del self.st_uuid_idx[s_fl.uuid]
-        del self.st_hash_idx[s_fl.hash]
         # Removing from SQLDB
-        s_arr = self.st_db.execute("SELECT content FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func='one')
+        self.st_db.execute("SELECT lo_unlink(content) FROM file_storage WHERE uuid = %s AND content IS NOT NULL;", (s_fl.uuid,), fetch_func=None)
+        self.st_db.execute("DELETE FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+        return True
+
+    def __migrate_to_blob(self, uuid_):
+        """Copy content of a file stored by another engine to local filesystem,
+        verifying its hash, then drop the original content."""
+        s_fl = self.st_uuid_idx.get(uuid_, None)
+        if not s_fl or s_fl.engine == 'blob':
+            return False
+        dest = file_stream.FileStream(mode='write', blob_store=self.st_blobs, database=self.st_db)
         try:
-            s_oid = s_arr[0]
-        except:
-            pass
-        self.st_db.execute("SELECT lo_unlink(%s);", (s_oid,))
-        self.st_db.execute("DELETE FROM file_storage WHERE uuid = %s;", (s_fl.uuid,))
+            src = self.__get_content(uuid_)
+            while True:
+                block = src.read(1024 * 1024)
+                if not block:
+                    break
+                dest.write(block)
+            src.close()
+        except Exception:
+            dest.destroy()
+            return False
+        dest.close()
+        if dest.digest != s_fl.hash:
+            self.st_blobs.discard(dest.get_content())
+            return False
+        self.st_blobs.commit(dest.get_content(), s_fl.hash)
+        self.__journal(s_fl)
+        # Dropping original content
+        if s_fl.sparse_uuid:
+            self.__detach_sparse(s_fl)
+            s_fl.sparse_uuid = None
+            s_fl.sparse_index = 0
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content, engine) VALUES (%s, %s, %s, %s, NULL, 'blob')", (s_fl.uuid, s_fl.size, s_fl.count, s_fl.hash), fetch_func=None)
+        elif s_fl.engine == 'chunked':
+            self.st_chunks.release(self.__get_manifest(s_fl)[0])
+            self.st_db.execute("DELETE FROM file_storage_manifest WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+            self.st_db.execute("UPDATE file_storage SET engine = 'blob' WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+        elif s_fl.engine == 'pack':
+            self.__detach_packed(s_fl)
+            self.st_db.execute("UPDATE file_storage SET content = NULL, engine = 'blob', pack_offset = NULL WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+        else:
+            s_arr = self.st_db.execute("SELECT content FROM file_storage WHERE uuid = %s;", (s_fl.uuid,), fetch_func='one')
+            if s_arr and s_arr[0]:
+                self.st_db.execute("SELECT lo_unlink(%s);", (s_arr[0],), fetch_func=None)
+            self.st_db.execute("UPDATE file_storage SET content = NULL, engine = 'blob' WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+        s_fl.engine = 'blob'
+        if s_fl.codec:
+            # Content had been copied decompressed
+            self.st_db.execute("UPDATE file_storage SET codec = NULL, codec_blocks = NULL, stored_size = NULL WHERE uuid = %s;", (s_fl.uuid,), fetch_func=None)
+            s_fl.codec = None
         return True
 
+    def __repack_sparse(self, sp_uuid):
+        """Move files left in a sparse row to pack segments, and drop the row
+        along with the holes left by removed files. Returns the bytes copied
+        and the bytes reclaimed."""
+        if sp_uuid not in self.st_uuid_sparse_idx:
+            return (0, 0)
+        row = self.st_db.execute("SELECT sub_uuid, sub_content, pg_column_size(file_storage_sparse.*) FROM file_storage_sparse WHERE uuid = %s;", (sp_uuid,), fetch_func='one')
+        if not row:
+            return (0, 0)
+        sub_uuid, sub_content, sp_size = row
+        moved = 0
+        for idx in range(0, min(len(sub_uuid), len(sub_content))):
+            s_fl = self.st_uuid_idx.get(sub_uuid[idx], None)
+            if not s_fl or s_fl.sparse_uuid != sp_uuid or s_fl.sparse_index != idx + 1:
+                continue # A hole
+            self.__journal(s_fl)
+            p_oid, p_offset = self.__pack_reserve(s_fl.size)
+            if s_fl.size > 0:
+                self.st_db.execute("SELECT lo_put(%s, %s, %s);", (p_oid, p_offset, sub_content[idx]), fetch_func=None)
+            self.st_db.execute("INSERT INTO file_storage (uuid, size, count, hash, content, engine, pack_offset) VALUES (%s, %s, %s, %s, %s, 'pack', %s)", (s_fl.uuid, s_fl.size, s_fl.count, s_fl.hash, p_oid, p_offset), fetch_func=None)
+            s_fl.sparse_uuid = None
+            s_fl.sparse_index = 0
+            s_fl.engine = 'pack'
+            moved += s_fl.size
+        self.st_db.execute("DELETE FROM file_storage_sparse WHERE uuid = %s;", (sp_uuid,), fetch_func=None)
+        self.__forget_sparse_row(sp_uuid)
+        return (moved, max(0, sp_size - moved))
+
+    def __compact_pack(self, p_oid):
+        """Move files in a pack segment to other segments, and drop the
+        segment along with the space left by removed files. Returns the bytes
+        copied and the bytes reclaimed."""
+        row = self.st_db.execute("SELECT size, used FROM file_storage_pack WHERE oid = %s;", (p_oid,), fetch_func='one')
+        if not row:
+            return (0, 0)
+        p_size, p_used = row
+        moved = 0
+        for item in self.st_db.execute("SELECT uuid, lo_get(content, pack_offset, COALESCE(stored_size, size)::INTEGER) FROM file_storage WHERE content = %s AND engine = 'pack';", (p_oid,)):
+            s_fl = self.st_uuid_idx.get(item[0], None)
+            if not s_fl:
+                continue
+            content = item[1]
+            self.__detach_packed(s_fl)
+            n_oid, n_offset = self.__pack_reserve(len(content), exclude=[p_oid])
+            if len(content) > 0:
+                self.st_db.execute("SELECT lo_put(%s, %s, %s);", (n_oid, n_offset, content), fetch_func=None)
+            self.st_db.execute("UPDATE file_storage SET content = %s, pack_offset = %s WHERE uuid = %s;", (n_oid, n_offset, s_fl.uuid), fetch_func=None)
+            moved += len(content)
+        # Segments whose 'used' had drifted are dropped all the same
+        self.__drop_pack(p_oid)
+        self.st_db.execute("""
+            WITH seg AS (
+                DELETE FROM file_storage_pack WHERE oid = %s
+                    AND NOT EXISTS (SELECT uuid FROM file_storage WHERE content = %s)
+                    RETURNING oid)
+            SELECT lo_unlink(oid) FROM seg;""",
+            (p_oid, p_oid), fetch_func=None)
+        return (moved, max(0, p_size - moved))
+
+    def __reconcile_counts(self):
+        """Set the reference count of every file to the number of filesystem
+        nodes referring to it, removing files no node refers to. Returns the
+        number of counts corrected and the bytes of files removed."""
+        refs = dict()
+        for item in self.st_db.execute("SELECT f_uuid, COUNT(*) FROM file_system_node WHERE NOT is_dir AND f_uuid IS NOT NULL GROUP BY f_uuid;"):
+            refs[item[0]] = item[1]
+        fixed, reclaimed = 0, 0
+        for s_fl in list(self.st_uuid_idx.values()):
+            n_count = refs.get(s_fl.uuid, 0)
+            if n_count == s_fl.count:
+                continue
+            fixed += 1
+            if n_count <= 0:
+                # Removed like any file whose last reference is gone
+                self.__add_count(s_fl, 1 - s_fl.count)
+                self.__remove_unique_file(s_fl.uuid)
+                reclaimed += s_fl.size
+                continue
+            self.__add_count(s_fl, n_count - s_fl.count)
+        return (fixed, reclaimed)
+
     def __get_content_sparse(self, u_fl):
         """Retrieves content from file storage and returns the content in binary
         bytes. Consumes 8x memory per operation, but since it's a sparse file,
         it doesn't matter."""
         content = b''
-        selection = self.st_db.execute("SELECT sub_content[%s] FROM file_storage_sparse WHERE uuid = %s;", (u_fl.sparse_index, u_fl.sparse_uuid))
+        if u_fl.engine == 'pack':
+            selection = self.st_db.execute("SELECT lo_get(content, pack_offset, COALESCE(stored_size, size)::INTEGER) FROM file_storage WHERE uuid = %s;", (u_fl.uuid,))
+        else:
+            selection = self.st_db.execute("SELECT sub_content[%s] FROM file_storage_sparse WHERE uuid = %s;", (u_fl.sparse_index, u_fl.sparse_uuid))
         # Of course this writes easier...
         try: content = selection[0][0]
         except: content = b''
@@ -337,6 +773,13 @@ class FileStorage:
         )
         return content_stream
 
+    def __get_manifest(self, u_fl):
+        """Returns digests and sizes of chunks of a chunked file."""
+        res = self.st_db.execute("SELECT chunk_hash, chunk_size FROM file_storage_manifest WHERE uuid = %s;", (u_fl.uuid,), fetch_func='one')
+        if not res:
+            return (list(), list())
+        return (res[0], res[1])
+
     def __get_content(self, uuid_):
         """Retrieves content from file storage and returns the content in binary
         bytes. Consumes 1x + 2 MB memory per operation."""
@@ -344,9 +787,39 @@ class FileStorage:
             u_fl = self.st_uuid_idx[uuid_]
         except Exception:
             return b''
+        content_stream = self.__get_content_raw(u_fl)
+        if not u_fl.codec or content_stream is file_stream.EmptyFileStream:
+            return content_stream
+        # Decompressed while being read
+        res = self.st_db.execute("SELECT codec_blocks FROM file_storage WHERE uuid = %s;", (u_fl.uuid,), fetch_func='one')
+        return file_stream.FileStream(
+            mode='read',
+            codec_reader=file_codec.CodecReader(content_stream, u_fl.codec, res[0] if res else list(), u_fl.size),
+            database=self.st_db
+        )
+
+    def __get_content_raw(self, u_fl):
+        """Retrieves content as it is stored, compressed or not."""
         # If this is a sparse file, we call on subroutines to finish this
-        if u_fl.sparse_uuid:
+        if u_fl.sparse_uuid or u_fl.engine == 'pack':
             return self.__get_content_sparse(u_fl)
+        if u_fl.engine == 'chunked':
+            return file_stream.FileStream(
+                mode='read',
+                manifest=self.__get_manifest(u_fl),
+                chunk_store=self.st_chunks,
+                database=self.st_db
+            )
+        if u_fl.engine == 'blob':
+            try:
+                return file_stream.FileStream(
+                    mode='read',
+                    blob_store=self.st_blobs,
+                    blob_hash=u_fl.hash,
+                    database=self.st_db
+                )
+            except (OSError, AttributeError):
+                return file_stream.EmptyFileStream
         # Got file handle, now querying large file data
         # content = b'' # Empty bytes, ready to write
 
@@ -367,7 +840,8 @@ class FileStorage:
 
     def add_unique_file(self, uuid):
         """Adds an occurence to this file."""
-        ret_result = self.__add_unique_file(uuid)
+        with self.st_lock:
+            ret_result = self.__add_unique_file(uuid)
         return ret_result
 
     def new_unique_file(self, content_stream):
@@ -375,12 +849,126 @@ class FileStorage:
         ret_result = self.__new_unique_file(content_stream)
         return ret_result
 
+    def find_unique_file(self, hash_, size):
+        """Finds the UniqueFile with content of the hash and size, returns its
+        UUID or None if not found."""
+        with self.st_lock:
+            ret_result = self.__find_unique_file(hash_, size)
+        return ret_result
+
+    def check_proof(self, hash_, size, offset, length, salt, proof):
+        """Whether 'proof' is the hex SHA256 digest of 'salt' followed by
+        'length' bytes from 'offset' of the content of the hash and size, that
+        is whether whoever gave it has the content. The content is read
+        without holding the lock."""
+        uuid_ = self.find_unique_file(hash_, size)
+        if not uuid_ or offset < 0 or length < 0 or offset + length > size:
+            return False
+        # Removed meanwhile, or failing to be read, proves nothing
+        content_stream = self.__get_content(uuid_)
+        if not content_stream or content_stream is file_stream.EmptyFileStream:
+            return False
+        try:
+            try:
+                content_stream.seek(offset, 0)
+                data = content_stream.read(length)
+            finally:
+                content_stream.close()
+        except Exception:
+            return False
+        if len(data) != length:
+            return False
+        ret_result = hmac.compare_digest(hashlib.sha256(salt + data).hexdigest(), proof)
+        return ret_result
+
+    def find_by_hash(self, hash_):
+        """Returns the UUID of the file with the given hash, or None if there
+        is no such file. Quarantined files are only returned if there is no
+        other, as their content is still what their nodes refer to."""
+        s_fl = self.st_hash_idx.get(hash_, None)
+        if not s_fl:
+            with self.st_lock:
+                s_fl = next((self.st_uuid_idx[uuid_] for uuid_ in self.st_quarantined
+                    if uuid_ in self.st_uuid_idx and self.st_uuid_idx[uuid_].hash == hash_), None)
+        ret_result = s_fl.uuid if s_fl else None
+        return ret_result
+
     def remove_unique_file(self, uuid):
         """Removes a unique file, and if its appearances drop below 1 ( <= 0 ),
         remove the actual coincidence of this file and its content."""
         ret_result = self.__remove_unique_file(uuid)
         return ret_result
 
+    def migrate_to_blob(self, uuid):
+        """Moves content of a file to local filesystem, returns whether it was
+        moved. Should be called in a transaction."""
+        with self.st_lock:
+            ret_result = self.__migrate_to_blob(uuid)
+        return ret_result
+
+    def list_migratable(self):
+        """Returns UUIDs of all files not on local filesystem."""
+        with self.st_lock:
+            ret_result = list(s_fl.uuid for s_fl in self.st_uuid_idx.values() if s_fl.engine != 'blob')
+        return ret_result
+
+    def repack_sparse(self, sp_uuid):
+        """Moves files of a sparse row to pack segments and drops the row.
+        Returns bytes copied and bytes reclaimed. Should be called in a
+        transaction."""
+        with self.st_lock:
+            ret_result = self.__repack_sparse(sp_uuid)
+        return ret_result
+
+    def compact_pack(self, p_oid):
+        """Moves files of a pack segment to other segments and drops the
+        segment. Returns bytes copied and bytes reclaimed. Should be called in
+        a transaction."""
+        with self.st_lock:
+            ret_result = self.__compact_pack(p_oid)
+        return ret_result
+
+    def reconcile_counts(self):
+        """Corrects reference counts against the filesystem nodes, returns the
+        number of counts corrected and bytes of unreferenced files removed.
+        Should be called in a transaction, with the filesystem unchanged."""
+        with self.st_lock:
+            ret_result = self.__reconcile_counts()
+        return ret_result
+
+    def list_files(self):
+        """Returns UUID, hash and size of all stored files."""
+        with self.st_lock:
+            ret_result = list((s_fl.uuid, s_fl.hash, s_fl.size) for s_fl in self.st_uuid_idx.values())
+        return ret_result
+
+    def exists(self, uuid):
+        """Whether file of 'uuid' is still stored."""
+        ret_result = uuid in self.st_uuid_idx
+        return ret_result
+
+    def quarantine(self, uuid, reason):
+        """Stop deduplicating new uploads against file of 'uuid', of which the
+        content is damaged. Returns whether it was not quarantined before."""
+        with self.st_lock:
+            ret_result = self.__quarantine(uuid, reason)
+        return ret_result
+
+    def encode(self, content_stream, file_name=None):
+        """Compresses content of a closed stream if it is worth compressing,
+        so that the compressed content is stored by new_unique_file(). Returns
+        whether it was compressed. Should be called without holding locks."""
+        ret_result = self.__encode(content_stream, file_name)
+        return ret_result
+
+    def compression_report(self):
+        """Returns number of files, original size and stored size of files
+        by codec, 'none' for files not compressed."""
+        ret_result = dict()
+        for item in self.st_db.execute("SELECT codec, COUNT(*), SUM(size), SUM(COALESCE(stored_size, size)) FROM file_storage GROUP BY codec;") or list():
+            ret_result[item[0] or 'none'] = {'files': item[1], 'size': int(item[2] or 0), 'stored-size': int(item[3] or 0)}
+        return ret_result
+
     def get_content(self, uuid):
         """Retrieves content from file storage and returns a I/O operational
         file handle to read. Consumes very small memory."""
@@ -0,0 +1,283 @@
+
+import threading
+import time
+
+gc_chunk_batch = 256 # Chunks deleted per transaction
+
+class FileStorageCollector:
+    """ Background garbage collector of FileStorage, run on a schedule. Each
+    run does the following, in order:
+
+        reconcile   - Reference counts are corrected against the nodes in
+                      'file_system_node', and files no node refers to are
+                      removed.
+        sparse      - Sparse rows with holes left by removed files are moved
+                      into pack segments and dropped.
+        packs       - Pack segments of which at least half is no longer used
+                      are moved into other segments and dropped.
+        lobjects    - Large objects referred to by neither 'file_storage' nor
+                      'file_storage_pack' are unlinked.
+        chunks      - Chunks referred to by no manifest, nor pinned by an
+                      upload in progress here, are deleted.
+        uploads     - Temporary files of uploads to local filesystem, not in
+                      progress here and unchanged since, are removed.
+        blobs       - Blobs referred to by no file, as committed by uploads
+                      of which the transaction was rolled back, are removed.
+
+    Moving sparse rows and pack segments, and removing content, count their
+    size towards an I/O budget per run, and are left to later runs once the
+    budget is spent. The most fragmented are handled first.
+
+    Uploads write their large object in a transaction of their own, so it is
+    not visible here until the upload is complete, and is referred to right
+    after. To leave alone uploads between these two steps, in this or other
+    processes, a large object is only unlinked if it was already unreferenced
+    in the previous run. Chunks, temporary files and blobs are written ahead
+    of being referred to as well, and are only removed the same way.
+
+    Files are changed by transactions of different subtrees at the same time,
+    so files are moved or removed while holding a shared lock on the whole
+    tree, which waits for these transactions to finish. """
+
+    def __init__(self, database=None, budget=256 * 1024**2):
+        if not database:
+            raise AttributeError('Must provide a database')
+        self.db         = database
+        self.budget     = budget
+        self.fs         = None
+        self.fs_lock    = None
+        self.fs_store   = None
+        self.run_lock   = threading.Lock()
+        self.candidates = set() # Unreferenced large objects of the last run
+        self.chunk_candidates  = set() # Unreferenced chunks of the last run
+        self.upload_candidates = dict() # Temporary files of the last run -> (size, mtime)
+        self.blob_candidates   = set() # Unreferenced blobs of the last run
+        self.metrics    = {
+            'runs': 0,
+            'last-run': None,
+            'last-run-time': 0.0,
+            'last-run-bytes-reclaimed': 0,
+            'bytes-copied': 0,
+            'bytes-reclaimed': 0,
+            'bytes-reclaimed-sparse': 0,
+            'bytes-reclaimed-packs': 0,
+            'bytes-reclaimed-lobjects': 0,
+            'bytes-reclaimed-chunks': 0,
+            'bytes-reclaimed-uploads': 0,
+            'bytes-reclaimed-blobs': 0,
+            'bytes-reclaimed-unreferenced': 0,
+            'counts-corrected': 0,
+            'sparse-rows-repacked': 0,
+            'pack-segments-compacted': 0,
+            'lobjects-unlinked': 0,
+            'chunks-deleted': 0,
+            'uploads-removed': 0,
+            'blobs-removed': 0,
+            'budget-exhausted': 0,
+        }
+        return
+
+    def __reclaimed(self, kind, copied, reclaimed):
+        self.metrics['bytes-copied'] += copied
+        self.metrics['bytes-reclaimed'] += reclaimed
+        self.metrics['bytes-reclaimed-' + kind] += reclaimed
+        return reclaimed
+
+    def __reconcile(self):
+        with self.fs_lock.shared('/'), self.fs_store.st_lock, self.db.transaction():
+            fixed, reclaimed = self.fs_store.reconcile_counts()
+            if fixed:
+                self.fs.bump_generation() # Snapshots hold reference counts
+        self.metrics['counts-corrected'] += fixed
+        return self.__reclaimed('unreferenced', 0, reclaimed)
+
+    def __compact_sparse(self, budget):
+        """ Repack sparse rows with holes, returns bytes reclaimed and budget
+        left. """
+        ret_result = 0
+        rows = self.db.execute("""
+            SELECT uuid, pg_column_size(file_storage_sparse.*) FROM file_storage_sparse
+                WHERE array_length(unused, 1) > 0 OR count < array_length(sub_uuid, 1)
+                ORDER BY array_length(sub_uuid, 1) - count DESC;""")
+        for sp_uuid, sp_size in rows or list():
+            if sp_size > budget:
+                self.metrics['budget-exhausted'] += 1
+                break
+            with self.fs_lock.shared('/'), self.fs_store.st_lock, self.db.transaction():
+                copied, reclaimed = self.fs_store.repack_sparse(sp_uuid)
+                self.fs.bump_generation() # Snapshots hold sparse rows
+            budget -= sp_size
+            ret_result += self.__reclaimed('sparse', copied, reclaimed)
+            self.metrics['sparse-rows-repacked'] += 1
+        return ret_result, budget
+
+    def __compact_packs(self, budget):
+        """ Compact pack segments at least half unused, returns bytes
+        reclaimed and budget left. """
+        ret_result = 0
+        rows = self.db.execute("""
+            SELECT oid, size + used FROM file_storage_pack
+                WHERE used * 2 <= size ORDER BY size - used DESC;""")
+        for p_oid, cost in rows or list():
+            if cost > budget:
+                self.metrics['budget-exhausted'] += 1
+                break
+            with self.fs_lock.shared('/'), self.fs_store.st_lock, self.db.transaction():
+                copied, reclaimed = self.fs_store.compact_pack(p_oid)
+            budget -= cost
+            ret_result += self.__reclaimed('packs', copied, reclaimed)
+            self.metrics['pack-segments-compacted'] += 1
+        return ret_result, budget
+
+    def __unlink_lobjects(self, budget):
+        """ Unlink large objects unreferenced since the last run, returns
+        bytes reclaimed and budget left. """
+        ret_result = 0
+        rows = self.db.execute("""
+            SELECT m.oid FROM pg_largeobject_metadata AS m
+                WHERE NOT EXISTS (SELECT uuid FROM file_storage WHERE content = m.oid)
+                    AND NOT EXISTS (SELECT oid FROM file_storage_pack WHERE oid = m.oid);""")
+        orphans = set(item[0] for item in rows or list())
+        confirmed = sorted(orphans & self.candidates)
+        self.candidates = orphans
+        for oid in confirmed:
+            with self.fs_store.st_lock, self.db.transaction():
+                # Referred to meanwhile, or already gone
+                size = self.db.execute("""
+                    SELECT lo_lseek64(lo_open(m.oid, 262144), 0, 2) FROM pg_largeobject_metadata AS m
+                        WHERE m.oid = %s
+                            AND NOT EXISTS (SELECT uuid FROM file_storage WHERE content = m.oid)
+                            AND NOT EXISTS (SELECT oid FROM file_storage_pack WHERE oid = m.oid);""",
+                    (oid,), fetch_func='one')
+                if not size:
+                    self.candidates.discard(oid)
+                    continue
+                if size[0] > budget:
+                    self.metrics['budget-exhausted'] += 1
+                    break
+                self.db.execute("SELECT lo_unlink(%s);", (oid,), fetch_func=None)
+            self.candidates.discard(oid)
+            budget -= size[0]
+            ret_result += self.__reclaimed('lobjects', 0, size[0])
+            self.metrics['lobjects-unlinked'] += 1
+        return ret_result, budget
+
+    def __drop_chunks(self, budget):
+        """ Delete chunks unreferenced since the last run, returns bytes
+        reclaimed and budget left. """
+        ret_result = 0
+        rows = self.db.execute("SELECT hash, size FROM file_storage_chunk WHERE count <= 0;")
+        orphans = dict((item[0], item[1]) for item in rows or list())
+        confirmed = sorted(set(orphans) & self.chunk_candidates)
+        self.chunk_candidates = set(orphans)
+        for i in range(0, len(confirmed), gc_chunk_batch):
+            batch = confirmed[i:i + gc_chunk_batch]
+            cost = sum(orphans[digest] for digest in batch)
+            if cost > budget:
+                self.metrics['budget-exhausted'] += 1
+                break
+            # Pinned or referred to meanwhile, or already gone, are kept
+            with self.fs_store.st_lock, self.db.transaction():
+                deleted, reclaimed = self.fs_store.st_chunks.drop_unreferenced(batch)
+            self.chunk_candidates.difference_update(batch)
+            budget -= cost
+            ret_result += self.__reclaimed('chunks', 0, reclaimed)
+            self.metrics['chunks-deleted'] += deleted
+        return ret_result, budget
+
+    def __remove_uploads(self, budget):
+        """ Remove temporary files of uploads to local filesystem, unchanged
+        since the last run, returns bytes reclaimed and budget left. """
+        ret_result = 0
+        blobs = self.fs_store.st_blobs
+        if not blobs:
+            return ret_result, budget
+        orphans = blobs.list_uploads()
+        confirmed = sorted(path for path in orphans if self.upload_candidates.get(path, None) == orphans[path])
+        self.upload_candidates = orphans
+        for tmp_path in confirmed:
+            size = orphans[tmp_path][0]
+            if size > budget:
+                self.metrics['budget-exhausted'] += 1
+                break
+            blobs.discard(tmp_path)
+            del self.upload_candidates[tmp_path]
+            budget -= size
+            ret_result += self.__reclaimed('uploads', 0, size)
+            self.metrics['uploads-removed'] += 1
+        return ret_result, budget
+
+    def __remove_blobs(self, budget):
+        """ Remove blobs unreferenced since the last run, returns bytes
+        reclaimed and budget left. """
+        ret_result = 0
+        blobs = self.fs_store.st_blobs
+        if not blobs:
+            return ret_result, budget
+        # Listed after the references, so that blobs stored meanwhile are
+        # left to the next run
+        rows = self.db.execute("SELECT DISTINCT hash FROM file_storage WHERE engine = 'blob';")
+        referenced = set(item[0] for item in rows or list())
+        orphans = dict((hash_, size) for hash_, size in blobs.list_blobs().items() if hash_ not in referenced)
+        confirmed = sorted(set(orphans) & self.blob_candidates)
+        self.blob_candidates = set(orphans)
+        for hash_ in confirmed:
+            if orphans[hash_] > budget:
+                self.metrics['budget-exhausted'] += 1
+                break
+            with self.fs_lock.shared('/'), self.fs_store.st_lock:
+                # Referred to meanwhile
+                if self.db.execute("SELECT uuid FROM file_storage WHERE engine = 'blob' AND hash = %s LIMIT 1;", (hash_,), fetch_func='one'):
+                    self.blob_candidates.discard(hash_)
+                    continue
+                removed = blobs.remove(hash_)
+            self.blob_candidates.discard(hash_)
+            if not removed:
+                continue
+            budget -= orphans[hash_]
+            ret_result += self.__reclaimed('blobs', 0, orphans[hash_])
+            self.metrics['blobs-removed'] += 1
+        return ret_result, budget
+
+    def __collect(self):
+        tm = time.time()
+        budget = self.budget
+        reclaimed = self.__reconcile()
+        for func in [self.__compact_sparse, self.__compact_packs, self.__unlink_lobjects, self.__drop_chunks, self.__remove_uploads, self.__remove_blobs]:
+            r_bytes, budget = func(budget)
+            reclaimed += r_bytes
+        self.metrics['runs'] += 1
+        self.metrics['last-run'] = tm
+        self.metrics['last-run-time'] = time.time() - tm
+        self.metrics['last-run-bytes-reclaimed'] = reclaimed
+        return reclaimed
+
+    def bind(self, filesystem, filestorage, fs_lock):
+        """ Garbage would be collected from 'filestorage', which stores the
+        content of 'filesystem', of which 'fs_lock' locks the tree. """
+        self.fs = filesystem
+        self.fs_store = filestorage
+        self.fs_lock = fs_lock
+        return
+
+    def collect(self):
+        """ Run the collector once, unless already running. Returns the bytes
+        reclaimed, or None if skipped. """
+        if not self.run_lock.acquire(blocking=False):
+            return None
+        try:
+            ret_result = self.__collect()
+        finally:
+            self.run_lock.release()
+        return ret_result
+
+    def get_metrics(self):
+        """ Totals of what the collector had done since started. """
+        ret_result = dict(self.metrics)
+        ret_result['budget'] = self.budget
+        ret_result['lobjects-pending'] = len(self.candidates)
+        ret_result['chunks-pending'] = len(self.chunk_candidates)
+        ret_result['uploads-pending'] = len(self.upload_candidates)
+        ret_result['blobs-pending'] = len(self.blob_candidates)
+        return ret_result
+    pass
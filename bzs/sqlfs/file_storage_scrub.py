@@ -0,0 +1,275 @@
+
+import collections
+import concurrent.futures
+import json
+import threading
+import time
+
+from . import file_hash
+from . import file_stream
+
+scrub_block_size = 1024 * 1024 # Read at a time
+scrub_save_every = 256 # Files verified between saving the checkpoint
+scrub_retry_delay = 5.0 # Seconds before reading again content that could not be read
+
+class FileStorageScrubber:
+    """ Background scrubber of FileStorage, which reads the content of stored
+    files again and hashes it the same way as fs_st_sha256(), to find content
+    that no longer matches the hash recorded when it was uploaded, or that
+    could not be read at all.
+
+    Files are visited in order of their UUID, by a few threads of its own,
+    each hashing a single file at a time. Reads of all threads together are
+    limited to 'rate' bytes per second, so the scrubber takes only a small
+    share of the I/O of the database and of local disks. Each run stops after
+    reading 'budget' bytes, and the next run resumes from where it stopped:
+    the UUID up to which all files were verified is kept in 'core', along
+    with the damaged files found so far.
+
+    Damaged files are reported as:
+
+        missing     - Content could not be read.
+        mismatch    - Content was read but its hash differs.
+
+    If 'quarantine' is set, new uploads are no longer deduplicated against
+    damaged files, so intact copies of the content could be stored again.
+    Content found missing is only quarantined if it was also missing on the
+    previous pass, as reads fail while the database is unavailable. Files
+    removed while being verified are not reported. """
+
+    def __init__(self, database=None, threads=2, rate=8 * 1024**2, budget=1024**3, quarantine=False):
+        if not database:
+            raise AttributeError('Must provide a database')
+        self.db         = database
+        self.threads    = max(1, threads)
+        self.rate       = rate # 0 for unlimited
+        self.budget     = budget # 0 for unlimited
+        self.quarantine = quarantine
+        self.fs_store   = None
+        self.loaded     = False # Whether state was loaded from 'core'
+        self.hash_pool  = file_hash.HashPoolType(threads=1) # Each thread hashes on its own
+        self.run_lock   = threading.Lock()
+        self.lock       = threading.Lock() # Guards throttling and results
+        self.buffers    = threading.local() # Read buffer of each thread
+        self.tm_next    = 0.0 # When the next block may be read
+        self.checkpoint = None # All files up to this UUID were verified in this pass
+        self.passes     = 0
+        self.failures   = dict() # UUID -> details
+        self.progress   = {
+            'running': False,
+            'files-total': 0,
+            'files-done': 0,
+        }
+        self.metrics    = {
+            'runs': 0,
+            'last-run': None,
+            'last-run-time': 0.0,
+            'last-pass': None,
+            'files-scrubbed': 0,
+            'bytes-scrubbed': 0,
+            'files-missing': 0,
+            'files-mismatch': 0,
+            'files-quarantined': 0,
+        }
+        return
+
+    def __load_state(self):
+        res = self.db.execute("SELECT data FROM core WHERE index = 'sqlfs_scrub';")
+        if not res:
+            return
+        state = json.loads(bytes(res[0][0]).decode('utf-8'))
+        self.checkpoint = state.get('checkpoint', None)
+        self.passes = state.get('passes', 0)
+        self.metrics['last-pass'] = state.get('last-pass', None)
+        self.failures = state.get('failures', dict())
+        return
+
+    def __save_state(self):
+        with self.lock:
+            state = json.dumps({
+                'checkpoint': self.checkpoint,
+                'passes': self.passes,
+                'last-pass': self.metrics['last-pass'],
+                'failures': self.failures,
+            }).encode('utf-8')
+        with self.db.transaction():
+            self.db.execute("DELETE FROM core WHERE index = 'sqlfs_scrub';", fetch_func=None)
+            self.db.execute("INSERT INTO core (index, data) VALUES ('sqlfs_scrub', %s);", (state,), fetch_func=None)
+        return
+
+    def __throttle(self, size):
+        """ Wait until 'size' bytes may be read without exceeding the rate. """
+        if self.rate <= 0:
+            return
+        with self.lock:
+            tm = time.time()
+            tm_start = max(tm, self.tm_next)
+            self.tm_next = tm_start + size / self.rate
+        if tm_start > tm:
+            time.sleep(tm_start - tm)
+        return
+
+    def __get_buffer(self):
+        """ Buffer of the calling thread, which all files it verifies are read
+        into. """
+        buffer = getattr(self.buffers, 'buffer', None)
+        if buffer is None:
+            buffer = memoryview(bytearray(scrub_block_size))
+            self.buffers.buffer = buffer
+        return buffer
+
+    def __read(self, f_uuid, f_hash, f_size):
+        """ Hash content of a file, returns the reason it is damaged, or None
+        if it is not, and the bytes read. """
+        hasher = file_hash.TreeHasher(pool=self.hash_pool)
+        buffer = self.__get_buffer()
+        stream = None
+        try:
+            stream = self.fs_store.get_content(f_uuid)
+            if stream is file_stream.EmptyFileStream and f_size > 0:
+                return 'missing', 0
+            while True:
+                size = stream.readinto(buffer)
+                if not size:
+                    break
+                hasher.update(buffer[:size])
+                self.__throttle(size)
+        except Exception:
+            return 'missing', hasher.length
+        finally:
+            if stream is not None and stream is not file_stream.EmptyFileStream:
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+        if hasher.hexdigest() != f_hash:
+            return 'mismatch', hasher.length
+        return None, hasher.length
+
+    def __verify(self, f_uuid, f_hash, f_size):
+        """ Same as __read(), content that could not be read is read again
+        after a while, as the database could have been unavailable. """
+        reason, size = self.__read(f_uuid, f_hash, f_size)
+        if reason == 'missing':
+            time.sleep(scrub_retry_delay)
+            reason, r_size = self.__read(f_uuid, f_hash, f_size)
+            size += r_size
+        return reason, size
+
+    def __record(self, f_uuid, f_hash, reason, size):
+        with self.lock:
+            self.metrics['files-scrubbed'] += 1
+            self.metrics['bytes-scrubbed'] += size
+            if not reason:
+                self.failures.pop(str(f_uuid), None)
+                return
+        if not self.fs_store.exists(f_uuid):
+            return # Removed while being verified
+        with self.lock:
+            self.metrics['files-' + reason] += 1
+            previous = self.failures.get(str(f_uuid), None)
+            self.failures[str(f_uuid)] = {
+                'hash': f_hash,
+                'reason': reason,
+                'time': time.time(),
+            }
+        # Content that could not be read is only quarantined once it was also
+        # missing on the previous visit
+        confirmed = reason == 'mismatch' or (previous and previous['reason'] == 'missing')
+        if self.quarantine and confirmed:
+            with self.fs_store.st_lock, self.db.transaction():
+                quarantined = self.fs_store.quarantine(f_uuid, reason)
+            if quarantined:
+                self.metrics['files-quarantined'] += 1
+        return
+
+    def __scrub(self):
+        tm = time.time()
+        if not self.loaded:
+            self.__load_state()
+            self.loaded = True
+        files = sorted(self.fs_store.list_files(), key=lambda item: str(item[0]))
+        pending = files if not self.checkpoint else list(
+            item for item in files if str(item[0]) > self.checkpoint)
+        self.progress['files-total'] = len(files)
+        self.progress['files-done'] = len(files) - len(pending)
+        budget = self.budget
+        done = 0
+        in_flight = collections.deque() # Futures in order of UUID
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        try:
+            while done < len(pending):
+                # Keep every thread busy, and a file in line for each
+                while done + len(in_flight) < len(pending) and len(in_flight) < 2 * self.threads and (self.budget <= 0 or budget > 0):
+                    f_uuid, f_hash, f_size = pending[done + len(in_flight)]
+                    in_flight.append(executor.submit(self.__verify, f_uuid, f_hash, f_size))
+                    budget -= f_size
+                if not in_flight:
+                    break # Budget spent
+                # The checkpoint only moves past files verified in order
+                f_uuid, f_hash, f_size = pending[done]
+                reason, size = in_flight.popleft().result()
+                self.__record(f_uuid, f_hash, reason, size)
+                with self.lock:
+                    self.checkpoint = str(f_uuid)
+                done += 1
+                self.progress['files-done'] += 1
+                if done % scrub_save_every == 0:
+                    self.__save_state()
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+        if done >= len(pending):
+            # Pass complete, failures of files removed since are dropped
+            stored = set(str(item[0]) for item in self.fs_store.list_files())
+            with self.lock:
+                self.failures = dict((key, value) for key, value in self.failures.items() if key in stored)
+                self.checkpoint = None
+                self.passes += 1
+                self.metrics['last-pass'] = time.time()
+        self.__save_state()
+        self.metrics['runs'] += 1
+        self.metrics['last-run'] = tm
+        self.metrics['last-run-time'] = time.time() - tm
+        return done
+
+    def bind(self, filestorage):
+        """ Content of 'filestorage' would be verified. """
+        self.fs_store = filestorage
+        return
+
+    def scrub(self):
+        """ Verify files from the checkpoint on, until the budget of the run is
+        spent or all files were verified. Returns the number of files
+        verified, or None if skipped as already running. """
+        if not self.run_lock.acquire(blocking=False):
+            return None
+        self.progress['running'] = True
+        try:
+            ret_result = self.__scrub()
+        finally:
+            self.progress['running'] = False
+            self.run_lock.release()
+        return ret_result
+
+    def get_failures(self):
+        """ Damaged files found so far, by UUID. """
+        with self.lock:
+            ret_result = dict((key, dict(value)) for key, value in self.failures.items())
+        return ret_result
+
+    def get_metrics(self):
+        """ Progress of the current pass, and totals since started. """
+        with self.lock:
+            ret_result = dict(self.metrics)
+            ret_result.update(self.progress)
+            ret_result['checkpoint'] = self.checkpoint
+            ret_result['passes'] = self.passes
+            ret_result['failures'] = len(self.failures)
+        ret_result['threads'] = self.threads
+        ret_result['rate'] = self.rate
+        ret_result['budget'] = self.budget
+        ret_result['quarantine'] = self.quarantine
+        return ret_result
+    pass
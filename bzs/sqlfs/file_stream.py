@@ -3,23 +3,186 @@ import io
 
 from .. import db
 from .. import utils
+from . import file_blobs
+from . import file_chunks
+from . import file_hash
 
 sparse_size = 2 * 1024 * 1024 # Files under 2 MB would be considered sparse
 
+class MemoryReader:
+    """File-like object reading content held in memory, such as 'bytes' or a
+    'memoryview' from the database, without copying it. Reads could go into a
+    given buffer, or be views of the content itself."""
+
+    def __init__(self, data):
+        self.data = data
+        self.view = memoryview(data)
+        self.length = len(self.view)
+        self.pos = 0
+        self.closed = False
+        return
+
+    def read_view(self, size=-1):
+        """Returns a view of at most 'size' bytes from the current position,
+        valid until the reader is closed."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.length - self.pos
+        ret_result = self.view[self.pos:self.pos + size]
+        self.pos += len(ret_result)
+        return ret_result
+
+    def read(self, size=-1):
+        return bytes(self.read_view(size))
+
+    def readinto(self, buffer):
+        view = self.read_view(len(buffer))
+        memoryview(buffer)[:len(view)] = view
+        return len(view)
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.pos = max(0, offset + [0, self.pos, self.length][whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        """The content is kept, only the view is released."""
+        self.closed = True
+        return
+    pass
+
+class LargeObjectReader:
+    """File-like object reading a large object with a short statement for
+    every read, so that no connection is held between reads, however long
+    the content takes to be sent. Reads are not isolated from each other,
+    the large object must not change while it is being read."""
+
+    def __init__(self, database, oid):
+        self.db = database
+        self.oid = oid
+        # Opened for reading (INV_READ) only as long as the statement runs
+        self.length = self.db.execute("SELECT lo_lseek64(lo_open(%s, 262144), 0, 2);", (oid,), fetch_func='one')[0]
+        self.pos = 0
+        self.closed = False
+        return
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if size is None or size < 0:
+            size = self.length - self.pos
+        size = max(0, min(size, self.length - self.pos))
+        if size <= 0:
+            return b''
+        ret_result = bytes(self.db.execute("SELECT lo_get(%s, %s, %s);", (self.oid, self.pos, size), fetch_func='one')[0])
+        self.pos += len(ret_result)
+        return ret_result
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        size = max(0, min(len(buffer), self.length - self.pos))
+        if size <= 0:
+            return 0
+        data = self.db.execute("SELECT lo_get(%s, %s, %s);", (self.oid, self.pos, size), fetch_func='one')[0]
+        memoryview(buffer)[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        self.pos = max(0, offset + [0, self.pos, self.length][whence])
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def unlink(self):
+        self.db.execute("SELECT lo_unlink(%s);", (self.oid,), fetch_func=None)
+        return
+
+    def close(self):
+        self.closed = True
+        return
+    pass
+
 class FileStream:
-    """A file stream handler used to work on both large and sparsed files."""
+    """A file stream handler used to work on both large and sparsed files.
+    Large files may also be chunked if a 'chunk_store' is given, in which case
+    they are written as content-defined chunks, and read through 'manifest'.
+    Files of any size may instead be kept on the local filesystem if given a
+    'blob_store', and read from the blob of 'blob_hash'. Compressed content is
+    read through a 'codec_reader'.
+
+    In write mode, content is hashed as it comes in, with the same scheme as
+    fs_st_sha256(), and the digest is available in 'digest' once closed. It
+    would be None if the stream was not written sequentially from its end, in
+    which case the content should be read back to be hashed."""
 
-    def __init__(self, mode='read', est_length=1024**8, obj_oid=0, obj_data=b'', database=None):
+    def __init__(self, mode='read', est_length=1024**8, obj_oid=0, obj_data=b'', database=None, chunk_store=None, manifest=None, blob_store=None, blob_hash=None, codec_reader=None):
         if not database:
             raise AttributeError('Must provide a database')
         self.db = database
-        if (est_length <= sparse_size or len(obj_data) > 0) and obj_oid <= 0:
-            # Create sparsed file
+        self.chunk_store = chunk_store
+        self.manifest = manifest
+        self.blob_store = blob_store
+        self.is_chunked = False
+        self.is_blob = False
+        self.codec = None
+        self.encoded = None # Compressed copy of content written, see FileStorage.encode()
+        if codec_reader:
+            # Read compressed content
+            self.content_obj = codec_reader
+            self.codec = codec_reader.codec
+            self.mode = mode
+            self.length = codec_reader.length
+            self.is_sparse = False
+        elif blob_store and (blob_hash or (mode == 'write' and obj_oid <= 0)):
+            # Create file on local filesystem
+            if blob_hash:
+                self.content_obj = blob_store.reader(blob_hash)
+            else:
+                self.content_obj = blob_store.writer()
+                self.content_obj.write(obj_data)
+            self.blob_path = self.content_obj.path
+            self.mode = mode
+            self.length = self.content_obj.length
+            self.is_sparse = False
+            self.is_blob = True
+        elif chunk_store and (manifest or (mode == 'write' and est_length > sparse_size and len(obj_data) <= 0 and obj_oid <= 0)):
+            # Create chunked file
+            if manifest:
+                self.content_obj = file_chunks.ChunkReader(chunk_store, manifest)
+            else:
+                self.content_obj = file_chunks.ChunkWriter(chunk_store)
+            self.mode = mode
+            self.length = self.content_obj.length
+            self.is_sparse = False
+            self.is_chunked = True
+        elif (est_length <= sparse_size or len(obj_data) > 0) and obj_oid <= 0:
+            # Create sparsed file, read without copying the content
             self.content_data = obj_data
-            self.content_obj = io.BytesIO(self.content_data) # Already seeked to begin
+            if mode == 'read':
+                self.content_obj = MemoryReader(self.content_data)
+            else:
+                self.content_obj = io.BytesIO(self.content_data) # Already seeked to begin
             self.mode = mode
             self.length = len(obj_data)
             self.is_sparse = True
+        elif est_length > sparse_size and mode == 'read':
+            # Read large object a block at a time
+            self.content_conn = None
+            self.content_obj = LargeObjectReader(self.db, obj_oid)
+            self.content_oid = obj_oid
+            self.mode = mode
+            self.length = self.content_obj.length
+            self.is_sparse = False
         elif est_length > sparse_size:
             # Create large object
             self.content_conn = self.db.execute_raw()
@@ -33,38 +196,63 @@ class FileStream:
             self.is_sparse = False
         self.est_length = est_length
         self.closed = False
+        # Incremental hashing, see fs_st_sha256()
+        self.digest = None
+        if mode == 'write':
+            self.hasher = file_hash.TreeHasher()
+            self.hasher.update(obj_data)
+        else:
+            self.hasher = None
         return
 
     def close(self):
         """close() -- close the file stream."""
         if self.closed:
             return
-        if self.is_sparse:
-            self.content_obj.seek(0, 0)
-            self.content_data = self.content_obj.read()
+        if self.mode == 'write' and self.hasher:
+            self.digest = self.hasher.hexdigest()
+            self.hasher = None
+        if self.codec:
+            self.content_obj.close()
+        elif self.is_chunked:
+            self.content_obj.close()
+            self.length = self.content_obj.length
+            if self.mode == 'write':
+                self.manifest = self.content_obj.manifest()
+        elif self.is_blob:
+            self.content_obj.close()
+            self.length = self.content_obj.length
+        elif self.is_sparse:
+            if self.mode == 'write':
+                # Shares the buffer of BytesIO where possible, not copied
+                self.content_data = self.content_obj.getvalue()
             self.length = len(self.content_data)
             self.content_obj.close()
         else:
             self.length = self.size()
             # If original indicated as large file but now is sparsed file, destroy the original one and create BytesIO.
-            if self.length < sparse_size:
+            if self.length < sparse_size and self.mode == 'write':
                 self.content_obj.seek(0, 0)
                 self.content_data = self.content_obj.read()
                 # Destroying lObject
                 self.content_obj.unlink()
                 self.content_conn.commit()
                 self.content_cur.close()
-                # Creating BytesIO
+                self.db.release_raw(self.content_conn)
+                # Read as a sparse file from now on
                 del self.content_obj
                 del self.content_conn
                 del self.content_cur
-                self.content_obj = io.BytesIO(self.content_data)
+                self.content_obj = MemoryReader(self.content_data)
                 self.is_sparse = True
                 self.content_obj.close()
             else:
                 self.content_obj.close()
-                self.content_conn.commit()
-                self.content_cur.close()
+                if self.content_conn:
+                    self.content_conn.commit()
+                    self.content_cur.close()
+                    self.db.release_raw(self.content_conn)
+                del self.content_conn
             pass
         del self.est_length
         self.closed = True
@@ -72,13 +260,19 @@ class FileStream:
 
     def reopen(self):
         """reopen() -- Reopen the file as reading mode."""
-        if self.is_sparse:
-            self.content_obj = io.BytesIO(self.content_data)
+        if self.is_chunked:
+            self.content_obj = file_chunks.ChunkReader(self.chunk_store, self.manifest)
+            self.est_length = self.length
+        elif self.is_blob:
+            self.content_obj = file_blobs.BlobReader(self.blob_path)
+            self.est_length = self.length
+        elif self.is_sparse:
+            # The same content is read again, not copied
+            self.content_obj = MemoryReader(self.content_data)
             self.est_length = len(self.content_data)
         else:
-            self.content_conn = self.db.execute_raw()
-            self.content_cur = self.content_conn.cursor()
-            self.content_obj = self.content_conn.lobject(self.content_oid, 'rb')
+            self.content_conn = None
+            self.content_obj = LargeObjectReader(self.db, self.content_oid)
             self.est_length = self.length
         self.closed = False
         self.mode = 'read'
@@ -93,6 +287,27 @@ class FileStream:
             return b''
         return self.content_obj.read(size)
 
+    def readinto(self, buffer):
+        """readinto(buffer) -- Read at most len(buffer) bytes into a writable
+        buffer, and return the number of bytes read. Saves allocating a new
+        'bytes' for every read, if the buffer is reused."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self.mode != 'read':
+            return 0
+        return self.content_obj.readinto(buffer)
+
+    def read_view(self, size=-1):
+        """read_view(size=-1) -- Read at most size bytes as a memoryview, which
+        is a view of the content itself for sparse files, valid until closed."""
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self.mode != 'read':
+            return memoryview(b'')
+        if self.is_sparse:
+            return self.content_obj.read_view(size)
+        return memoryview(self.content_obj.read(size))
+
     def seek(self, offset, whence=0):
         """seek(offset, whence=0) -- Set the file's current position."""
         if self.closed:
@@ -115,8 +330,15 @@ class FileStream:
             raise ValueError('I/O operation on closed file')
         if self.mode != 'write':
             return
-        if self.tell() > self.est_length:
+        pos = self.tell()
+        if pos > self.est_length:
             raise Exception('Wrote more bytes than anticipated')
+        # Hashing is only valid for content appended in order
+        if self.hasher:
+            if pos == self.hasher.length:
+                self.hasher.update(cont)
+            else:
+                self.hasher = None
         if self.is_sparse:
             result = self.content_obj.write(cont)
         else:
@@ -140,19 +362,49 @@ class FileStream:
         or do nothing but destroy the bytes record from database."""
         if self.closed:
             raise ValueError('I/O operation on closed file')
-        if self.is_sparse:
+        if self.is_chunked:
+            if self.mode == 'write':
+                self.content_obj.discard()
+            self.content_obj.close()
+        elif self.is_blob:
+            self.content_obj.close()
+            if self.mode == 'write':
+                self.blob_store.discard(self.blob_path)
+        elif self.is_sparse:
             self.content_obj.close()
             self.content_data = None
         else:
             self.content_obj.unlink()
-            self.content_conn.commit()
-            self.content_cur.close()
+            if self.content_conn:
+                self.content_conn.commit()
+                self.content_cur.close()
+                self.db.release_raw(self.content_conn)
+            del self.content_conn
         self.closed = True
         return
 
+    def get_encoded(self, codec):
+        """Returns a stream of content as stored if it is compressed with
+        'codec', which could be sent as is to clients accepting that encoding,
+        otherwise None. Its length is in 'length'. Each block is compressed on
+        its own, as a gzip member, and some clients stop after the first one,
+        so content of more than one block is decompressed here instead."""
+        if self.codec != codec or self.mode != 'read':
+            return None
+        if len(self.content_obj.offsets) > 2:
+            return None
+        raw = self.content_obj.raw
+        raw.seek(0, 0)
+        return raw
+
     def get_content(self):
         """get_content() -- Get entire content of file in bytes. If file is
-        not sparsed, then the OID is returned."""
+        not sparsed, then the OID is returned, or the manifest of (digests,
+        sizes) if chunked, or the path on local filesystem if a blob."""
+        if self.is_chunked:
+            return self.manifest
+        if self.is_blob:
+            return self.blob_path
         if self.is_sparse:
             return self.content_data
         else:
@@ -1,7 +1,12 @@
 
+import collections
 import copy
 import re
+import sys
+import threading
+import types
 import uuid as uuid_package
+import weakref
 
 from . import file_stream
 
@@ -11,6 +16,80 @@ class Filesystem:
     files and find siblings quickly. Yet without the B-Tree optimization it
     would not be easy to maintain a high performance. """
 
+    class fsACL:
+        """ Access control list of a node, which maps users and usergroups to
+        their permissions. Permissions of each are a 6-bit mask of:
+
+            read         =  1 - Read permissions
+            write        =  2 - Write permissions
+            inherit      =  4 - Properties affect children
+            read_pass    =  8 - Pass read properties to children upon creation
+            write_pass   = 16 - Pass write properties to children upon creation
+            inherit_pass = 32 - Pass inheritance properties to children upon creation
+
+        Also formatted as 'rwxrwx' in the same order. ACLs are immutable and
+        interned, so that nodes with the same permissions share one ACL, and
+        changing permissions of a node replaces its ACL (copy-on-write). The
+        formatted ACL is computed once upon creation. Get ACLs through
+        fsACL.get(). """
+
+        __slots__ = ('masks', 'key', 'fmt_dict', 'fmt_list', '__weakref__')
+        bits      = {'read': 1, 'write': 2, 'inherit': 4, 'read_pass': 8, 'write_pass': 16, 'inherit_pass': 32}
+        parsed    = dict((''.join('rwxrwx'[i] if m & (1 << i) else '-' for i in range(0, 6)), m) for m in range(0, 64))
+        formats   = dict((m, f) for f, m in parsed.items())
+        interned  = weakref.WeakValueDictionary()
+        lock      = threading.Lock()
+
+        def __init__(self, masks, key):
+            self.masks = masks
+            self.key = key
+            self.fmt_dict = dict((usr, self.formats[masks[usr]]) for usr in masks)
+            self.fmt_list = list([usr, self.fmt_dict[usr]] for usr in masks)
+            return
+
+        def __getitem__(self, usr):
+            return self.masks[usr]
+
+        def __contains__(self, usr):
+            return usr in self.masks
+
+        def __iter__(self):
+            return iter(self.masks)
+
+        def test(self, usr, mode):
+            """ Whether 'usr' has permission 'mode', such as 'read'. """
+            return self.masks[usr] & self.bits[mode] != 0
+
+        def set(self, usr, mask):
+            """ Returns the ACL with permissions of 'usr' replaced by 'mask'. """
+            if self.masks.get(usr, None) == mask:
+                return self
+            n_masks = dict(self.masks)
+            n_masks[usr] = mask
+            return self.get(n_masks)
+
+        @classmethod
+        def get(cls, masks):
+            """ Returns the shared ACL of 'masks', a dict() of users to masks or
+            'rwxrwx' formatted permissions. Returns None if any of them is
+            malformed. """
+            n_masks = dict()
+            for usr in masks:
+                mask = masks[usr]
+                if type(mask) == str:
+                    mask = cls.parsed.get(mask, None)
+                if type(mask) != int or mask < 0 or mask >= 64:
+                    return None
+                n_masks[sys.intern(usr)] = mask
+            key = tuple(sorted(n_masks.items()))
+            with cls.lock:
+                acl = cls.interned.get(key, None)
+                if acl is None:
+                    acl = cls(n_masks, key)
+                    cls.interned[key] = acl
+            return acl
+        pass
+
     class fsNode:
         """ This is a virtual node on a virtual filesystem SQLFS. The virtual
         node contains the following data:
@@ -20,7 +99,7 @@ class Filesystem:
             is_dir      - Whether is a directory or not
             file_name   - The actual file / directory name given by the user
             owner       - The string handle of the owner.
-            permissions - A dict() of users with dict() of allowed permissions.
+            permissions - The shared fsACL() of users to permissions.
             upload_time - The time uploaded / copied / moved to server
             f_uuid      - If a file them this indicates its FileStorage UUID.
 
@@ -30,65 +109,90 @@ class Filesystem:
             sub_items     - Set of children.
             sub_names_idx - Dictionary of children indexed by name.
 
+        Children of a directory may not be loaded from the database yet, if the
+        filesystem is lazily loaded. They are loaded upon first access to
+        'sub_items' or 'sub_names_idx'. Files do not hold children containers
+        and always give the same empty ones.
+
+        Nodes use __slots__ and share owner strings and permissions, as there
+        may be millions of them in memory.
+
         Do process with caution, and use exported methods only. """
 
-        file_name     = ''
-        is_dir        = False
-        owner         = 'kernel'
-        permissions   = {
-            '': dict(
-                read         = False, # Read permissions
-                write        = False, # Write permissions
-                inherit      = False, # Properties affect children
-                read_pass    = False, # Pass read properties to children upon creation
-                write_pass   = False, # Pass write properties to children upon creation
-                inherit_pass = False  # Pass inheritance properties to children upon creation
-            )
-        }
-        uuid          = uuid_package.UUID('00000000-0000-0000-0000-000000000000')
-        upload_time   = 0.0
-        f_uuid        = uuid_package.UUID('00000000-0000-0000-0000-000000000000')
-        sub_items     = set()
-        sub_names_idx = dict()
+        __slots__ = ('master', 'uuid', 'is_dir', 'file_name', 'owner',
+                     'permissions', 'upload_time', 'f_uuid', 'parent',
+                     '_sub_items', '_sub_names')
+        empty_items = frozenset()
+        empty_names = types.MappingProxyType(dict())
 
-        def __init__(self, is_dir=True, file_name='Untitled', owner='kernel', permissions={'':'------'}, uuid=None, upload_time=None, sub_folders=set(), sub_files=set(), f_uuid=None, master=None):
+        def __init__(self, is_dir=True, file_name='Untitled', owner='kernel', permissions={'':'------'}, uuid=None, upload_time=None, f_uuid=None, master=None, loaded=True):
             """ Load tree of all nodes in SQLFS filesystem. """
             # The filesystem / master of the node
             self.master = master
             # Assigning data
             self.is_dir = is_dir
             self.file_name = file_name
-            self.owner = owner
+            self.owner = sys.intern(owner)
             self.permissions = self.chmod_all(permissions)
             # Generate Universally Unique Identifier
             self.uuid = master.utils_pkg.get_new_uuid(uuid, master.fs_uuid_idx)
             master.fs_uuid_idx[self.uuid] = self
             # Get upload time
             self.upload_time = upload_time or master.utils_pkg.get_current_time()
-            if not self.is_dir:
-                self.sub_folders = set()
-                self.sub_files = set()
-                self.f_uuid = f_uuid
-            else:
-                # Folder initialization needs to be accounted after init as whole by the main caller
-                self.sub_folders = sub_folders # Temporary
-                self.sub_files = sub_files # Temporary
+            self.f_uuid = None if self.is_dir else f_uuid
             # This is a traversal thing...
             self.parent = None
-            self.sub_items = set()
-            self.sub_names_idx = dict()
+            self._sub_items = None
+            self._sub_names = None
+            if loaded and self.is_dir:
+                self.sub_items = set()
+                self.sub_names_idx = dict()
+            return
+
+        @property
+        def sub_items(self):
+            if not self.is_dir:
+                return self.empty_items
+            if self._sub_items is None:
+                self.master.materialize(self)
+            return self._sub_items
+
+        @sub_items.setter
+        def sub_items(self, value):
+            if not self.is_dir:
+                return # Files do not have children
+            self._sub_items = value
+            if self.master.fs_lazy:
+                self.master.touch(self)
             return
 
+        @property
+        def sub_names_idx(self):
+            if not self.is_dir:
+                return self.empty_names
+            if self._sub_names is None:
+                self.master.materialize(self)
+            return self._sub_names
+
+        @sub_names_idx.setter
+        def sub_names_idx(self, value):
+            if not self.is_dir:
+                return
+            self._sub_names = value
+            return
+
+        def is_loaded(self):
+            """ Whether children of this node are in memory. """
+            return not self.is_dir or self._sub_items is not None
+
         def duplicate(self):
             """ Create duplicate (mutation-invulnerable) of this node with a
             different UUID. """
             n_fl = self.master.fsNode(is_dir=self.is_dir, file_name=self.file_name, owner=self.owner, master=self.master)
-            n_fl.permissions = copy.copy(self.permissions)
+            n_fl.permissions = self.permissions # Shared, replaced upon change
             # n_fl.uuid = None # Disabled due to new UUID necessity
             n_fl.upload_time = self.upload_time
             if not n_fl.is_dir: n_fl.f_uuid = self.f_uuid
-            del n_fl.sub_folders
-            del n_fl.sub_files
             n_fl.parent = self.parent
             n_fl.sub_items = copy.copy(self.sub_items)
             n_fl.sub_names_idx = copy.copy(self.sub_names_idx)
@@ -96,50 +200,30 @@ class Filesystem:
 
         def chown(self, owner):
             """ Change owner of the file. """
-            self.owner = owner
+            self.owner = sys.intern(owner)
             return True
 
         def chmod(self, usr, perm):
             """ Changes the permission of a single user. """
-            if len(perm) != 6:
+            mask = Filesystem.fsACL.parsed.get(perm, None)
+            if mask is None:
                 return False # Does not comply with the basics
-            standard = 'rwxrwx'
-            indices = ['read', 'write', 'inherit', 'read_pass', 'write_pass', 'inherit_pass']
-            n_dict = dict()
-            for i in range(0, 6):
-                n_dict[indices[i]] = (perm[i] == standard[i])
-            self.permissions[usr] = n_dict
+            self.permissions = self.permissions.set(sys.intern(usr), mask)
             return True
 
         def chmod_all(self, perms):
             """ Change all permissions using a dict() of the file. """
-            self.permissions = dict()
-            for usr in perms:
-                if not self.chmod(usr, perms[usr]):
-                    return None
+            self.permissions = Filesystem.fsACL.get(perms)
             return self.permissions
 
         def fmtmod(self):
             """ Return formatted permissions of the file. """
-            fmt_res = dict()
-            for usr in self.permissions:
-                fmt_res[usr] = '%s%s%s%s%s%s' % (
-                    'r' if self.permissions[usr]['read'] else '-',
-                    'w' if self.permissions[usr]['write'] else '-',
-                    'x' if self.permissions[usr]['inherit'] else '-',
-                    'r' if self.permissions[usr]['read_pass'] else '-',
-                    'w' if self.permissions[usr]['write_pass'] else '-',
-                    'x' if self.permissions[usr]['inherit_pass'] else '-'
-                )
-            return fmt_res
+            return dict(self.permissions.fmt_dict)
 
         def fmtmod_list(self):
-            """ Return (listized) formatted permissions of the file. """
-            fml = self.fmtmod()
-            res = list()
-            for usr in fml:
-                res.append([usr, fml[usr]])
-            return res
+            """ Return (listized) formatted permissions of the file. The list
+            is shared with the ACL and must not be modified. """
+            return self.permissions.fmt_list
 
         def inherit_parmod(self, usr):
             """ Inherit permissions of 'usr' from parent. """
@@ -147,14 +231,11 @@ class Filesystem:
                 return False
             if usr not in self.parent.permissions:
                 return False
-            self.permissions[usr] = dict()
-            if self.parent.permissions[usr]['inherit_pass']:
-                for s in {'read', 'write', 'inherit'}:
-                    self.permissions[usr][s] = self.parent.permissions[usr]['%s_pass' % s]
-                    self.permissions[usr]['%s_pass' % s] = self.parent.permissions[usr]['%s_pass' % s]
-            else:
-                for s in {'read', 'write', 'inherit', 'read_pass', 'write_pass', 'inherit_pass'}:
-                    self.permissions[usr][s] = self.parent.permissions[usr][s]
+            p_mask = self.parent.permissions[usr]
+            if p_mask & Filesystem.fsACL.bits['inherit_pass']:
+                # Passed properties become the properties themselves
+                p_mask = (p_mask >> 3) | (p_mask & 0o70)
+            self.permissions = self.permissions.set(usr, p_mask)
             return True
 
         def inherit_parmod_all(self):
@@ -168,13 +249,21 @@ class Filesystem:
 
         pass
 
-    def __init__(self, database=None, filestorage=None, utils_package=None):
+    def __init__(self, database=None, filestorage=None, utils_package=None, lazy_load=False, resident_nodes=1000000, snapshot=None):
         """ Load files from database, must specify these options or will revoke
         AttributeError:
 
             database = The database
             filestorage = The file storage which holds handles for files
 
+        If 'lazy_load' is set, only the root is loaded upon start, and other
+        directories are loaded when first accessed. Directories that are least
+        recently loaded or listed are unloaded when more than 'resident_nodes'
+        nodes are in memory.
+
+        If 'snapshot' is given, the tree is restored from the decoded snapshot
+        instead of the database.
+
         Should return nothing elsewise. """
         if not database:
             raise AttributeError('Must provide database')
@@ -187,151 +276,338 @@ class Filesystem:
         self.fs_db       = database
         self.fs_store    = filestorage
         self.utils_pkg   = utils_package
+        self.fs_lazy     = lazy_load
+        self.fs_resident = resident_nodes
+        self.fs_lru      = collections.OrderedDict() # uuid -> loaded directory
+        self.fs_lru_lock = threading.RLock()
+        self.fs_lock     = None # Tree locks, nodes locked are never unloaded
+        self.fs_acl_gen  = 0 # Increased when permissions of existing nodes may change
+        # Moving trees stored in the legacy format into one row per node.
+        if self.fs_db.execute("SELECT to_regclass('file_system');")[0][0]:
+            self.__migrate_legacy_tree()
+        if self.fs_lazy:
+            self.__load_root()
+            return
+        if snapshot:
+            self.__load_snapshot(snapshot)
+            return
         # Testforing items in database for building tree.
-        for item in self.fs_db.execute("SELECT uuid, file_name, owner, permissions, upload_time, sub_folders, sub_files FROM file_system"):
+        n_parents = dict()
+        n_missing = list()
+        for item in self.fs_db.execute("SELECT uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid FROM file_system_node;"):
             # Splitting tuple into parts
-            uuid, file_name, owner, permissions__, upload_time, sub_folders, sub_files = item
+            uuid, parent_uuid, file_name, is_dir, owner, permissions__, upload_time, f_uuid = item
             permissions = dict()
             for lst in permissions__:
                 permissions[lst[0]] = lst[1]
-            # Getting sub files which are expensive stored separately
-            n_sub_files = set()
-            for fil_idx in sub_files:
-                # This is where the order goes, BEAWARE
-                s_uuid = fil_idx[0]
-                s_file_name = fil_idx[1]
-                s_owner = fil_idx[2]
-                # Set permissions
-                s_permissions = dict()
-                for lst in list(fr.split('/') for fr in fil_idx[3].split(';')):
-                    s_permissions[lst[0]] = lst[1]
-                # Set upload time
-                try:
-                    s_upload_time = float(fil_idx[4])
-                except:
-                    s_upload_time = self.utils_pkg.get_current_time()
-                # File UUID uploading
-                s_f_uuid = uuid_package.UUID(fil_idx[5])
-                if s_f_uuid not in self.fs_store.st_uuid_idx:
-                    continue
-                # Pushing into structure...
-                s_file = self.fsNode(is_dir=False, file_name=s_file_name, owner=s_owner, permissions=s_permissions, uuid=s_uuid, upload_time=s_upload_time, f_uuid=s_f_uuid, master=self)
-                n_sub_files.add(s_file)
-                self.fs_uuid_idx[s_uuid] = s_file
-            # Getting sub folders as a set but not templating them
-            n_sub_folders = set() # Since reference is passed, should not manipulate this further
-            for fol_idx in sub_folders:
-                n_sub_folders.add(fol_idx)
-            fold_elem = self.fsNode(is_dir=True, file_name=file_name, owner=owner, permissions=permissions, uuid=uuid, upload_time=upload_time, sub_folders=n_sub_folders, sub_files=n_sub_files, master=self)
-            self.fs_uuid_idx[uuid] = fold_elem
+            # Files without content would not be loaded
+            if not is_dir and f_uuid not in self.fs_store.st_uuid_idx:
+                n_missing.append(uuid)
+                continue
+            n_node = self.fsNode(is_dir=is_dir, file_name=file_name, owner=owner, permissions=permissions, uuid=uuid, upload_time=upload_time, f_uuid=f_uuid, master=self)
+            n_parents[n_node] = parent_uuid
+        # Their rows are deleted, so that their names could be taken again
+        if n_missing:
+            self.fs_db.execute("DELETE FROM file_system_node WHERE uuid = ANY(%s);", (n_missing,), fetch_func=None)
         # Done importing from SQL database, now attempting to refurbish connexions
-        for uuid in self.fs_uuid_idx:
-            item = self.fs_uuid_idx[uuid]
-            if not item.is_dir:
+        for item in n_parents:
+            parent_uuid = n_parents[item]
+            if parent_uuid is None:
+                if item.is_dir and not self.fs_root:
+                    self.fs_root = item
                 continue
-            # Asserted that it was a folder.
-            for n_sub in item.sub_files:
-                item.sub_items.add(n_sub)
-                item.sub_names_idx[n_sub.file_name] = n_sub
-            for n_sub_uuid in item.sub_folders:
-                try:
-                    n_sub = self.fs_uuid_idx[n_sub_uuid]
-                    item.sub_items.add(n_sub)
-                    item.sub_names_idx[n_sub.file_name] = n_sub
-                except Exception:
-                    pass
-            del item.sub_files
-            del item.sub_folders
-        # Fixing parental occlusions
-        def iterate_fsnode(node):
-            for item in node.sub_items:
-                if item.parent:
-                    continue
-                # Never iterated before
-                item.parent = node
-                iterate_fsnode(item)
-            return
-        for uuid in self.fs_uuid_idx: # This would fix all nodes...
-            item = self.fs_uuid_idx[uuid]
-            iterate_fsnode(item)
-        # Finding root and finishing parent connexions
-        for uuid in self.fs_uuid_idx: # Takes the first element that ever occured to me
-            item = self.fs_uuid_idx[uuid]
-            while item.parent:
-                item = item.parent
-            self.fs_root = item
-            break
-        else:
+            par = self.fs_uuid_idx.get(parent_uuid, None)
+            if not par or not par.is_dir:
+                continue
+            item.parent = par
+            par.sub_items.add(item)
+            par.sub_names_idx[item.file_name] = item
+        # Nodes that could not be reached from root are dropped
+        for item in n_parents:
+            p_nd = item
+            while p_nd.parent:
+                p_nd = p_nd.parent
+            if p_nd != self.fs_root:
+                del self.fs_uuid_idx[item.uuid]
+        # Finding root
+        if not self.fs_root:
             self.__make_root()
-        # Traversing root for filename indexing
-        def iterate_node_fn(node):
-            for item in node.sub_items:
-                node.sub_names_idx[item.file_name]
         # All done, finished initialization
         return
 
+    def __load_snapshot(self, snap):
+        """ Restore the whole tree from a decoded snapshot. Nodes are created
+        without __init__(), as their attributes are already resolved, and the
+        ACL of each distinct set is parsed only once. """
+        perm_sets = list(self.fsACL.get(dict(perms)) for perms in snap.perms)
+        strings = list(sys.intern(s) for s in snap.strings)
+        nodes = list()
+        for idx in range(0, len(snap.node_uuids)):
+            n_node = self.fsNode.__new__(self.fsNode)
+            n_node.master = self
+            n_node.uuid = snap.node_uuids[idx]
+            n_node.is_dir = snap.node_is_dir[idx] == 1
+            n_node.file_name = strings[snap.node_names[idx]]
+            n_node.owner = strings[snap.node_owners[idx]]
+            n_node.permissions = perm_sets[snap.node_perms[idx]]
+            n_node.upload_time = snap.node_times[idx]
+            if n_node.is_dir:
+                n_node.f_uuid = None
+                n_node._sub_items = set()
+                n_node._sub_names = dict()
+            else:
+                n_node.f_uuid = snap.st_uuids[snap.node_files[idx]]
+                n_node._sub_items = None
+                n_node._sub_names = None
+            # Parents always come before children
+            par_idx = snap.node_parents[idx]
+            if par_idx >= 0:
+                par = nodes[par_idx]
+                n_node.parent = par
+                par._sub_items.add(n_node)
+                par._sub_names[n_node.file_name] = n_node
+            else:
+                n_node.parent = None
+            nodes.append(n_node)
+            self.fs_uuid_idx[n_node.uuid] = n_node
+        self.fs_root = nodes[0]
+        return
+
+    def __bump_generation(self):
+        """ Mark the tree as changed, so that older snapshots would not be
+        loaded. Sequences are not rolled back, which would only make a
+        snapshot look older than it is. """
+        self.fs_db.execute("SELECT nextval('sqlfs_generation');", fetch_func=None)
+        return
+
+    def __bump_acl_generation(self):
+        """ Mark permissions of existing nodes as changed, which invalidates
+        cached permissions. """
+        self.fs_acl_gen += 1
+        return
+
+    def __make_fsnode(self, item):
+        """ Create a node from a row of 'file_system_node', returns None if the
+        node should not be loaded. """
+        uuid, parent_uuid, file_name, is_dir, owner, permissions__, upload_time, f_uuid = item
+        permissions = dict()
+        for lst in permissions__:
+            permissions[lst[0]] = lst[1]
+        # Files without content would not be loaded, and their rows are deleted
+        # so that their names could be taken again
+        if not is_dir and f_uuid not in self.fs_store.st_uuid_idx:
+            self.fs_db.execute("DELETE FROM file_system_node WHERE uuid = %s;", (uuid,), fetch_func=None)
+            return None
+        return self.fsNode(is_dir=is_dir, file_name=file_name, owner=owner, permissions=permissions, uuid=uuid, upload_time=upload_time, f_uuid=f_uuid, master=self, loaded=False)
+
+    def __load_root(self):
+        """ Load only the root node, whose children are loaded on demand. """
+        for item in self.fs_db.execute("SELECT uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid FROM file_system_node WHERE parent_uuid IS NULL AND is_dir = TRUE LIMIT 1;"):
+            self.fs_root = self.__make_fsnode(item)
+        if not self.fs_root:
+            self.__make_root()
+        return
+
+    def __materialize(self, node):
+        """ Load children of directory 'node' from database. """
+        with self.fs_lru_lock:
+            if node._sub_items is not None:
+                return True
+            n_items = set()
+            n_names = dict()
+            if node.is_dir:
+                for item in self.fs_db.execute("SELECT uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid FROM file_system_node WHERE parent_uuid = %s;", (node.uuid,)):
+                    n_sub = self.__make_fsnode(item)
+                    if not n_sub:
+                        continue
+                    n_sub.parent = node
+                    n_items.add(n_sub)
+                    n_names[n_sub.file_name] = n_sub
+            node.sub_names_idx = n_names
+            node.sub_items = n_items
+            # Keep memory usage in bound
+            if len(self.fs_uuid_idx) > self.fs_resident:
+                self.__evict(node)
+        return True
+
+    def __touch(self, node):
+        """ Mark 'node' as recently used. """
+        with self.fs_lru_lock:
+            self.fs_lru[node.uuid] = node
+            self.fs_lru.move_to_end(node.uuid)
+        return
+
+    def __unload(self, item):
+        """ Forget children of directory 'item', which are loaded again from
+        database upon next access. """
+        if item._sub_items is None:
+            return
+        for i_sub in item._sub_items:
+            if i_sub.is_dir and i_sub._sub_items is not None:
+                self.__unload(i_sub)
+                self.fs_lru.pop(i_sub.uuid, None)
+            self.fs_uuid_idx.pop(i_sub.uuid, None)
+        item._sub_items = None
+        item._sub_names = None
+        return
+
+    def __evict(self, keep):
+        """ Unload children of least recently used directories, until no more
+        than 90% of 'fs_resident' nodes are in memory. Directories that are
+        locked or under a locked subtree, and ancestors of 'keep' are not
+        unloaded. """
+        target = int(self.fs_resident * 0.9)
+        kept = set()
+        p_nd = keep
+        while p_nd:
+            kept.add(p_nd.uuid)
+            p_nd = p_nd.parent
+        for uuid in list(self.fs_lru):
+            if len(self.fs_uuid_idx) <= target:
+                break
+            item = self.fs_lru.get(uuid, None)
+            if not item or uuid in kept:
+                continue
+            if self.fs_lock and self.fs_lock.pinned(item):
+                continue
+            self.__unload(item)
+            del self.fs_lru[uuid]
+        return
+
+    def __revert(self, node, state):
+        """ Put back attributes 'state' of 'node', and forget its children so
+        that they are loaded from database again, as changes made to them in
+        memory were rolled back in database. Nodes no longer in the tree are
+        left alone, as their parent would be loaded again. """
+        with self.fs_lru_lock:
+            if self.fs_uuid_idx.get(node.uuid, None) is not node:
+                return
+            node.owner, node.permissions, node.upload_time = state
+            if node.is_dir:
+                self.__unload(node)
+                self.fs_lru.pop(node.uuid, None)
+        self.__bump_acl_generation()
+        return
+
+    def __revert_on_rollback(self, *paths):
+        """ Revert nodes of 'paths' to how they are now if the transaction is
+        rolled back. The nodes must be locked for writing until the transaction
+        ends, and only they and their subtrees may be changed meanwhile. """
+        for path in paths:
+            node = self.__locate(path)
+            if node:
+                state = (node.owner, node.permissions, node.upload_time)
+                self.fs_db.on_rollback(lambda node=node, state=state: self.__revert(node, state))
+        return
+
+    def __parent_of(self, path):
+        """ Parent of the node of 'path', or the node itself if it is the
+        root. """
+        node = self.__locate(path)
+        return node.parent if node and node.parent else node
+
+    def __restore_root(self, root):
+        """ Put back 'root', which had been removed and replaced. """
+        with self.fs_lru_lock:
+            if self.fs_root is not root:
+                self.__unload(self.fs_root)
+                self.fs_uuid_idx.pop(self.fs_root.uuid, None)
+            self.fs_root = root
+            self.fs_uuid_idx[root.uuid] = root
+        return
+
+    def __migrate_legacy_tree(self, batch_size=1000):
+        """ Move the tree stored in the legacy 'file_system' table, where each
+        directory row holds arrays of its sub-folders and sub-files, into the
+        'file_system_node' table with one row per node. The migration works in
+        batches of 'batch_size' directories, each of which in a transaction and
+        could be safely run again, so an interrupted migration would simply be
+        resumed on next start. The legacy table is renamed as
+        'file_system_legacy' afterwards. """
+        print('Migrating SQLFS tree into one row per node.')
+        rows = self.fs_db.execute("SELECT uuid, file_name, owner, permissions, upload_time, sub_folders, sub_files FROM file_system;")
+        # Directories only know their children, so find out their parents first
+        n_parents = dict()
+        for item in rows:
+            for fol_idx in item[5] or []:
+                n_parents[fol_idx] = item[0]
+        for b_idx in range(0, len(rows), batch_size):
+            with self.fs_db.transaction():
+                for item in rows[b_idx:b_idx + batch_size]:
+                    uuid, file_name, owner, permissions, upload_time, sub_folders, sub_files = item
+                    self.fs_db.execute("INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid) VALUES (%s, %s, %s, TRUE, %s, %s, %s, NULL) ON CONFLICT DO NOTHING;", (uuid, n_parents.get(uuid, None), file_name, owner, permissions, upload_time), fetch_func=None)
+                    for fil_idx in sub_files or []:
+                        # This is where the order goes, BEAWARE
+                        s_uuid = uuid_package.UUID(fil_idx[0])
+                        s_file_name = fil_idx[1]
+                        s_owner = fil_idx[2]
+                        s_permissions = list(fr.split('/') for fr in fil_idx[3].split(';'))
+                        try:
+                            s_upload_time = float(fil_idx[4])
+                        except:
+                            s_upload_time = self.utils_pkg.get_current_time()
+                        s_f_uuid = uuid_package.UUID(fil_idx[5])
+                        self.fs_db.execute("INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid) VALUES (%s, %s, %s, FALSE, %s, %s, %s, %s) ON CONFLICT DO NOTHING;", (s_uuid, uuid, s_file_name, s_owner, s_permissions, s_upload_time, s_f_uuid), fetch_func=None)
+                pass
+        self.fs_db.execute("ALTER TABLE file_system RENAME TO file_system_legacy;", fetch_func=None)
+        print('Migrated %d directories.' % len(rows))
+        return
+
     def __sqlify_fsnode(self, item):
         """ Turns a node into SQL-compatible node. """
         n_uuid = item.uuid
+        n_parent_uuid = item.parent.uuid if item.parent else None
         n_file_name = item.file_name
+        n_is_dir = item.is_dir
         n_owner = item.owner
         n_permissions = item.fmtmod_list()
         n_upload_time = item.upload_time
-        n_sub_folders = list()
-        n_sub_files = list()
-        for i_sub in item.sub_items:
-            if i_sub.is_dir:
-                n_sub_folders.append(i_sub.uuid)
-            else:
-                n_sub_files.append([
-                    str(i_sub.uuid),
-                    str(i_sub.file_name),
-                    str(i_sub.owner),
-                    ';'.join('/'.join(fr) for fr in i_sub.fmtmod_list()),
-                    "%f" % i_sub.upload_time,
-                    str(i_sub.f_uuid)
-                ])
+        n_f_uuid = None if item.is_dir else item.f_uuid
         # Formatting string
-        return (n_uuid, n_file_name, n_owner, n_permissions, n_upload_time, n_sub_folders, n_sub_files)
+        return (n_uuid, n_parent_uuid, n_file_name, n_is_dir, n_owner, n_permissions, n_upload_time, n_f_uuid)
 
     def __update_in_db(self, item):
-        """ Push updating commit to Database for changes. Does not affect
-        nonexistent nodes in Database. Otherwise please use __insert_in_db().
-
-        Operation would not be redirected to insertion because of recursive
-        risks that could potentially damage and overflow the process. """
-        # This applies to items in the
+        """ Push updating commit to Database for changes of the node itself,
+        which are its name, parent, owner, permissions and upload time. Does not
+        affect nonexistent nodes in Database. Otherwise please use
+        __insert_in_db(). """
         # We assert that item should be Node.
         item = self.__locate(item)
         if not item:
             return False
-        # Giving a few but crucial assertions...
-        if not item.is_dir:
-            item = item.parent
-            if not item.is_dir:
-                return False # I should raise, by a matter of fact
         # Collecting data
-        n_uuid, n_file_name, n_owner, n_permissions, n_upload_time, n_sub_folders, n_sub_files = self.__sqlify_fsnode(item)
-        # Uploading / committing data
-        if not self.fs_db.execute("SELECT uuid FROM file_system WHERE uuid = %s;", (n_uuid,)):
-            return False # You already stated this is an updating operation!
-        self.fs_db.execute("UPDATE file_system SET file_name = %s, owner = %s, permissions = %s, upload_time = %s, sub_folders = %s, sub_files = %s WHERE uuid = %s;", (n_file_name, n_owner, n_permissions, n_upload_time, n_sub_folders, n_sub_files, n_uuid))
+        n_uuid, n_parent_uuid, n_file_name, n_is_dir, n_owner, n_permissions, n_upload_time, n_f_uuid = self.__sqlify_fsnode(item)
+        # Uploading / committing data, nonexistent rows are left untouched.
+        self.fs_db.execute("UPDATE file_system_node SET parent_uuid = %s, file_name = %s, owner = %s, permissions = %s, upload_time = %s WHERE uuid = %s;", (n_parent_uuid, n_file_name, n_owner, n_permissions, n_upload_time, n_uuid), fetch_func=None)
         return True
 
     def __insert_in_db(self, item):
-        """ Create filesystem record of directory 'item' inside database. You
+        """ Create filesystem record of node 'item' inside database. You
         should not insert something that already existed. However:
 
         We have had a precaution for this. Update operations would be taken
         automatically instead. """
-        if not item.is_dir:
-            return False # Must be directory...
-        n_uuid, n_file_name, n_owner, n_permissions, n_upload_time, n_sub_folders, n_sub_files = self.__sqlify_fsnode(item)
+        n_uuid, n_parent_uuid, n_file_name, n_is_dir, n_owner, n_permissions, n_upload_time, n_f_uuid = self.__sqlify_fsnode(item)
         # Uploading / committing data
-        if self.fs_db.execute("SELECT uuid FROM file_system WHERE uuid = %s;", (n_uuid,)):
-            return self.__update_in_db(item) # Existed, updating instead.
-        self.fs_db.execute("INSERT INTO file_system (uuid, file_name, owner, permissions, upload_time, sub_folders, sub_files) VALUES (%s, %s, %s, %s, %s, %s, %s);", (n_uuid, n_file_name, n_owner, n_permissions, n_upload_time, n_sub_folders, n_sub_files))
-        return
+        self.fs_db.execute("""
+            INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (uuid) DO UPDATE SET
+                    parent_uuid = EXCLUDED.parent_uuid,
+                    file_name = EXCLUDED.file_name,
+                    owner = EXCLUDED.owner,
+                    permissions = EXCLUDED.permissions,
+                    upload_time = EXCLUDED.upload_time;""",
+            (n_uuid, n_parent_uuid, n_file_name, n_is_dir, n_owner, n_permissions, n_upload_time, n_f_uuid),
+            fetch_func=None)
+        return True
+
+    def __remove_in_db(self, uuids):
+        """ Remove records of all nodes in 'uuids' from database. """
+        if not uuids:
+            return True
+        self.fs_db.execute("DELETE FROM file_system_node WHERE uuid = ANY(%s);", (list(uuids),), fetch_func=None)
+        return True
 
     def __make_root(self):
         """ Create root that didn't exist before. """
@@ -346,24 +622,18 @@ class Filesystem:
         large_set = {itm_system, itm_public, itm_groups, itm_users}
         # Inserting into SQL database
         # Creating root
-        del itm_root.sub_files
-        del itm_root.sub_folders
         itm_root.sub_items = set()
         itm_root.sub_names_idx = dict()
         itm_root.parent = None
         self.fs_root = itm_root
         # Create system folders
         for item in large_set:
-            del item.sub_files
-            del item.sub_folders
             item.sub_items = set()
             item.sub_names_idx = dict()
             itm_root.sub_items.add(item)
             itm_root.sub_names_idx[item.file_name] = item
             item.parent = itm_root
         # Create kernel's user folder
-        del itm_kernel_folder.sub_files
-        del itm_kernel_folder.sub_folders
         itm_kernel_folder.sub_items = set()
         itm_kernel_folder.sub_names_idx = dict()
         itm_kernel_folder.parent = itm_users
@@ -374,6 +644,7 @@ class Filesystem:
         for item in large_set:
             self.__insert_in_db(item)
         self.__insert_in_db(itm_kernel_folder)
+        self.__bump_generation()
         return
 
     def __locate(self, path, parent=None):
@@ -456,24 +727,35 @@ class Filesystem:
         # This should never happen!
         return file_name
 
-    def __mkfile(self, path_parent, file_name, owner, content_stream):
+    def __mkfile(self, path_parent, file_name, owner, content_stream=None, f_hash=None, f_size=0):
         """ Inject object into filesystem, while passing in content. The content
-        itself would be indexed in FileStorage. """
+        itself would be indexed in FileStorage. If no content is given, the
+        file refers to existing content of 'f_hash' and 'f_size' instead. """
         path_parent = self.__locate(path_parent)
-        if not path_parent:
+        if not path_parent or not path_parent.is_dir:
             return False
+        if not content_stream:
+            f_uuid = self.fs_store.find_unique_file(f_hash, f_size)
+            if not f_uuid:
+                return False
         # Create an environment-friendly file name
         file_name = self.__make_nice_filename(file_name)
         file_name = self.__resolve_conflict(file_name, path_parent)
         # Finished assertion.
-        n_uuid = self.fs_store.new_unique_file(content_stream)
+        if content_stream:
+            n_uuid = self.fs_store.new_unique_file(content_stream)
+        else:
+            n_uuid = f_uuid
+            # Might have been removed by another transaction meanwhile
+            if not self.fs_store.add_unique_file(n_uuid):
+                return False
         n_fl = self.fsNode(is_dir=False, file_name=file_name, owner=owner, permissions={'':'--x--x',owner:'rwxrwx'}, f_uuid=n_uuid, master=self)
         # Updating tree connexions
         n_fl.parent = path_parent
         n_fl.inherit_parmod_all()
         path_parent.sub_items.add(n_fl)
         path_parent.sub_names_idx[file_name] = n_fl
-        self.__update_in_db(path_parent)
+        self.__insert_in_db(n_fl)
         # Indexing and return
         self.fs_uuid_idx[n_fl.uuid] = n_fl
         return True
@@ -481,7 +763,7 @@ class Filesystem:
     def __mkdir(self, path_parent, file_name, owner):
         """ Inject folder into filesystem. """
         path_parent = self.__locate(path_parent)
-        if not path_parent:
+        if not path_parent or not path_parent.is_dir:
             return False
         # Create an environment-friendly file name
         file_name = self.__make_nice_filename(file_name)
@@ -493,7 +775,6 @@ class Filesystem:
         n_fl.inherit_parmod_all()
         path_parent.sub_items.add(n_fl)
         path_parent.sub_names_idx[file_name] = n_fl
-        self.__update_in_db(path_parent)
         self.__insert_in_db(n_fl)
         # Indexing and return
         self.fs_uuid_idx[n_fl.uuid] = n_fl
@@ -505,6 +786,7 @@ class Filesystem:
 
             file-name   - File name
             file-size   - File size
+            file-hash   - Hash of the content, None for directories
             is-dir      - Whether is directory
             owner       - The handle of the owner
             permissions - The permissions of the file
@@ -515,6 +797,9 @@ class Filesystem:
         path = self.__locate(path)
         if not path:
             return []
+        # Walks through directories do not count as use, listings do
+        if self.fs_lazy and path.is_dir:
+            self.__touch(path)
         # List directory, given the list(dict()) result...
         dirs = list()
         for item in path.sub_items:
@@ -522,6 +807,7 @@ class Filesystem:
             try:
                 attrib['file-name'] = item.file_name
                 attrib['file-size'] = 0 if item.is_dir else self.fs_store.st_uuid_idx[item.f_uuid].size
+                attrib['file-hash'] = None if item.is_dir else self.fs_store.st_uuid_idx[item.f_uuid].hash
                 attrib['is-dir'] = item.is_dir
                 attrib['owner'] = item.owner
                 attrib['permissions'] = item.fmtmod()
@@ -542,6 +828,23 @@ class Filesystem:
             return file_stream.EmptyFileStream
         return self.fs_store.get_content(item.f_uuid)
 
+    def __stat(self, item):
+        """ Attributes of the file 'item', the same as of __listdir(), or None
+        if it is not a file. """
+        item = self.__locate(item)
+        if not item or item.is_dir or item.f_uuid not in self.fs_store.st_uuid_idx:
+            return None
+        s_fl = self.fs_store.st_uuid_idx[item.f_uuid]
+        return {
+            'file-name': item.file_name,
+            'file-size': s_fl.size,
+            'file-hash': s_fl.hash,
+            'is-dir': False,
+            'owner': item.owner,
+            'permissions': item.fmtmod(),
+            'upload-time': item.upload_time,
+        }
+
     def __copy_recursive(self, item, new_owner):
         """ Copies content of a single object and recursively call all its
         children for recursive copy, targeted as a child under target_par. """
@@ -561,9 +864,8 @@ class Filesystem:
         if new_owner:
             item.owner = new_owner # Assignment
         # These are to maintain tree structures or relations
-        if item.is_dir:
-            self.__insert_in_db(item)
-        else:
+        self.__insert_in_db(item)
+        if not item.is_dir:
             self.fs_store.add_unique_file(item.f_uuid)
         return
 
@@ -574,7 +876,7 @@ class Filesystem:
         functions separatedly. """
         source = self.__locate(source)
         target_parent = self.__locate(target_parent)
-        if not source or not target_parent:
+        if not source or not target_parent or not target_parent.is_dir:
             return False if not return_handle else None
         if self.__is_child(target_parent, source):
             return False if not return_handle else None
@@ -588,8 +890,6 @@ class Filesystem:
         target_parent.sub_items.add(target)
         target_parent.sub_names_idx[target.file_name] = target
         self.__copy_recursive(target, new_owner)
-        # Assigning and finishing tree connexions
-        self.__update_in_db(target_parent)
         return True if not return_handle else target
 
     def __move(self, source, target_parent, return_handle=False):
@@ -599,7 +899,7 @@ class Filesystem:
         executed. """
         source = self.__locate(source)
         target_parent = self.__locate(target_parent)
-        if not source or not target_parent:
+        if not source or not target_parent or not target_parent.is_dir:
             return False if not return_handle else None
         # It should not move itself to itself.
         if source.parent == target_parent:
@@ -618,22 +918,22 @@ class Filesystem:
         source.parent = target_parent
         target_parent.sub_items.add(source)
         target_parent.sub_names_idx[source.file_name] = source
-        # Updating SQL database.
-        self.__update_in_db(par)
-        self.__update_in_db(target_parent)
+        # Updating SQL database, only the moved node itself had changed.
+        self.__update_in_db(source)
+        self.__bump_acl_generation() # Ancestors had changed
         return True if not return_handle else source
 
-    def __remove_recursive(self, item):
+    def __remove_recursive(self, item, removed):
         """ Removes content of a single object and recursively call all its
-        children for recursive removal. """
+        children for recursive removal. UUIDs of removed nodes are collected in
+        'removed' to be deleted from SQL database in one go. """
         # We assert item is fsNode().
         # Remove recursively.
         for i_sub in item.sub_items:
-            self.__remove_recursive(i_sub)
+            self.__remove_recursive(i_sub, removed)
         # Delete itself from filesystem.
         del self.fs_uuid_idx[item.uuid]
-        # Delete itself from SQL database.
-        self.fs_db.execute("DELETE FROM file_system WHERE uuid = %s;", (item.uuid,))
+        removed.append(item.uuid)
         # Also delete occurence if is file.
         if not item.is_dir:
             self.fs_store.remove_unique_file(item.f_uuid)
@@ -647,13 +947,15 @@ class Filesystem:
             return False
         # Done assertion, path is now fsNode().
         par = path.parent
-        self.__remove_recursive(path)
+        removed = list()
+        self.__remove_recursive(path, removed)
+        self.__remove_in_db(removed)
         if par:
             par.sub_items.remove(path)
             del par.sub_names_idx[path.file_name]
-            self.__update_in_db(par)
         # There always should be a root.
         if path == self.fs_root:
+            self.fs_db.on_rollback(lambda: self.__restore_root(path))
             self.__make_root()
         # Done removal.
         return True
@@ -672,9 +974,7 @@ class Filesystem:
         del item.parent.sub_names_idx[item.file_name]
         item.file_name = file_name
         item.parent.sub_names_idx[item.file_name] = item
-        if item.is_dir:
-            self.__update_in_db(item)
-        self.__update_in_db(item.parent) # At least there is a parent
+        self.__update_in_db(item)
         return True
 
     def __chown(self, item, owner):
@@ -686,12 +986,9 @@ class Filesystem:
             for sub_ in item_.sub_items:
                 _chown_recursive(sub_, owner_)
             item_.chown(owner_)
-            if item_.is_dir:
-                self.__update_in_db(item_)
+            self.__update_in_db(item_)
             return
         _chown_recursive(item, owner)
-        if not item.is_dir:
-            self.__update_in_db(item.parent)
         return True
 
     def __chmod(self, item, perm):
@@ -699,27 +996,33 @@ class Filesystem:
         item = self.__locate(item)
         if not item:
             return False
-        # Parse permission information
-        ret = item.chmod_all(perm)
-        if not item.is_dir:
-            self.__update_in_db(item.parent)
-        else:
-            self.__update_in_db(item)
-        return ret
+        # Parse permission information, replacing the ACL as a whole
+        acl = self.fsACL.get(perm)
+        if acl is None:
+            return False
+        item.permissions = acl
+        self.__update_in_db(item)
+        self.__bump_acl_generation()
+        return True
 
     def __chmod_recursive(self, item, perm):
         """ Recursively change permissions. """
         item = self.__locate(item)
         if not item:
             return False
-        # Done assertion.
-        result = True
-        def _rec_work(item_, perm_):
+        acl = self.fsACL.get(perm)
+        if acl is None:
+            return False
+        # Done assertion, all nodes share the same ACL.
+        def _rec_work(item_):
             for i_sub in item_.sub_items:
                 _rec_work(i_sub)
-            result = result and self.__chmod(item_, perm_)
-        _rec_work(item, perm)
-        return result
+            item_.permissions = acl
+            self.__update_in_db(item_)
+            return
+        _rec_work(item)
+        self.__bump_acl_generation()
+        return True
 
     def __shell(self):
         cwd = self.fs_root
@@ -733,7 +1036,10 @@ class Filesystem:
             op = cmd[0]
             if op == 'db':
                 db_cmd = cmd_input.split(' ', 1)[1] or ''
-                res = self.fs_db.execute(db_cmd)
+                try:
+                    res = self.fs_db.execute(db_cmd)
+                except Exception as err:
+                    res = err
                 print(res)
             elif op == 'ls':
                 res = self.list_directory(cwd)
@@ -813,17 +1119,49 @@ class Filesystem:
 
     def update_in_db(self, node):
         """ Update a node status in the filesystem. """
-        return self.__update_in_db(node)
+        self.__revert_on_rollback(node)
+        ret_result = self.__update_in_db(node)
+        self.__bump_generation()
+        self.__bump_acl_generation()
+        return ret_result
+
+    def materialize(self, node):
+        """ Load children of 'node' from database if not loaded. """
+        ret_result = self.__materialize(node)
+        return ret_result
+
+    def touch(self, node):
+        """ Mark 'node' as recently used, so it would be the last to be
+        unloaded. """
+        self.__touch(node)
+        return
+
+    def bind_lock(self, fs_lock):
+        """ Use tree locks 'fs_lock' to tell which nodes are in use. """
+        self.fs_lock = fs_lock
+        return
 
     def create_file(self, path_parent, file_name, owner, content_stream):
         """ Inject object into filesystem, while passing in content. The content
         itself would be indexed in FileStorage. """
+        self.__revert_on_rollback(path_parent)
         ret_result = self.__mkfile(path_parent, file_name, owner, content_stream)
+        self.__bump_generation()
+        return ret_result
+
+    def create_file_by_hash(self, path_parent, file_name, owner, f_hash, f_size):
+        """ Inject object into filesystem with content already in FileStorage,
+        given its hash and size. Returns False if no such content exists. """
+        self.__revert_on_rollback(path_parent)
+        ret_result = self.__mkfile(path_parent, file_name, owner, f_hash=f_hash, f_size=f_size)
+        self.__bump_generation()
         return ret_result
 
     def create_directory(self, path_parent, file_name, owner):
         """ Create directory under path_parent into filesystem. """
+        self.__revert_on_rollback(path_parent)
         ret_result = self.__mkdir(path_parent, file_name, owner)
+        self.__bump_generation()
         return ret_result
 
     def copy(self, source, target_parent, new_owner=None):
@@ -831,12 +1169,16 @@ class Filesystem:
         that was copied under the node 'target_parent'. Destination can be the
         same as source folder. If rename required please call the related
         functions separatedly. """
+        self.__revert_on_rollback(target_parent)
         ret_result = self.__copy(source, target_parent, new_owner=new_owner)
+        self.__bump_generation()
         return ret_result
 
     def copy_with_handle(self, source, target_parent, new_owner=None):
         """ Same as copy(), returns HANDLE or None. """
+        self.__revert_on_rollback(target_parent)
         ret_result = self.__copy(source, target_parent, new_owner=new_owner, return_handle=True)
+        self.__bump_generation()
         return ret_result
 
     def move(self, source, target_parent):
@@ -844,28 +1186,38 @@ class Filesystem:
         that was moved under the node 'target_parent'. Destination should not
         at all be the same as source folder, otherwise operation would not be
         executed. """
+        self.__revert_on_rollback(self.__parent_of(source), target_parent)
         ret_result = self.__move(source, target_parent)
+        self.__bump_generation()
         return ret_result
 
     def move_with_handle(self, source, target_parent):
         """ Same as move(), returns HANDLE or None. """
+        self.__revert_on_rollback(self.__parent_of(source), target_parent)
         ret_result = self.__move(source, target_parent, return_handle=True)
+        self.__bump_generation()
         return ret_result
 
     def remove(self, path):
         """ Removes (recursively) all content of the folder / file itself and
         all its subdirectories. """
+        self.__revert_on_rollback(self.__parent_of(path))
         ret_result = self.__remove(path)
+        self.__bump_generation()
         return ret_result
 
     def rename(self, path, file_name):
         """ Renames object 'path' into file_name. """
+        self.__revert_on_rollback(self.__parent_of(path))
         ret_result = self.__rename(path, file_name)
+        self.__bump_generation()
         return ret_result
 
     def change_ownership(self, path, owner):
         """ Assign owner of 'path' to new owner, recursively. """
+        self.__revert_on_rollback(path)
         ret_result = self.__chown(path, owner)
+        self.__bump_generation()
         return ret_result
 
     def change_permissions(self, path, permissions, recursive=False):
@@ -883,16 +1235,19 @@ class Filesystem:
             directory.
         In 'write' mode, sub_files would not be writable if and only if it
             itself is not writable or its parent does not allow its writing. """
+        self.__revert_on_rollback(path)
         if not recursive:
             ret_result = self.__chmod(path, permissions)
         else:
             ret_result = self.__chmod_recursive(path, permissions)
+        self.__bump_generation()
         return ret_result
 
     def expunge_user_ownership(self, handle):
         """ Must only be called from kernel / system, used when removing a
         usergroup or a user. Its ownership is expunged from the system, and
         replaced by the file node's parent. """
+        self.__revert_on_rollback(self.fs_root)
         root = self.fs_root
         def __exp_uown(node, handle):
             for sub in node.sub_items:
@@ -908,6 +1263,8 @@ class Filesystem:
                 self.__update_in_db(node)
             pass
         __exp_uown(root, handle)
+        self.__bump_generation()
+        self.__bump_acl_generation()
         return
 
     def list_directory(self, path):
@@ -931,6 +1288,17 @@ class Filesystem:
         ret_result = self.__get_content(path)
         return ret_result
 
+    def stat(self, path):
+        """ Gets attributes of the file 'path', including the hash of its
+        content, or None if it is not a file. """
+        ret_result = self.__stat(path)
+        return ret_result
+
+    def bump_generation(self):
+        """ Mark the tree as changed outside of the exported functions. """
+        self.__bump_generation()
+        return
+
     def shell(self):
         """ Interactive shell for manipulating SQLFS. May be integrated into
         other utilites in the (far) futuure. Possible commands are:
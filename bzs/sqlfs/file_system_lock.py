@@ -0,0 +1,204 @@
+
+import collections
+import threading
+
+class FilesystemLock:
+    """ Hierarchical reader-writer locks over the nodes of SQLFS. Readers take
+    shared (S) locks on the nodes they look into, writers take exclusive (X)
+    locks on the nodes whose subtrees they change. Every ancestor of a locked
+    node is locked with an intention lock (IS / IX), so that a lock on a node
+    covers its whole subtree while unrelated subtrees stay available:
+
+                IS    IX    S     X
+            IS  yes   yes   yes   no
+            IX  yes   yes   no    no
+            S   yes   no    yes   no
+            X   no    no    no    no
+
+    All locks an operation needs are granted at once or not at all, so an
+    operation never holds some locks while waiting for others. Operations
+    waiting for locks are served in order of arrival: an operation is not
+    granted locks that conflict with those wanted by an operation waiting
+    before it, on any node, so that writers are not starved by a stream of
+    readers. The oldest waiting operation therefore only waits for locks
+    being held, which are released without waiting for anything, and
+    operations on two parents (such as move or copy) cannot deadlock each
+    other. Locks are not reentrant. """
+
+    compatible = {
+        'IS': {'IS', 'IX', 'S'},
+        'IX': {'IS', 'IX'},
+        'S':  {'IS', 'S'},
+        'X':  set(),
+    }
+
+    class LockContext:
+        """ Locks the nodes located from given paths upon entering, and returns
+        the located nodes in the order of 'shared', 'exclusive' and
+        'exclusive_parent'. Nodes that could not be located are given as None.
+        If the tree had changed while waiting for the locks, the paths are
+        located again and the locks re-acquired accordingly. """
+
+        def __init__(self, master, shared=(), exclusive=(), exclusive_parent=()):
+            self.master           = master
+            self.shared           = list(shared)
+            self.exclusive        = list(exclusive)
+            self.exclusive_parent = list(exclusive_parent)
+            self.plan             = None
+            return
+
+        def __resolve(self):
+            fs = self.master.fs
+            nodes = list(fs.locate(path) for path in self.shared + self.exclusive + self.exclusive_parent)
+            n_sh = len(self.shared)
+            n_ex = len(self.exclusive)
+            # Changing a node's name or existence requires changing its parent
+            parents = list()
+            for node in nodes[n_sh + n_ex:]:
+                parents.append(node.parent if node and node.parent else node)
+            plan = self.master.make_plan(nodes[:n_sh], nodes[n_sh:n_sh + n_ex] + parents)
+            return nodes, plan
+
+        def __enter__(self):
+            while True:
+                nodes, plan = self.__resolve()
+                self.master.acquire(plan)
+                n_nodes, n_plan = self.__resolve()
+                if n_plan == plan:
+                    self.plan = plan
+                    return n_nodes
+                self.master.release(plan)
+            return None
+
+        def __exit__(self, exc_type, exc_value, traceback):
+            self.master.release(self.plan)
+            self.plan = None
+            return False
+        pass
+
+    def __init__(self, filesystem=None):
+        if not filesystem:
+            raise AttributeError('Must provide a file system')
+        self.fs        = filesystem
+        self.cond      = threading.Condition(threading.Lock())
+        self.held      = dict() # uuid -> {mode: count}
+        self.waiting   = collections.OrderedDict() # ticket -> plan, in order of arrival
+        self.ticket    = 0
+        return
+
+    def __merge(self, mode_1, mode_2):
+        """ The weakest mode that grants both 'mode_1' and 'mode_2'. """
+        if not mode_1 or mode_1 == mode_2:
+            return mode_2
+        if not mode_2:
+            return mode_1
+        modes = {mode_1, mode_2}
+        if modes == {'IS', 'IX'}:
+            return 'IX'
+        if modes == {'IS', 'S'}:
+            return 'S'
+        # Either exclusive or shared with intention exclusive (SIX)
+        return 'X'
+
+    def __grantable(self, plan, ticket):
+        for uuid in plan:
+            held = self.held.get(uuid, None)
+            if held:
+                for h_mode in held:
+                    if h_mode not in self.compatible[plan[uuid]]:
+                        return False
+        # Give way to operations that have been waiting longer
+        for w_ticket, w_plan in self.waiting.items():
+            if w_ticket >= ticket:
+                break
+            for uuid in plan:
+                if uuid in w_plan and w_plan[uuid] not in self.compatible[plan[uuid]]:
+                    return False
+        return True
+
+    def make_plan(self, shared, exclusive):
+        """ Returns the locks required on each node, as a dict() of UUIDs to
+        modes, for reading 'shared' nodes and writing 'exclusive' nodes. """
+        plan = dict()
+        def _add(node, mode, intention):
+            p_nd = node.parent
+            while p_nd:
+                plan[p_nd.uuid] = self.__merge(plan.get(p_nd.uuid, None), intention)
+                p_nd = p_nd.parent
+            plan[node.uuid] = self.__merge(plan.get(node.uuid, None), mode)
+            return
+        for node in shared:
+            if node:
+                _add(node, 'S', 'IS')
+        for node in exclusive:
+            if node:
+                _add(node, 'X', 'IX')
+        return plan
+
+    def acquire(self, plan):
+        """ Wait until all locks in 'plan' could be granted, and grant them
+        at once. """
+        self.cond.acquire()
+        ticket = self.ticket
+        self.ticket += 1
+        self.waiting[ticket] = plan
+        try:
+            while not self.__grantable(plan, ticket):
+                self.cond.wait()
+            for uuid in plan:
+                held = self.held.setdefault(uuid, dict())
+                held[plan[uuid]] = held.get(plan[uuid], 0) + 1
+        finally:
+            del self.waiting[ticket]
+            # Operations waiting behind this one may go ahead
+            self.cond.notify_all()
+            self.cond.release()
+        return
+
+    def release(self, plan):
+        """ Release all locks in 'plan'. """
+        self.cond.acquire()
+        for uuid in plan:
+            held = self.held[uuid]
+            held[plan[uuid]] -= 1
+            if held[plan[uuid]] <= 0:
+                del held[plan[uuid]]
+            if not held:
+                del self.held[uuid]
+        self.cond.notify_all()
+        self.cond.release()
+        return
+
+    def pinned(self, node):
+        """ Whether 'node' is in use, that it is locked in any mode, or any of
+        its ancestors is locked for reading or writing. """
+        self.cond.acquire()
+        try:
+            if node.uuid in self.held:
+                return True
+            p_nd = node.parent
+            while p_nd:
+                held = self.held.get(p_nd.uuid, None)
+                if held and ('S' in held or 'X' in held):
+                    return True
+                p_nd = p_nd.parent
+        finally:
+            self.cond.release()
+        return False
+
+    def lock(self, shared=(), exclusive=(), exclusive_parent=()):
+        """ Returns a context which locks 'shared' paths for reading,
+        'exclusive' paths for writing, and the parents of 'exclusive_parent'
+        paths for writing (as to remove, rename or move them). Entering the
+        context gives the located nodes. """
+        return self.LockContext(self, shared, exclusive, exclusive_parent)
+
+    def shared(self, *paths):
+        """ Lock 'paths' for reading. """
+        return self.LockContext(self, shared=paths)
+
+    def exclusive(self, *paths):
+        """ Lock 'paths' for writing. """
+        return self.LockContext(self, exclusive=paths)
+
+    pass
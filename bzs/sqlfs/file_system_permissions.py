@@ -1,5 +1,6 @@
 
 import copy
+import threading
 
 from .. import users
 
@@ -13,26 +14,64 @@ class FilesystemPermissions:
 
     Specific operations on the file system should also call the post-process
     procedures in this class for special security precautions, to prevent the
-    user from viewing anything inappropriate. """
+    user from viewing anything inappropriate.
 
-    def __init__(self, filesystem=None):
+    Effective permissions of each user on each node are cached, for up to
+    'cache_size' entries. The cache is dropped as a whole once permissions in
+    the filesystem or memberships of usergroups had changed, as told by their
+    generation counters. """
+
+    def __init__(self, filesystem=None, cache_size=100000):
         if not filesystem:
             raise AttributeError('Must provide a file system')
         self.fs = filesystem
+        self.cache = dict() # (uuid, handle, mode) -> bool
+        self.cache_gen = None
+        self.cache_size = cache_size
+        self.cache_lock = threading.Lock()
+        self.cache_enabled = cache_size > 0
         return
 
+    def __generation(self):
+        return (self.fs.fs_acl_gen, users.get_membership_generation())
+
+    def __cached(self, key, func, *args):
+        """ Returns func(*args), cached under 'key'. """
+        if not self.cache_enabled:
+            return func(*args)
+        gen = self.__generation()
+        if gen != self.cache_gen or len(self.cache) >= self.cache_size:
+            with self.cache_lock:
+                if gen != self.cache_gen or len(self.cache) >= self.cache_size:
+                    self.cache = dict()
+                    self.cache_gen = gen
+        cache = self.cache
+        res = cache.get(key, None)
+        if res is None:
+            res = func(*args)
+            # Results could be outdated if anything changed meanwhile
+            if self.__generation() == gen:
+                cache[key] = res
+        return res
+
     def __accessible(self, node, user, mode, check_parent=False):
         """ Wrapping function for determining a single attribute. """
+        # Kernel has ultimate access to files
+        if user.handle in {'kernel'}:
+            return True
+        return self.__cached((node.uuid, user.handle, mode, check_parent), self.__accessible_uncached, node, user, mode, check_parent)
+
+    def __accessible_uncached(self, node, user, mode, check_parent):
         # Kernel has ultimate access to files
         if user.handle in {'kernel'}:
             return True
         # Otherwise normal users
         sel_usr = users.select_member(node.permissions, user.handle)
-        res = node.permissions[sel_usr][mode]
+        res = node.permissions.test(sel_usr, mode)
         if node.parent and check_parent:
             sel_usr_2 = users.select_member(node.parent.permissions, user.handle)
-            if node.parent.permissions[sel_usr_2]['inherit']:
-                res = res and node.parent.permissions[sel_usr_2][mode]
+            if node.parent.permissions.test(sel_usr_2, 'inherit'):
+                res = res and node.parent.permissions.test(sel_usr_2, mode)
             pass
         return res
 
@@ -42,15 +81,20 @@ class FilesystemPermissions:
         node = self.fs.locate(node, parent)
         if not node:
             return False
-        # Check itself and all its parents to see if readable
-        p_nd = node
-        res = True
-        while p_nd.parent:
-            if not self.__accessible(p_nd, user, 'read'):
-                res = False
-            p_nd = p_nd.parent
+        return self.__readable(node, user)
+
+    def __readable(self, node, user):
+        """ Check itself and all its parents to see if readable. Results of the
+        parents are cached and shared among siblings. """
+        if not node.parent:
+            return True
+        return self.__cached((node.uuid, user.handle, 'readable'), self.__readable_uncached, node, user)
+
+    def __readable_uncached(self, node, user):
         # If we don't check all there may be a possibility that people can determine which folders are unreadable through the response timing
-        return res
+        r_self = self.__accessible(node, user, 'read')
+        r_parent = self.__readable(node.parent, user)
+        return r_self and r_parent
 
     def readable_all(self, path, user, parent=None):
         """ Check permissions of a folder whether all its subfolders are
@@ -104,6 +148,13 @@ class FilesystemPermissions:
     def read_writable_all(self, path, user, parent=None):
         return self.readable_all(path, user, parent) and self.writable_all(path, user, parent)
 
+    def invalidate(self):
+        """ Drop all cached permissions. """
+        with self.cache_lock:
+            self.cache = dict()
+            self.cache_gen = None
+        return
+
     def copy_reown(self, path, user, parent=None):
         """ Reset ownership of a folder, and if ownership does not gurantee
         the user read access, then remove this file. """
@@ -124,7 +175,7 @@ class FilesystemPermissions:
                 edited = True
             # Reset permissions
             orig_perms = item.permissions
-            item.permissions = dict()
+            item.chmod_all(dict())
             item.inherit_parmod_all()
             # Add permissions for this user
             item.chmod(user.handle, 'rwxrwx')
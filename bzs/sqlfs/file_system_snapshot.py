@@ -0,0 +1,249 @@
+
+import array
+import mmap
+import os
+import struct
+import threading
+import uuid as uuid_package
+
+class FilesystemSnapshot:
+    """ Binary snapshot of the SQLFS tree and the FileStorage indexes, used to
+    restart without rebuilding the tree from SQL. The snapshot is tagged with
+    the generation counter kept in the sequence 'sqlfs_generation', which is
+    increased by every operation that changes the tree, and would only be
+    loaded if the generation still matches.
+
+    The file starts with a header of magic, version and generation, followed
+    by sections each prefixed with its length in bytes. Strings are stored
+    once in a table and referred to by index. The sections are:
+
+        strings         - All strings, concatenated in UTF-8
+        string offsets  - Offsets of each string, in characters
+        node uuids      - 16 bytes per node
+        node parents    - Index of parent node, -1 for root
+        node names      - String index of file name
+        node is_dir     - 1 for directories, 0 for files
+        node owners     - String index of owner
+        node times      - Upload time
+        node files      - Index of UniqueFile, -1 for directories
+        node perms      - Index of permission set
+        perm offsets    - Offsets of each permission set in 'perm pairs'
+        perm pairs      - String indices of user and permissions, in pairs
+        storage uuids   - 16 bytes per UniqueFile
+        storage sizes   - File size
+        storage counts  - Reference count
+        storage hashes  - String index of hash
+        storage sparse  - Index of sparse row, -1 for large objects
+        storage subidx  - Array subscript in the sparse row
+        storage engine  - String index of engine, -1 for none
+        storage codec   - String index of codec, -1 for none
+        sparse uuids    - 16 bytes per sparse row
+
+    Nodes are ordered so that parents come before their children. Numbers are
+    in native byte order, so snapshots should not be moved across machines. """
+
+    magic   = b'BZSSQLFS'
+    version = 3
+    header  = struct.Struct('=8sIQ')
+    length  = struct.Struct('=Q')
+    layout  = [None, 'q', None, 'i', 'i', 'b', 'i', 'd', 'i', 'i', 'i', 'i',
+               None, 'q', 'q', 'i', 'i', 'i', 'i', 'i', None]
+
+    class Snapshot:
+        """ Decoded content of a snapshot. """
+        pass
+
+    def __init__(self, database=None, path=''):
+        if not database:
+            raise AttributeError('Must provide a database')
+        self.db         = database
+        self.path       = path
+        self.fs         = None
+        self.fs_store   = None
+        self.fs_lock    = None
+        self.save_lock  = threading.Lock()
+        self.last_saved = None
+        return
+
+    def __get_generation(self):
+        return self.db.execute("SELECT last_value FROM sqlfs_generation;")[0][0]
+
+    def __encode_uuids(self, uuids):
+        return b''.join(uuid.bytes for uuid in uuids)
+
+    def __decode_uuids(self, data):
+        return list(uuid_package.UUID(bytes=data[i:i + 16]) for i in range(0, len(data), 16))
+
+    def __collect(self):
+        """ Walk the tree and the storage indexes into section contents. """
+        strings = list()
+        strings_idx = dict()
+        def _str(s):
+            idx = strings_idx.get(s, None)
+            if idx is None:
+                idx = strings_idx[s] = len(strings)
+                strings.append(s)
+            return idx
+        # Storage indexes
+        st_files = list(self.fs_store.st_uuid_idx.values())
+        st_sparse = list(self.fs_store.st_uuid_sparse_idx)
+        st_files_idx = dict((st_files[i].uuid, i) for i in range(0, len(st_files)))
+        st_sparse_idx = dict((st_sparse[i], i) for i in range(0, len(st_sparse)))
+        s_sizes, s_counts, s_hashes = array.array('q'), array.array('q'), array.array('i')
+        s_sparse, s_subidx, s_engines = array.array('i'), array.array('i'), array.array('i')
+        s_codecs = array.array('i')
+        for s_fl in st_files:
+            s_sizes.append(s_fl.size)
+            s_counts.append(s_fl.count)
+            s_hashes.append(_str(s_fl.hash))
+            s_sparse.append(st_sparse_idx.get(s_fl.sparse_uuid, -1))
+            s_subidx.append(s_fl.sparse_index)
+            s_engines.append(_str(s_fl.engine) if s_fl.engine else -1)
+            s_codecs.append(_str(s_fl.codec) if s_fl.codec else -1)
+        # Nodes, parents before children
+        n_uuids = list()
+        n_parents, n_names, n_is_dir = array.array('i'), array.array('i'), array.array('b')
+        n_owners, n_times = array.array('i'), array.array('d')
+        n_files, n_perms = array.array('i'), array.array('i')
+        p_offsets, p_pairs = array.array('i', [0]), array.array('i')
+        perms_idx = dict()
+        nodes_idx = dict()
+        queue = [(self.fs.fs_root, -1)]
+        while queue:
+            node, par = queue.pop()
+            nodes_idx[node.uuid] = len(n_uuids)
+            n_uuids.append(node.uuid)
+            n_parents.append(par)
+            n_names.append(_str(node.file_name))
+            n_is_dir.append(1 if node.is_dir else 0)
+            n_owners.append(_str(node.owner))
+            n_times.append(node.upload_time)
+            n_files.append(-1 if node.is_dir else st_files_idx[node.f_uuid])
+            # ACLs are interned, so each is written only once
+            acl = node.permissions
+            p_idx = perms_idx.get(acl.key, None)
+            if p_idx is None:
+                p_idx = perms_idx[acl.key] = len(perms_idx)
+                for usr, perm in acl.fmt_list:
+                    p_pairs.append(_str(usr))
+                    p_pairs.append(_str(perm))
+                p_offsets.append(len(p_pairs))
+            n_perms.append(p_idx)
+            for i_sub in node.sub_items:
+                queue.append((i_sub, nodes_idx[node.uuid]))
+        # String table
+        s_offsets = array.array('q', [0])
+        for s in strings:
+            s_offsets.append(s_offsets[-1] + len(s))
+        return [
+            ''.join(strings).encode('utf-8'), s_offsets,
+            self.__encode_uuids(n_uuids), n_parents, n_names, n_is_dir,
+            n_owners, n_times, n_files, n_perms, p_offsets, p_pairs,
+            self.__encode_uuids(s_fl.uuid for s_fl in st_files), s_sizes,
+            s_counts, s_hashes, s_sparse, s_subidx, s_engines, s_codecs,
+            self.__encode_uuids(st_sparse)
+        ]
+
+    def __save(self):
+        if not self.path or not self.fs or self.fs.fs_lazy:
+            return False
+        if not self.save_lock.acquire(blocking=False):
+            return False # Another save is in progress
+        try:
+            # Writers are held back while the tree is walked, so that the
+            # snapshot matches the generation.
+            with self.fs_lock.shared('/'), self.fs_store.st_lock:
+                generation = self.__get_generation()
+                sections = self.__collect()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(self.header.pack(self.magic, self.version, generation))
+                for sect in sections:
+                    data = sect if type(sect) == bytes else sect.tobytes()
+                    f.write(self.length.pack(len(data)))
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self.last_saved = generation
+        finally:
+            self.save_lock.release()
+        return True
+
+    def __load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None # Empty file
+        try:
+            magic, version, generation = self.header.unpack_from(mm, 0)
+            if magic != self.magic or version != self.version:
+                return None
+            if generation != self.__get_generation():
+                print('SQLFS snapshot is stale, rebuilding from database.')
+                return None
+            sections = list()
+            offset = self.header.size
+            for typecode in self.layout:
+                length, = self.length.unpack_from(mm, offset)
+                offset += self.length.size
+                if offset + length > len(mm):
+                    return None # Truncated
+                view = memoryview(mm)[offset:offset + length]
+                if typecode:
+                    sect = array.array(typecode)
+                    sect.frombytes(view)
+                else:
+                    sect = bytes(view)
+                view.release()
+                sections.append(sect)
+                offset += length
+        except struct.error:
+            return None
+        finally:
+            mm.close()
+        # Decoding sections
+        snap = self.Snapshot()
+        snap.generation = generation
+        s_all = sections[0].decode('utf-8')
+        s_offsets = sections[1]
+        snap.strings = list(s_all[s_offsets[i]:s_offsets[i + 1]] for i in range(0, len(s_offsets) - 1))
+        snap.node_uuids = self.__decode_uuids(sections[2])
+        snap.node_parents, snap.node_names, snap.node_is_dir, snap.node_owners, \
+            snap.node_times, snap.node_files, snap.node_perms = sections[3:10]
+        p_offsets, p_pairs = sections[10:12]
+        snap.perms = list()
+        for i in range(0, len(p_offsets) - 1):
+            pairs = p_pairs[p_offsets[i]:p_offsets[i + 1]]
+            snap.perms.append(list((snap.strings[pairs[j]], snap.strings[pairs[j + 1]]) for j in range(0, len(pairs), 2)))
+        snap.st_uuids = self.__decode_uuids(sections[12])
+        snap.st_sizes, snap.st_counts, snap.st_hashes, snap.st_sparse, \
+            snap.st_subidx, snap.st_engines, snap.st_codecs = sections[13:20]
+        snap.st_sparse_uuids = self.__decode_uuids(sections[20])
+        self.last_saved = generation
+        return snap
+
+    def bind(self, filesystem, filestorage, fs_lock):
+        """ Snapshots would be taken of 'filesystem' and 'filestorage', while
+        'fs_lock' is used to keep them unchanged. """
+        self.fs = filesystem
+        self.fs_store = filestorage
+        self.fs_lock = fs_lock
+        return
+
+    def save(self):
+        """ Write snapshot to disk, unless disabled, the filesystem is lazily
+        loaded, or the snapshot on disk is up to date. """
+        if self.last_saved is not None and self.last_saved == self.__get_generation():
+            return False
+        ret_result = self.__save()
+        return ret_result
+
+    def load(self):
+        """ Load snapshot from disk, returns None if it could not be used. """
+        ret_result = self.__load()
+        return ret_result
+    pass
@@ -0,0 +1,50 @@
+
+import psycopg2
+import threading
+import time
+
+from bzs import db
+
+def run_unpooled(count):
+    """ Execute 'count' statements, each on a brand new connection. """
+    for i in range(0, count):
+        with psycopg2.connect(**db.Database.connect_params) as l_db:
+            with l_db.cursor() as l_cur:
+                l_cur.execute('SELECT 1;')
+                l_cur.fetchall()
+            pass
+        l_db.close()
+    return
+
+def run_pooled(count):
+    """ Execute 'count' statements through the connection pool. """
+    for i in range(0, count):
+        db.Database.execute('SELECT 1;')
+    return
+
+def measure(func, count=1000, threads=1):
+    """ Returns statements per second of 'func' running in 'threads' threads,
+    each executing 'count' statements. """
+    thr_list = list()
+    for i in range(0, threads):
+        thr_list.append(threading.Thread(target=func, args=[count]))
+    tm = time.time()
+    for thr in thr_list:
+        thr.start()
+    for thr in thr_list:
+        thr.join()
+    tm = time.time() - tm
+    return count * threads / tm
+
+def benchmark(count=1000):
+    print('Connection pool benchmark, %d statements per thread\n%s\n' % (count, '#' * 70))
+    print('Threads     Unpooled (stmt/s)   Pooled (stmt/s)     Speedup')
+    for threads in [1, 4, 16]:
+        r_unpooled = measure(run_unpooled, count, threads)
+        r_pooled = measure(run_pooled, count, threads)
+        print('%s%s%s%.2fx' % (str(threads).ljust(12), ('%.1f' % r_unpooled).ljust(20), ('%.1f' % r_pooled).ljust(20), r_pooled / r_unpooled))
+    print('')
+    print('Pool status: %s' % db.Database.pool.stats())
+    return
+
+benchmark(1000)
@@ -0,0 +1,83 @@
+
+import os
+import time
+import tracemalloc
+
+from bzs import sqlfs
+from bzs.sqlfs import file_hash
+
+def measure(func):
+    """ Run 'func', returns the time spent and the peak of memory allocated
+    by it, above what was allocated before. """
+    tracemalloc.start() # Peak starts over on every start
+    base = tracemalloc.get_traced_memory()[0]
+    tm = time.time()
+    func()
+    tm = time.time() - tm
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return tm, peak
+
+def read_bytes(stream, block_size):
+    stream.seek(0, 0)
+    while stream.read(block_size):
+        pass
+    return
+
+def read_into(stream, buffer):
+    stream.seek(0, 0)
+    while stream.readinto(buffer):
+        pass
+    return
+
+def benchmark(path='/System/bench-alloc/', sizes=[64 * 1024, 1024**2, 32 * 1024**2], rounds=16, block_size=64 * 1024):
+    """ Read files of each size again and again with read(), which allocates
+    new bytes for every block, and with readinto() a single buffer, printing
+    throughput and the peak of memory allocated while reading. The buffer of
+    readinto() is allocated once, outside of what is measured, so its peak
+    should be near zero for sparse files, and a block for others. """
+    print('Buffer reuse benchmark, blocks of %d KB, %d rounds\n%s\n' % (block_size // 1024, rounds, '#' * 70))
+    sqlfs.create_directory('/System/', 'bench-alloc')
+    buffer = bytearray(block_size)
+    hash_buffer = bytearray(file_hash.hash_block_size)
+    print('Size MB   Read MB/s  Peak KB    Into MB/s  Peak KB    Hash MB/s  Peak KB')
+    for size in sizes:
+        data = os.urandom(size)
+        stream = sqlfs.create_file_handle(mode='write', est_length=size)
+        stream.write(data)
+        stream.close()
+        sqlfs.create_file(path, 'file-%d.bin' % size, stream)
+        stream = sqlfs.get_content(path + 'file-%d.bin' % size, None)
+        # Content must be the same through both paths
+        read_into(stream, buffer)
+        stream.seek(0, 0)
+        if stream.read() != data:
+            print('Content of file-%d.bin changed' % size)
+        tm_read, peak_read = measure(lambda: [read_bytes(stream, block_size) for i in range(0, rounds)])
+        tm_into, peak_into = measure(lambda: [read_into(stream, buffer) for i in range(0, rounds)])
+        def hash_all():
+            stream.seek(0, 0)
+            file_hash.hash_stream(stream, buffer=hash_buffer)
+        tm_hash, peak_hash = measure(hash_all)
+        stream.close()
+        mb = size * rounds / 1024**2
+        print('%s%s%s%s%s%s%d' % (('%.2f' % (size / 1024**2)).ljust(10),
+            ('%.1f' % (mb / tm_read)).ljust(11), str(peak_read // 1024).ljust(11),
+            ('%.1f' % (mb / tm_into)).ljust(11), str(peak_into // 1024).ljust(11),
+            ('%.1f' % (size / 1024**2 / tm_hash)).ljust(11), peak_hash // 1024))
+    # Sparse content should be shared by the writer and readers, not copied
+    data = os.urandom(1024**2)
+    stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+    stream.write(data)
+    def close_reopen():
+        stream.close()
+        for i in range(0, rounds):
+            stream.reopen()
+            stream.read_view()
+            stream.close()
+    tm, peak = measure(close_reopen)
+    print('\nClosing and reopening a sparse file %d times: %.1f ms, peak %d KB\n' % (rounds, tm * 1000, peak // 1024))
+    sqlfs.remove(path)
+    return
+
+benchmark()
@@ -0,0 +1,76 @@
+
+import os
+import time
+
+from bzs import db
+from bzs import sqlfs
+from bzs.sqlfs import file_stream
+
+def postgres_cpu():
+    """ CPU seconds spent by local PostgreSQL processes, or None if they could
+    not be seen from here. """
+    total = None
+    tick = os.sysconf('SC_CLK_TCK')
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % pid, 'r') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        name = stat[stat.find('(') + 1:stat.rfind(')')]
+        if not name.startswith('postgres'):
+            continue
+        fields = stat[stat.rfind(')') + 2:].split()
+        total = (total or 0.0) + (int(fields[11]) + int(fields[12])) / tick
+    return total
+
+def store(path, file_name, size, block, blob):
+    """ Store a file of 'size' bytes either as a large object or a blob. """
+    prefix = ('%s-%f' % (file_name, time.time())).encode('utf-8')
+    block = prefix + block[len(prefix):]
+    stream = file_stream.FileStream(
+        mode='write',
+        est_length=size,
+        database=db.Database,
+        blob_store=sqlfs.FileStorage.st_blobs if blob else None)
+    for i in range(0, size // len(block)):
+        stream.write(block)
+    stream.close()
+    sqlfs.create_file(path, file_name, stream)
+    return
+
+def download(path, block_size, rounds):
+    """ Read the file as FilesDownloadHandler does. Returns seconds spent
+    and PostgreSQL CPU seconds spent. """
+    cpu = postgres_cpu()
+    tm = time.time()
+    for r in range(0, rounds):
+        stream = sqlfs.get_content(path, None)
+        while stream.tell() < stream.length:
+            stream.read(block_size)
+        stream.close()
+    tm = time.time() - tm
+    cpu = postgres_cpu() - cpu if cpu is not None else None
+    return tm, cpu
+
+def benchmark(size=256 * 1024**2, block_size=65536, rounds=4):
+    print('Blob store benchmark, downloading %d MB files in %d KB blocks\n%s\n' % (size // 1024**2, block_size // 1024, '#' * 70))
+    if not sqlfs.FileStorage.st_blobs:
+        print('Blob store is disabled, set BZS_SQLFS_BLOB_PATH.\n')
+        return
+    sqlfs.create_directory('/System/', 'bench-blobs')
+    path = '/System/bench-blobs/'
+    block = os.urandom(block_size)
+    print('Storage         Throughput (MB/s)   DB CPU (s)')
+    for blob in [False, True]:
+        file_name = 'blob.bin' if blob else 'lobject.bin'
+        store(path, file_name, size, block, blob)
+        tm, cpu = download(path + file_name, block_size, rounds)
+        print('%s%s%s' % (('blob' if blob else 'large object').ljust(16), ('%.1f' % (size * rounds / 1024**2 / tm)).ljust(20), '%.2f' % cpu if cpu is not None else 'n/a'))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
@@ -0,0 +1,87 @@
+
+import hashlib
+import random
+import time
+
+from bzs import sqlfs
+from bzs.sqlfs import file_chunks
+
+def make_corpus(size, variants, edits, seed=0):
+    """ A random base file and 'variants' copies of it, each with 'edits'
+    small insertions, deletions or overwrites at random places. """
+    rand = random.Random(seed)
+    base = bytes(rand.getrandbits(8) for i in range(0, 1024 * 1024)) * (size // 1024**2)
+    base = bytearray(base)
+    # Make each megabyte distinct
+    for i in range(0, len(base), 1024 * 1024):
+        base[i:i + 8] = i.to_bytes(8, 'little')
+    ret = [bytes(base)]
+    for v in range(0, variants):
+        data = bytearray(base)
+        for e in range(0, edits):
+            pos = rand.randrange(0, len(data))
+            n = rand.randrange(1, 4096)
+            kind = rand.choice(['insert', 'delete', 'overwrite'])
+            if kind == 'insert':
+                data[pos:pos] = bytes(rand.getrandbits(8) for i in range(0, n))
+            elif kind == 'delete':
+                del data[pos:pos + n]
+            else:
+                data[pos:pos + n] = bytes(rand.getrandbits(8) for i in range(0, n))
+        ret.append(bytes(data))
+    return ret
+
+def chunk_offline(corpus, block_size):
+    """ Cut the corpus into chunks in memory, returns logical bytes, distinct
+    chunk bytes and time spent. """
+    distinct = dict()
+    total = 0
+    tm = time.time()
+    for data in corpus:
+        chunker = file_chunks.Chunker()
+        chunks = list()
+        for i in range(0, len(data), block_size):
+            chunks += chunker.feed(data[i:i + block_size])
+        chunks.append(chunker.finish())
+        for chunk in chunks:
+            if chunk:
+                distinct[hashlib.sha256(chunk).hexdigest()] = len(chunk)
+        total += len(data)
+    tm = time.time() - tm
+    return total, sum(distinct.values()), tm
+
+def store_corpus(corpus, block_size):
+    """ Upload the corpus through sqlfs, returns bytes added to storage and
+    time spent. """
+    sqlfs.create_directory('/System/', 'bench-chunks')
+    path = '/System/bench-chunks/'
+    stored = sqlfs.FileStorage.st_chunks.stored_size()
+    tm = time.time()
+    for idx in range(0, len(corpus)):
+        data = corpus[idx]
+        stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+        for i in range(0, len(data), block_size):
+            stream.write(data[i:i + block_size])
+        stream.close()
+        sqlfs.create_file(path, 'variant-%d.bin' % idx, stream)
+    tm = time.time() - tm
+    stored = sqlfs.FileStorage.st_chunks.stored_size() - stored
+    sqlfs.remove(path)
+    return stored, tm
+
+def benchmark(size=64 * 1024**2, variants=7, edits=10, block_size=65536):
+    print('Chunked storage benchmark, %d MB base file with %d variants of %d\nedits each\n%s\n' % (size // 1024**2, variants, edits, '#' * 70))
+    corpus = make_corpus(size, variants, edits)
+    total, distinct, tm = chunk_offline(corpus, block_size)
+    print('Stage               Logical (MB)    Stored (MB)     Dedup ratio     MB/s')
+    print('%s%s%s%s-' % ('whole-file'.ljust(20), ('%.1f' % (total / 1024**2)).ljust(16), ('%.1f' % (total / 1024**2)).ljust(16), '1.00'.ljust(16)))
+    print('%s%s%s%s%.1f' % ('chunking'.ljust(20), ('%.1f' % (total / 1024**2)).ljust(16), ('%.1f' % (distinct / 1024**2)).ljust(16), ('%.2f' % (total / distinct)).ljust(16), total / 1024**2 / tm))
+    if sqlfs.FileStorage.st_engine == 'chunked':
+        stored, tm = store_corpus(corpus, block_size)
+        print('%s%s%s%s%.1f' % ('chunked upload'.ljust(20), ('%.1f' % (total / 1024**2)).ljust(16), ('%.1f' % (stored / 1024**2)).ljust(16), ('%.2f' % (total / max(stored, 1))).ljust(16), total / 1024**2 / tm))
+    else:
+        print('(Set BZS_SQLFS_STORAGE_ENGINE=chunked to measure uploads as well)')
+    print('')
+    return
+
+benchmark()
@@ -0,0 +1,80 @@
+
+import io
+import random
+import time
+
+from bzs import sqlfs
+
+def make_text(rand, size):
+    """ Text-like content, compressing roughly as source code does. """
+    words = list(''.join(rand.choice('abcdefghijklmnopqrstuvwxyz_') for i in range(0, rand.randint(2, 10)))
+        for j in range(0, 2000))
+    ret_result = io.StringIO()
+    while ret_result.tell() < size:
+        ret_result.write(' '.join(rand.choice(words) for i in range(0, rand.randint(4, 14))) + ';\n')
+    return ret_result.getvalue().encode('utf-8')[:size]
+
+def benchmark(path='/System/bench-codec/', count=16, size=4 * 1024**2, seeks=256, seed=0):
+    """ Upload the same text with each codec, printing time spent on
+    compression against bytes saved, and the cost of reading content back
+    as a whole, from random positions, and as stored for gzip clients. """
+    print('Compression tier benchmark, %d files of %.1f MB\n%s\n' % (count, size / 1024**2, '#' * 70))
+    rand = random.Random(seed)
+    files = list(make_text(rand, size) + ('%d' % i).encode('utf-8') for i in range(0, count))
+    sqlfs.create_directory('/System/', 'bench-codec')
+    codec_orig = sqlfs.FileStorage.st_codec
+    print('Codec     Upload s  CPU s     Stored MB  Ratio     Read s    Seek ms   Raw read s')
+    for codec in [None, 'gzip', 'xz']:
+        sqlfs.FileStorage.st_codec = codec
+        sqlfs.create_directory(path, str(codec))
+        par = '%s%s/' % (path, codec)
+        stored_before = sqlfs.get_compression_report().get(codec or 'none', {}).get('stored-size', 0)
+        # Uploading
+        tm, tm_cpu = time.time(), time.process_time()
+        for i, data in enumerate(files):
+            stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+            stream.write(data)
+            stream.close()
+            sqlfs.create_file(par, 'file-%d.txt' % i, stream)
+        tm, tm_cpu = time.time() - tm, time.process_time() - tm_cpu
+        stored = sqlfs.get_compression_report().get(codec or 'none', {}).get('stored-size', 0) - stored_before
+        # Reading whole files
+        tm_read = time.time()
+        for i, data in enumerate(files):
+            stream = sqlfs.get_content(par + 'file-%d.txt' % i, None)
+            if stream.read() != data:
+                print('Content of file-%d.txt changed' % i)
+            stream.close()
+        tm_read = time.time() - tm_read
+        # Reading 4 KB from random positions
+        stream = sqlfs.get_content(par + 'file-0.txt', None)
+        tm_seek = time.time()
+        for i in range(0, seeks):
+            pos = rand.randint(0, size - 4096)
+            stream.seek(pos, 0)
+            if stream.read(4096) != files[0][pos:pos + 4096]:
+                print('Content at %d changed' % pos)
+        tm_seek = time.time() - tm_seek
+        stream.close()
+        # Reading content as stored, as sent to clients accepting gzip
+        tm_raw = time.time()
+        for i in range(0, count):
+            stream = sqlfs.get_content(par + 'file-%d.txt' % i, None)
+            raw = stream.get_encoded('gzip') or stream
+            while raw.read(64 * 1024):
+                pass
+            stream.close()
+        tm_raw = time.time() - tm_raw
+        print('%s%s%s%s%s%s%s%.3f' % (str(codec).ljust(10), ('%.3f' % tm).ljust(10), ('%.3f' % tm_cpu).ljust(10),
+            ('%.2f' % (stored / 1024**2)).ljust(11), ('%.3f' % (stored / (count * size))).ljust(10),
+            ('%.3f' % tm_read).ljust(10), ('%.3f' % (tm_seek / seeks * 1000)).ljust(10), tm_raw))
+    sqlfs.FileStorage.st_codec = codec_orig
+    print('')
+    for codec, item in sorted(sqlfs.get_compression_report().items()):
+        print('%s%d files, %.1f MB stored as %.1f MB' % (codec.ljust(10), item['files'],
+            item['size'] / 1024**2, item['stored-size'] / 1024**2))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
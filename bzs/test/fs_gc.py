@@ -0,0 +1,90 @@
+
+import os
+import time
+
+from bzs import db
+from bzs import sqlfs
+
+def store(path, file_name, data):
+    stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+    stream.write(data)
+    stream.close()
+    sqlfs.create_file(path, file_name, stream)
+    return
+
+def abandon(size):
+    """ Write a large object as an aborted upload would, never stored. """
+    stream = sqlfs.create_file_handle(mode='write', est_length=size)
+    stream.write(os.urandom(size))
+    stream.close()
+    return stream.get_content()
+
+def leave_behind(size):
+    """ Leave a chunk, a temporary file and a blob, each of 'size' bytes, as
+    uploads in other processes that never completed would. Returns the
+    digest of the chunk and paths of the files. """
+    digest = os.urandom(32).hex()
+    db.Database.execute("INSERT INTO file_storage_chunk (hash, size, count, content) VALUES (%s, %s, 0, %s);", (digest, size, os.urandom(size)), fetch_func=None)
+    blobs = sqlfs.FileStorage.st_blobs
+    paths = [os.path.join(blobs.tmp_path, os.urandom(16).hex() + '.part'), blobs.blob_path(os.urandom(32).hex())]
+    for file_path in paths:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(os.urandom(size))
+    return digest, paths
+
+def check(path='/System/bench-gc/', count=512, size=32 * 1024):
+    """ Fragment pack segments, leave an orphaned large object, chunk,
+    temporary file and blob, and a wrong reference count, then make sure the
+    collector fixes all of them while the remaining files read back
+    unchanged. """
+    print('Storage garbage collector check\n%s\n' % ('#' * 70))
+    sqlfs.create_directory('/System/', 'bench-gc')
+    files = dict()
+    for i in range(0, count):
+        files['file-%d.bin' % i] = os.urandom(size)
+        store(path, 'file-%d.bin' % i, files['file-%d.bin' % i])
+    # Removing three quarters of the files
+    for i in range(0, count):
+        if i % 4 != 0:
+            sqlfs.remove(path + 'file-%d.bin' % i)
+            del files['file-%d.bin' % i]
+    oid = abandon(4 * 1024**2)
+    digest, paths = leave_behind(size)
+    s_fl = sqlfs.FileStorage.st_uuid_idx[sqlfs.Filesystem.locate(path + 'file-0.bin').f_uuid]
+    s_fl.count += 2
+    db.Database.execute("UPDATE file_storage SET count = %s WHERE uuid = %s;", (s_fl.count, s_fl.uuid), fetch_func=None)
+    # Orphans are only removed by the second run
+    tm = time.time()
+    reclaimed = sqlfs.collect_garbage()
+    reclaimed += sqlfs.collect_garbage()
+    tm = time.time() - tm
+    metrics = sqlfs.get_gc_metrics()
+    failures = 0
+    for file_name, data in files.items():
+        stream = sqlfs.get_content(path + file_name, None)
+        if stream.read() != data:
+            failures += 1
+            print('Content of %s changed' % file_name)
+        stream.close()
+    if s_fl.count != 1:
+        failures += 1
+        print('Reference count not corrected: %d' % s_fl.count)
+    if db.Database.execute("SELECT oid FROM pg_largeobject_metadata WHERE oid = %s;", (oid,)):
+        failures += 1
+        print('Orphaned large object %d not unlinked' % oid)
+    if db.Database.execute("SELECT hash FROM file_storage_chunk WHERE hash = %s;", (digest,)):
+        failures += 1
+        print('Orphaned chunk %s not deleted' % digest)
+    for file_path in paths:
+        if os.path.exists(file_path):
+            failures += 1
+            print('Orphaned file %s not removed' % file_path)
+    print('Reclaimed %.1f MB in %.2f s' % (reclaimed / 1024**2, tm))
+    for key in sorted(metrics):
+        print('    %s: %s' % (key, metrics[key]))
+    print('%d failures\n' % failures)
+    sqlfs.remove(path)
+    return failures == 0
+
+check()
@@ -0,0 +1,59 @@
+
+import hashlib
+import io
+import os
+import time
+
+from bzs.sqlfs import file_hash
+
+def reference_sha256(stream):
+    """ fs_st_sha256() as it was, reading and hashing one chunk at a time. """
+    hash_concat = ''
+    while True:
+        chunk = stream.read(8192)
+        hash_concat += hashlib.sha256(chunk).hexdigest()
+        if len(chunk) < 8192:
+            break
+    return hashlib.sha256(hash_concat.encode('utf-8', 'ignore')).hexdigest()
+
+def check(sizes=[0, 1, 8191, 8192, 8193, 1024**2 - 1, 1024**2, 3 * 1024**2 + 12345]):
+    """ Digests must not differ from the serial scheme, however the content
+    is split between writes. """
+    failures = 0
+    for size in sizes:
+        data = os.urandom(size)
+        expected = reference_sha256(io.BytesIO(data))
+        for block_size in [1000, 8192, 65536, 1024**2 + 7]:
+            hasher = file_hash.TreeHasher()
+            for i in range(0, len(data), block_size):
+                hasher.update(data[i:i + block_size])
+            if hasher.hexdigest() != expected:
+                failures += 1
+                print('Mismatch at %d bytes in blocks of %d' % (size, block_size))
+    return failures == 0
+
+def benchmark(size=512 * 1024**2, block_size=65536):
+    print('Tree hashing benchmark, %d MB written in %d KB blocks\n%s\n' % (size // 1024**2, block_size // 1024, '#' * 70))
+    data = os.urandom(size)
+    tm = time.time()
+    expected = reference_sha256(io.BytesIO(data))
+    tm = time.time() - tm
+    print('Threads         Throughput (MB/s)   Speedup')
+    print('%s%s%s' % ('serial'.ljust(16), ('%.1f' % (size / 1024**2 / tm)).ljust(20), '1.00'))
+    base = tm
+    threads = file_hash.HashPool.threads
+    for n in sorted(set([1, 2, 4, os.cpu_count() or 1])):
+        file_hash.HashPool.configure(n)
+        tm = time.time()
+        hasher = file_hash.TreeHasher()
+        for i in range(0, size, block_size):
+            hasher.update(data[i:i + block_size])
+        digest = hasher.hexdigest()
+        tm = time.time() - tm
+        print('%s%s%s%s' % (str(n).ljust(16), ('%.1f' % (size / 1024**2 / tm)).ljust(20), ('%.2f' % (base / tm)).ljust(10), '' if digest == expected else 'MISMATCH'))
+    file_hash.HashPool.configure(threads)
+    print('')
+    return
+
+check()
+benchmark()
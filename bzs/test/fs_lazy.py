@@ -0,0 +1,69 @@
+
+import os
+import subprocess
+import sys
+
+from bzs import db
+from bzs import sqlfs
+
+# Runs in a fresh interpreter, so that memory of each mode is measured apart.
+child_script = """
+import resource
+import time
+tm = time.time()
+from bzs import sqlfs
+tm_start = time.time() - tm
+tm = time.time()
+sqlfs.list_directory('/System/bench-lazy/folder-%d/')
+tm_list = time.time() - tm
+print('%%f %%f %%d %%d' % (tm_start, tm_list, len(sqlfs.Filesystem.fs_uuid_idx), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+"""
+
+def make_tree(folders, files):
+    """ Insert a synthetic tree of 'folders' folders each with 'files' files
+    right into the database, under /System/bench-lazy/. All files share the
+    content of one real file. """
+    sqlfs.create_directory('/System/', 'bench-lazy')
+    stream = sqlfs.create_file_handle(mode='write', est_length=5, obj_data=b'bench')
+    stream.close()
+    sqlfs.create_file('/System/bench-lazy/', 'content.txt', stream)
+    par = sqlfs.Filesystem.locate('/System/bench-lazy/')
+    f_uuid = sqlfs.Filesystem.locate('/System/bench-lazy/content.txt').f_uuid
+    perms = par.fmtmod_list()
+    db.Database.execute("""
+        INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid)
+            SELECT md5('bench-lazy-' || d)::UUID, %s, 'folder-' || d, TRUE, 'kernel', %s, 0.0, NULL
+                FROM generate_series(1, %s) d;""", (par.uuid, perms, folders), fetch_func=None)
+    db.Database.execute("""
+        INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid)
+            SELECT md5('bench-lazy-' || d || '-' || f)::UUID, md5('bench-lazy-' || d)::UUID, 'file-' || f || '.txt', FALSE, 'kernel', %s, 0.0, %s
+                FROM generate_series(1, %s) d, generate_series(1, %s) f;""", (perms, f_uuid, folders, files), fetch_func=None)
+    sqlfs.Filesystem.bump_generation()
+    return par
+
+def remove_tree(par):
+    db.Database.execute("DELETE FROM file_system_node WHERE parent_uuid IN (SELECT uuid FROM file_system_node WHERE parent_uuid = %s AND is_dir = TRUE);", (par.uuid,), fetch_func=None)
+    db.Database.execute("DELETE FROM file_system_node WHERE parent_uuid = %s AND is_dir = TRUE;", (par.uuid,), fetch_func=None)
+    sqlfs.Filesystem.bump_generation()
+    sqlfs.remove('/System/bench-lazy/')
+    return
+
+def measure(lazy, folders):
+    env = dict(os.environ)
+    env['BZS_SQLFS_LAZY_LOAD'] = '1' if lazy else '0'
+    res = subprocess.run([sys.executable, '-c', child_script % (folders // 2)], env=env, stdout=subprocess.PIPE, check=True)
+    tm_start, tm_list, nodes, rss = res.stdout.decode('utf-8').split()[-4:]
+    return float(tm_start), float(tm_list), int(nodes), int(rss)
+
+def benchmark(folders=1000, files=999):
+    print('Lazy tree loading benchmark, %d folders of %d files\n%s\n' % (folders, files, '#' * 70))
+    par = make_tree(folders, files)
+    print('Mode        Cold start (s)  First listing (ms)  Resident nodes  Max RSS (MB)')
+    for lazy in [False, True]:
+        tm_start, tm_list, nodes, rss = measure(lazy, folders)
+        print('%s%s%s%s%.1f' % (('lazy' if lazy else 'eager').ljust(12), ('%.2f' % tm_start).ljust(16), ('%.2f' % (tm_list * 1000)).ljust(20), str(nodes).ljust(16), rss / 1024))
+    print('')
+    remove_tree(par)
+    return
+
+benchmark()
@@ -0,0 +1,100 @@
+
+import threading
+import time
+
+from bzs import sqlfs
+
+def make_tree(parent, name, folders, files):
+    """ Create a folder 'name' under 'parent' with 'folders' sub-folders, each
+    containing 'files' small files. """
+    sqlfs.create_directory(parent, name)
+    path = '%s%s/' % (parent, name)
+    for i in range(0, folders):
+        sqlfs.create_directory(path, 'folder-%d' % i)
+        for j in range(0, files):
+            content = ('%d-%d' % (i, j)).encode('utf-8')
+            stream = sqlfs.create_file_handle(mode='write', est_length=len(content), obj_data=content)
+            stream.close()
+            sqlfs.create_file('%sfolder-%d/' % (path, i), 'file-%d.txt' % j, stream)
+    return path
+
+def list_worker(path, stop_event, counter, lock):
+    """ List 'path' repeatedly until stopped, counting the listings. """
+    while not stop_event.is_set():
+        sqlfs.list_directory(path)
+        lock.acquire()
+        counter[0] += 1
+        lock.release()
+    return
+
+def measure_listing(path, threads=4, duration=None, background=None):
+    """ Returns listings per second of 'path'. If 'background' is given, the
+    measure lasts as long as the background job runs, otherwise 'duration'
+    seconds. """
+    stop_event = threading.Event()
+    counter = [0]
+    lock = threading.Lock()
+    thr_list = list()
+    for i in range(0, threads):
+        thr_list.append(threading.Thread(target=list_worker, args=[path, stop_event, counter, lock]))
+    tm = time.time()
+    for thr in thr_list:
+        thr.start()
+    if background:
+        background.start()
+        background.join()
+    else:
+        time.sleep(duration)
+    stop_event.set()
+    for thr in thr_list:
+        thr.join()
+    tm = time.time() - tm
+    return counter[0] / tm, tm
+
+def check(timeout=30.0):
+    """ Copy two folders into each other at the same time while a reader holds
+    both, as every writer then waits behind the reader and the other writer.
+    Both copies must complete once the reader is done. """
+    print('Filesystem locking check\n%s\n' % ('#' * 70))
+    source = make_tree('/System/', 'bench-lock-p', 2, 2)
+    target = make_tree('/System/', 'bench-lock-q', 2, 2)
+    thr_list = list()
+    thr_list.append(threading.Thread(target=sqlfs.copy, args=[source, target]))
+    thr_list.append(threading.Thread(target=sqlfs.copy, args=[target, source]))
+    with sqlfs.FilesystemLock.shared(source, target):
+        for thr in thr_list:
+            thr.start()
+            time.sleep(0.5)
+    failures = 0
+    for thr in thr_list:
+        thr.join(timeout)
+        if thr.is_alive():
+            failures += 1
+    if failures:
+        print('%d of 2 opposite copies did not complete in %.1f s\n' % (failures, timeout))
+        return False
+    print('Opposite copies completed\n')
+    sqlfs.remove(source)
+    sqlfs.remove(target)
+    return True
+
+def benchmark(folders=50, files=100, threads=4):
+    print('Filesystem locking benchmark, copying %d folders of %d files\n%s\n' % (folders, files, '#' * 70))
+    source = make_tree('/System/', 'bench-lock-source', folders, files)
+    sqlfs.create_directory('/System/', 'bench-lock-target')
+    target = '/System/bench-lock-target/'
+    for path in ['/Public/', source]:
+        r_idle, tm = measure_listing(path, threads, duration=5.0)
+        copy_thread = threading.Thread(target=sqlfs.copy, args=[source, target])
+        r_busy, tm = measure_listing(path, threads, background=copy_thread)
+        print('Listing %s' % path)
+        print('    Idle:         %.1f listings/s' % r_idle)
+        print('    During copy:  %.1f listings/s (copy took %.2f s)' % (r_busy, tm))
+        sqlfs.remove(target + 'bench-lock-source/')
+    print('')
+    sqlfs.remove(source)
+    sqlfs.remove(target)
+    return
+
+check()
+benchmark()
@@ -0,0 +1,130 @@
+
+import gc
+import tracemalloc
+import uuid
+
+from bzs import sqlfs
+
+class LegacyNode:
+    """ Nodes as they were laid out before, with a __dict__, a dict() of six
+    booleans per user and children containers even for files. """
+
+    def __init__(self, is_dir, file_name, owner, permissions, upload_time, f_uuid):
+        self.master = None
+        self.is_dir = is_dir
+        self.file_name = file_name
+        self.owner = ''.join(list(owner)) # Not shared
+        self.permissions = dict()
+        for usr in permissions:
+            perm = permissions[usr]
+            self.permissions[usr] = dict(
+                read         = perm[0] == 'r',
+                write        = perm[1] == 'w',
+                inherit      = perm[2] == 'x',
+                read_pass    = perm[3] == 'r',
+                write_pass   = perm[4] == 'w',
+                inherit_pass = perm[5] == 'x'
+            )
+        self.uuid = uuid.uuid4()
+        self.upload_time = upload_time
+        self.f_uuid = f_uuid
+        self.parent = None
+        self.sub_items = set()
+        self.sub_names_idx = dict()
+        return
+    pass
+
+class LegacyUniqueFile:
+    def __init__(self, size, count, hash_):
+        self.master = None
+        self.uuid = uuid.uuid4()
+        self.size = size
+        self.count = count
+        self.hash = hash_
+        self.sparse_uuid = None
+        self.sparse_index = 0
+        return
+    pass
+
+legacy_idx = dict() # Same indexes as the filesystem and storage keep
+
+def make_legacy(folders, files):
+    nodes = list()
+    for i in range(0, folders):
+        par = LegacyNode(True, 'folder-%d' % i, 'kernel', {'': '--x--x', 'kernel': 'rwxrwx'}, 0.0, None)
+        legacy_idx[par.uuid] = par
+        nodes.append(par)
+        for j in range(0, files):
+            n_fl = LegacyNode(False, 'file-%d.txt' % j, 'kernel', {'': '--x--x', 'kernel': 'rwxrwx'}, 0.0, uuid.uuid4())
+            n_fl.parent = par
+            par.sub_items.add(n_fl)
+            par.sub_names_idx[n_fl.file_name] = n_fl
+            legacy_idx[n_fl.uuid] = n_fl
+            nodes.append(n_fl)
+    return nodes
+
+def make_compact(folders, files):
+    fs = sqlfs.Filesystem
+    nodes = list()
+    for i in range(0, folders):
+        par = fs.fsNode(is_dir=True, file_name='folder-%d' % i, owner='kernel', permissions={'': '--x--x', 'kernel': 'rwxrwx'}, upload_time=1.0, master=fs)
+        nodes.append(par)
+        for j in range(0, files):
+            n_fl = fs.fsNode(is_dir=False, file_name='file-%d.txt' % j, owner='kernel', permissions={'': '--x--x', 'kernel': 'rwxrwx'}, upload_time=1.0, f_uuid=uuid.uuid4(), master=fs)
+            n_fl.parent = par
+            par.sub_items.add(n_fl)
+            par.sub_names_idx[n_fl.file_name] = n_fl
+            nodes.append(n_fl)
+    return nodes
+
+def make_legacy_storage(count):
+    ret = list()
+    for i in range(0, count):
+        s_fl = LegacyUniqueFile(1024, 1, '%064x' % i)
+        legacy_idx[s_fl.uuid] = s_fl
+        legacy_idx[s_fl.hash] = s_fl
+        ret.append(s_fl)
+    return ret
+
+def make_compact_storage(count):
+    st = sqlfs.FileStorage
+    ret = list()
+    for i in range(0, count):
+        ret.append(st.UniqueFile(None, 1024, 1, '%064x' % i, master=st))
+    return ret
+
+def measure(func, *args):
+    """ Returns bytes allocated per object created by 'func', along with the
+    objects, so that they could be cleaned up. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objs = func(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(objs), objs
+
+def benchmark(folders=100, files=1000):
+    print('Node memory benchmark, %d folders of %d files\n%s\n' % (folders, files, '#' * 70))
+    print('Object              Before (B/node)     After (B/node)      Saved')
+    r_legacy, objs = measure(make_legacy, folders, files)
+    legacy_idx.clear()
+    del objs
+    r_compact, objs = measure(make_compact, folders, files)
+    for node in objs:
+        del sqlfs.Filesystem.fs_uuid_idx[node.uuid]
+    del objs
+    print('%s%s%s%.1f%%' % ('fsNode'.ljust(20), ('%.1f' % r_legacy).ljust(20), ('%.1f' % r_compact).ljust(20), 100 - r_compact / r_legacy * 100))
+    r_legacy, objs = measure(make_legacy_storage, folders * files)
+    legacy_idx.clear()
+    del objs
+    r_compact, objs = measure(make_compact_storage, folders * files)
+    for s_fl in objs:
+        del sqlfs.FileStorage.st_uuid_idx[s_fl.uuid]
+        del sqlfs.FileStorage.st_hash_idx[s_fl.hash]
+    del objs
+    print('%s%s%s%.1f%%' % ('UniqueFile'.ljust(20), ('%.1f' % r_legacy).ljust(20), ('%.1f' % r_compact).ljust(20), 100 - r_compact / r_legacy * 100))
+    print('')
+    return
+
+benchmark()
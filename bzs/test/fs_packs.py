@@ -0,0 +1,78 @@
+
+import os
+import time
+import uuid
+
+from bzs import db
+from bzs import sqlfs
+
+def legacy_store(files):
+    """ Store 'files' with the statements sparse rows were written with, 256
+    files to a row, in a scratch table. Returns seconds spent per file, for
+    each row position. """
+    db.Database.execute("DROP TABLE IF EXISTS bench_sparse;", fetch_func=None)
+    db.Database.execute("CREATE TABLE bench_sparse (uuid UUID, size BIGINT, count BIGINT, sub_content BYTEA[]);", fetch_func=None)
+    ret = list(0.0 for i in range(0, 256))
+    row = None
+    for i in range(0, len(files)):
+        tm = time.time()
+        if i % 256 == 0:
+            row = uuid.uuid4()
+            db.Database.execute("INSERT INTO bench_sparse (uuid, size, count, sub_content) VALUES (%s, %s, 1, %s);", (row, len(files[i]), [files[i]]), fetch_func=None)
+        else:
+            db.Database.execute("UPDATE bench_sparse SET size = size + %s, count = count + 1, sub_content = array_cat(sub_content, %s) WHERE uuid = %s;", (len(files[i]), [files[i]], row), fetch_func=None)
+        ret[i % 256] += time.time() - tm
+    return ret
+
+def legacy_read(count):
+    tm = time.time()
+    for i in range(0, count):
+        db.Database.execute("SELECT sub_content[%s] FROM bench_sparse LIMIT 1;", (i % 256 + 1,))
+    tm = time.time() - tm
+    db.Database.execute("DROP TABLE IF EXISTS bench_sparse;", fetch_func=None)
+    return tm
+
+def pack_store(path, files):
+    """ Store 'files' through the filesystem, which appends them to pack
+    segments. Returns seconds spent per file, for each position as above. """
+    ret = list(0.0 for i in range(0, 256))
+    for i in range(0, len(files)):
+        tm = time.time()
+        stream = sqlfs.create_file_handle(mode='write', est_length=len(files[i]))
+        stream.write(files[i])
+        stream.close()
+        sqlfs.create_file(path, 'file-%d.bin' % i, stream)
+        ret[i % 256] += time.time() - tm
+    return ret
+
+def pack_read(path, count):
+    tm = time.time()
+    for i in range(0, count):
+        stream = sqlfs.get_content(path + 'file-%d.bin' % i, None)
+        stream.read()
+        stream.close()
+    tm = time.time() - tm
+    return tm
+
+def benchmark(count=1024, size=64 * 1024):
+    print('Pack store benchmark, %d files of %d KB\n%s\n' % (count, size // 1024, '#' * 70))
+    sqlfs.create_directory('/System/', 'bench-packs')
+    path = '/System/bench-packs/'
+    files = list(os.urandom(size) for i in range(0, count))
+    rows = count // 256 or 1
+    results = [
+        ('sparse rows', legacy_store(files), legacy_read(count)),
+        ('pack segments', pack_store(path, files), pack_read(path, count)),
+    ]
+    print('Storage         1st file (ms)   256th file (ms)  Write (files/s)  Read (files/s)')
+    for name, w_tm, r_tm in results:
+        print('%s%s%s%s%.0f' % (name.ljust(16),
+            ('%.2f' % (w_tm[0] / rows * 1000)).ljust(16),
+            ('%.2f' % (w_tm[-1] / rows * 1000)).ljust(17),
+            ('%.0f' % (count / sum(w_tm))).ljust(17),
+            count / r_tm))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
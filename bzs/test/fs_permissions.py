@@ -0,0 +1,141 @@
+
+import random
+import time
+
+from bzs import sqlfs
+from bzs import users
+
+perm_choices = ['rwxrwx', 'r-xr-x', '--x--x', '------', 'rw----', 'r--r--', 'rwx---']
+
+def make_tree(path, depth, width):
+    """ Create a tree of folders 'depth' levels deep, 'width' folders each,
+    with a file in each folder. Returns the paths of all folders. """
+    ret = list()
+    level = [path]
+    for d in range(0, depth):
+        n_level = list()
+        for par in level:
+            for i in range(0, width):
+                sqlfs.create_directory(par, 'folder-%d' % i)
+                n_level.append('%sfolder-%d/' % (par, i))
+        level = n_level
+        ret += level
+    for par in ret:
+        stream = sqlfs.create_file_handle(mode='write', est_length=5, obj_data=b'bench')
+        stream.close()
+        sqlfs.create_file(par, 'content.txt', stream)
+    return ret
+
+def make_users(count):
+    ret = list()
+    for i in range(0, count):
+        usr = users.User(handle='bench-perm-%d' % i, master=users.UserManager)
+        users.add_user(usr)
+        ret.append(usr)
+    return ret
+
+def snapshot_permissions(perms, nodes, usrs):
+    ret = list()
+    for node in nodes:
+        for usr in usrs:
+            ret.append((perms.readable(node, usr), perms.writable(node, usr), perms.writable_self(node, usr)))
+    return ret
+
+def all_nodes(path):
+    ret = list()
+    queue = [sqlfs.Filesystem.locate(path)]
+    while queue:
+        node = queue.pop()
+        ret.append(node)
+        queue += list(node.sub_items)
+    return ret
+
+def node_path(node):
+    ret = ''
+    while node.parent:
+        ret = node.file_name + '/' + ret
+        node = node.parent
+    return '/' + ret
+
+def check(path='/System/bench-perm/', rounds=200, seed=0):
+    """ Randomly change permissions, move folders, change memberships and
+    remove users, making sure that cached permissions never differ from the
+    ones computed afresh. """
+    print('Permission cache correctness check, %d rounds\n%s\n' % (rounds, '#' * 70))
+    rand = random.Random(seed)
+    perms = sqlfs.FilesystemPermissions
+    folders = make_tree(path, 3, 3)
+    usrs = make_users(4)
+    grp = users.Usergroup(handle='bench-perm-group', admin='kernel', name='Bench', master=users.UserManager)
+    users.UserManager.add_usergroup(grp)
+    handles = [usr.handle for usr in usrs] + [grp.handle, 'public', 'guest']
+    failures = 0
+    for r in range(0, rounds):
+        op = rand.choice(['chmod', 'chmod', 'move', 'member', 'remove'])
+        if op == 'chmod':
+            n_perm = dict((h, rand.choice(perm_choices)) for h in rand.sample(handles, 3))
+            sqlfs.change_permissions(rand.choice(folders), n_perm, recursive=rand.random() < 0.3)
+        elif op == 'move':
+            src, dest = rand.choice(folders), rand.choice(folders + [path])
+            if sqlfs.move(src, dest):
+                folders = list(node_path(n) for n in all_nodes(path) if n.is_dir)[1:]
+        elif op == 'member':
+            usr = rand.choice(usrs)
+            if usr.handle in grp.members:
+                grp.members.remove(usr.handle)
+                users.UserManager.membership_changed()
+            else:
+                grp.add_member(usr)
+        elif op == 'remove':
+            usr = rand.choice(usrs)
+            grp.members.discard(usr.handle)
+            users.remove_user(usr.handle)
+            usrs.remove(usr)
+            n_usr = users.User(handle='%s-%d' % (usr.handle, r), master=users.UserManager)
+            users.add_user(n_usr)
+            usrs.append(n_usr)
+        nodes = all_nodes(path)
+        perms.cache_enabled = True
+        r_cached = snapshot_permissions(perms, nodes, usrs)
+        perms.cache_enabled = False
+        r_fresh = snapshot_permissions(perms, nodes, usrs)
+        perms.cache_enabled = True
+        if r_cached != r_fresh:
+            failures += 1
+            print('Mismatch after round %d (%s)' % (r, op))
+    print('%d rounds, %d mismatches\n' % (rounds, failures))
+    for usr in usrs:
+        users.remove_user(usr.handle)
+    users.remove_usergroup(grp.handle)
+    sqlfs.remove(path)
+    return failures == 0
+
+def benchmark(path='/System/bench-perm-list/', depth=8, files=5000, listings=20):
+    print('Permission cache benchmark, listing %d files at depth %d\n%s\n' % (files, depth, '#' * 70))
+    par = '/System/'
+    for d in range(0, depth):
+        sqlfs.create_directory(par, 'bench-perm-list' if d == 0 else 'level-%d' % d)
+        par += ('bench-perm-list' if d == 0 else 'level-%d' % d) + '/'
+    for i in range(0, files):
+        stream = sqlfs.create_file_handle(mode='write', est_length=5, obj_data=b'bench')
+        stream.close()
+        sqlfs.create_file(par, 'file-%d.txt' % i, stream)
+    usr = make_users(1)[0]
+    perms = sqlfs.FilesystemPermissions
+    print('Cache       Listings/s      Files/s')
+    for enabled in [False, True]:
+        perms.cache_enabled = enabled
+        perms.invalidate()
+        tm = time.time()
+        for i in range(0, listings):
+            sqlfs.list_directory(par, usr)
+        tm = time.time() - tm
+        print('%s%s%.0f' % (('on' if enabled else 'off').ljust(12), ('%.2f' % (listings / tm)).ljust(16), listings * files / tm))
+    perms.cache_enabled = perms.cache_size > 0
+    print('')
+    users.remove_user(usr.handle)
+    sqlfs.remove(path)
+    return
+
+check()
+benchmark()
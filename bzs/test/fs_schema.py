@@ -0,0 +1,36 @@
+
+import time
+
+from bzs import sqlfs
+
+def create_files(path, prefix, count):
+    """ Create 'count' small files named after 'prefix' under 'path'. Returns
+    the average latency of each creation. """
+    tm = time.time()
+    for i in range(0, count):
+        content = ('%s-%d' % (prefix, i)).encode('utf-8')
+        stream = sqlfs.create_file_handle(mode='write', est_length=len(content), obj_data=content)
+        stream.close()
+        sqlfs.create_file(path, '%s-%d.txt' % (prefix, i), stream)
+    tm = time.time() - tm
+    return tm / count
+
+def benchmark(sizes=[0, 1000, 5000, 20000], count=100):
+    print('Filesystem schema benchmark, creating %d files in directories of\nvarious sizes\n%s\n' % (count, '#' * 70))
+    print('Directory size      Create latency (ms)')
+    sqlfs.create_directory('/System/', 'bench-schema')
+    path = '/System/bench-schema/'
+    filled = 0
+    for size in sizes:
+        # Fill the directory up to the given size, then measure
+        if size > filled:
+            create_files(path, 'fill-%d' % size, size - filled)
+            filled = size
+        latency = create_files(path, 'probe-%d' % size, count)
+        filled += count
+        print('%s%.3f' % (str(size).ljust(20), latency * 1000))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
@@ -0,0 +1,62 @@
+
+import os
+import time
+
+from bzs import db
+from bzs import sqlfs
+
+def store(path, file_name, data):
+    stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+    stream.write(data)
+    stream.close()
+    sqlfs.create_file(path, file_name, stream)
+    return sqlfs.Filesystem.locate(path + file_name).f_uuid
+
+def check(path='/System/bench-scrub/', count=256, size=16 * 1024):
+    """ Damage the content of one packed file behind the back of the storage,
+    then make sure a full pass of the scrubber finds it and only it, that a
+    pass resumes from the checkpoint, and that content of a quarantined file
+    is stored again when uploaded anew. """
+    print('Storage integrity scrubber check\n%s\n' % ('#' * 70))
+    sqlfs.create_directory('/System/', 'bench-scrub')
+    files = list(os.urandom(size) for i in range(0, count))
+    uuids = list(store(path, 'file-%d.bin' % i, files[i]) for i in range(0, count))
+    damaged = uuids[count // 2]
+    content, offset = db.Database.execute("SELECT content, pack_offset FROM file_storage WHERE uuid = %s;", (damaged,), fetch_func='one')
+    db.Database.execute("SELECT lo_put(%s, %s, %s);", (content, offset + 100, b'\x00' * 16), fetch_func=None)
+    scrubber = sqlfs.FileStorageScrubber
+    budget_orig, rate_orig, quarantine_orig = scrubber.budget, scrubber.rate, scrubber.quarantine
+    scrubber.budget, scrubber.rate, scrubber.quarantine = count * size // 4, 0, True
+    # Smaller budgets make the pass resume several times
+    passes = scrubber.get_metrics()['passes']
+    runs = 0
+    tm = time.time()
+    while scrubber.get_metrics()['passes'] == passes:
+        sqlfs.scrub_storage()
+        runs += 1
+    tm = time.time() - tm
+    failures = 0
+    found = sqlfs.get_scrub_failures()
+    if str(damaged) not in found:
+        failures += 1
+        print('Damaged file %s not found' % damaged)
+    for key in found:
+        if key != str(damaged) and key in set(str(item) for item in uuids):
+            failures += 1
+            print('Intact file %s reported' % key)
+    if runs < 2:
+        failures += 1
+        print('Pass did not resume from the checkpoint')
+    if store(path, 'again.bin', files[count // 2]) == damaged:
+        failures += 1
+        print('New upload deduplicated against quarantined file')
+    scrubber.budget, scrubber.rate, scrubber.quarantine = budget_orig, rate_orig, quarantine_orig
+    print('Pass of %d files in %d runs, %.2f s' % (count, runs, tm))
+    metrics = sqlfs.get_scrub_metrics()
+    for key in sorted(metrics):
+        print('    %s: %s' % (key, metrics[key]))
+    print('%d failures\n' % failures)
+    sqlfs.remove(path)
+    return failures == 0
+
+check()
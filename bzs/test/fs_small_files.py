@@ -0,0 +1,41 @@
+
+import os
+import random
+import time
+
+from bzs import sqlfs
+
+def benchmark(path='/System/bench-small/', count=100000, batch=10000, seed=0):
+    """ Upload many small files into a few directories, printing throughput
+    of each batch, which should not drop as pack segments pile up. """
+    print('Bulk small file upload benchmark, %d files\n%s\n' % (count, '#' * 70))
+    rand = random.Random(seed)
+    sqlfs.create_directory('/System/', 'bench-small')
+    for d in range(0, count // batch):
+        sqlfs.create_directory(path, 'batch-%d' % d)
+    pool = os.urandom(64 * 1024)
+    print('Files           Files/s         MB/s            Open segments')
+    total_tm = 0.0
+    for d in range(0, count // batch):
+        par = '%sbatch-%d/' % (path, d)
+        n_bytes = 0
+        tm = time.time()
+        for i in range(0, batch):
+            size = rand.randint(256, 16 * 1024)
+            offset = rand.randint(0, len(pool) - size)
+            # Unique content, so that no file is deduplicated
+            data = ('%d-%d-' % (d, i)).encode('utf-8') + pool[offset:offset + size]
+            stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+            stream.write(data)
+            stream.close()
+            sqlfs.create_file(par, 'file-%d.bin' % i, stream)
+            n_bytes += len(data)
+        tm = time.time() - tm
+        total_tm += tm
+        print('%s%s%s%d' % (str((d + 1) * batch).ljust(16), ('%.0f' % (batch / tm)).ljust(16),
+            ('%.2f' % (n_bytes / 1024**2 / tm)).ljust(16), len(sqlfs.FileStorage.st_packs.sizes)))
+    print('\n%d files in %.1f s, %.0f files/s\n' % (count, total_tm, count / total_tm))
+    sqlfs.remove(path)
+    return
+
+benchmark()
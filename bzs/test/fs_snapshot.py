@@ -0,0 +1,75 @@
+
+import os
+import subprocess
+import sys
+import tempfile
+
+from bzs import db
+from bzs import sqlfs
+
+# Runs in a fresh interpreter, as a restart of the server would.
+child_script = """
+import time
+tm = time.time()
+from bzs import sqlfs
+tm_start = time.time() - tm
+tm = time.time()
+sqlfs.save_snapshot()
+tm_save = time.time() - tm
+print('%f %f %d' % (tm_start, tm_save, len(sqlfs.Filesystem.fs_uuid_idx)))
+"""
+
+def make_tree(folders, files):
+    """ Insert a synthetic tree of 'folders' folders each with 'files' files
+    right into the database, under /System/bench-snapshot/. All files share
+    the content of one real file. """
+    sqlfs.create_directory('/System/', 'bench-snapshot')
+    stream = sqlfs.create_file_handle(mode='write', est_length=5, obj_data=b'bench')
+    stream.close()
+    sqlfs.create_file('/System/bench-snapshot/', 'content.txt', stream)
+    par = sqlfs.Filesystem.locate('/System/bench-snapshot/')
+    f_uuid = sqlfs.Filesystem.locate('/System/bench-snapshot/content.txt').f_uuid
+    perms = par.fmtmod_list()
+    db.Database.execute("""
+        INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid)
+            SELECT md5('bench-snapshot-' || d)::UUID, %s, 'folder-' || d, TRUE, 'kernel', %s, 0.0, NULL
+                FROM generate_series(1, %s) d;""", (par.uuid, perms, folders), fetch_func=None)
+    db.Database.execute("""
+        INSERT INTO file_system_node (uuid, parent_uuid, file_name, is_dir, owner, permissions, upload_time, f_uuid)
+            SELECT md5('bench-snapshot-' || d || '-' || f)::UUID, md5('bench-snapshot-' || d)::UUID, 'file-' || f || '.txt', FALSE, 'kernel', %s, 0.0, %s
+                FROM generate_series(1, %s) d, generate_series(1, %s) f;""", (perms, f_uuid, folders, files), fetch_func=None)
+    sqlfs.Filesystem.bump_generation()
+    return par
+
+def remove_tree(par):
+    db.Database.execute("DELETE FROM file_system_node WHERE parent_uuid IN (SELECT uuid FROM file_system_node WHERE parent_uuid = %s AND is_dir = TRUE);", (par.uuid,), fetch_func=None)
+    db.Database.execute("DELETE FROM file_system_node WHERE parent_uuid = %s AND is_dir = TRUE;", (par.uuid,), fetch_func=None)
+    sqlfs.Filesystem.bump_generation()
+    sqlfs.remove('/System/bench-snapshot/')
+    return
+
+def measure(path):
+    env = dict(os.environ)
+    env['BZS_SQLFS_LAZY_LOAD'] = '0'
+    env['BZS_SQLFS_SNAPSHOT_PATH'] = path
+    res = subprocess.run([sys.executable, '-c', child_script], env=env, stdout=subprocess.PIPE, check=True)
+    tm_start, tm_save, nodes = res.stdout.decode('utf-8').split()[-3:]
+    return float(tm_start), float(tm_save), int(nodes)
+
+def benchmark(folders=2000, files=999):
+    print('Tree snapshot benchmark, %d folders of %d files\n%s\n' % (folders, files, '#' * 70))
+    par = make_tree(folders, files)
+    path = os.path.join(tempfile.gettempdir(), 'bzs-bench.snapshot')
+    if os.path.isfile(path):
+        os.remove(path)
+    print('Restart from        Start (s)       Save (s)        Nodes')
+    for source in ['database', 'snapshot']:
+        tm_start, tm_save, nodes = measure(path)
+        print('%s%s%s%d' % (source.ljust(20), ('%.2f' % tm_start).ljust(16), ('%.2f' % tm_save).ljust(16), nodes))
+    print('Snapshot size: %.1f MB' % (os.path.getsize(path) / 1024 / 1024))
+    print('')
+    os.remove(path)
+    remove_tree(par)
+    return
+
+benchmark()
@@ -0,0 +1,39 @@
+
+import os
+import time
+
+from bzs import sqlfs
+
+def upload(path, file_name, size, block, incremental):
+    """ Write 'size' bytes in blocks as FilesUploadHandler does, then create
+    the file. Returns time spent in seconds. """
+    prefix = ('%s-%f' % (file_name, time.time())).encode('utf-8') # Unique content
+    block = prefix + block[len(prefix):]
+    tm = time.time()
+    stream = sqlfs.create_file_handle(mode='write', est_length=size)
+    for i in range(0, size // len(block)):
+        stream.write(block)
+    stream.close()
+    if not incremental:
+        stream.digest = None # Read back from database instead
+    sqlfs.create_file(path, file_name, stream)
+    tm = time.time() - tm
+    return tm
+
+def benchmark(size=1024**3, block_size=65536, rounds=3):
+    print('Upload hashing benchmark, %d MB files in %d KB blocks\n%s\n' % (size // 1024**2, block_size // 1024, '#' * 70))
+    sqlfs.create_directory('/System/', 'bench-upload-hash')
+    path = '/System/bench-upload-hash/'
+    block = os.urandom(block_size)
+    print('Hashing         Time (s)        Throughput (MB/s)')
+    for incremental in [False, True]:
+        tm = 0.0
+        for r in range(0, rounds):
+            tm += upload(path, 'file-%s-%d.bin' % (incremental, r), size, block, incremental)
+        tm /= rounds
+        print('%s%s%.1f' % (('incremental' if incremental else 're-read').ljust(16), ('%.2f' % tm).ljust(16), size / 1024**2 / tm))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
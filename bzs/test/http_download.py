@@ -0,0 +1,59 @@
+
+import os
+import requests
+import time
+
+from bzs import sqlfs
+from bzs import utils
+
+def store_large(path, file_name, size, block_size=4 * 1024**2):
+    """ Store a file of 'size' bytes without holding it in memory. """
+    pool = os.urandom(block_size)
+    stream = sqlfs.create_file_handle(mode='write', est_length=size)
+    written = 0
+    while written < size:
+        block = pool[:min(block_size, size - written)]
+        # Different blocks, so that nothing is deduplicated
+        stream.write(('%016x' % written).encode('utf-8') + block[16:])
+        written += len(block)
+    stream.close()
+    sqlfs.create_file(path, file_name, stream)
+    return
+
+def fetch(url, headers=None):
+    """ Download 'url', returns bytes received, time to first byte and total
+    time. """
+    tm = time.time()
+    req = requests.get(url, headers=headers or dict(), stream=True)
+    tm_first = None
+    received = 0
+    for block in req.iter_content(1024 * 1024):
+        if tm_first is None:
+            tm_first = time.time() - tm
+        received += len(block)
+    return received, tm_first or 0.0, time.time() - tm
+
+def benchmark(server='http://localhost', path='/Public/', sizes=[256 * 1024**2, 1024**3, 4 * 1024**3], runs=3):
+    """ Download files of several GB through a running server, one stream at
+    a time, printing throughput of whole files and of a range in the middle,
+    where reads of storage overlap with sending to the client. """
+    print('Single stream download benchmark\n%s\n' % ('#' * 70))
+    print('Size MB     Request        First byte ms  Time s         MB/s')
+    for size in sizes:
+        file_name = 'bench-download-%d.bin' % size
+        store_large(path, file_name, size)
+        url = server + utils.get_download_link(path + file_name, file_name)
+        for name, headers in [
+                ('whole', None),
+                ('middle half', {'Range': 'bytes=%d-%d' % (size // 4, size * 3 // 4 - 1)})]:
+            results = list(fetch(url, headers) for i in range(0, runs))
+            received = results[0][0]
+            tm_first = min(item[1] for item in results)
+            tm = min(item[2] for item in results)
+            print('%s%s%s%s%.1f' % (str(size // 1024**2).ljust(12), name.ljust(15), ('%.1f' % (tm_first * 1000)).ljust(15),
+                ('%.2f' % tm).ljust(15), received / 1024**2 / tm))
+        sqlfs.remove(path + file_name)
+    print('')
+    return
+
+benchmark()
@@ -0,0 +1,53 @@
+
+import os
+import requests
+
+from bzs import sqlfs
+from bzs import utils
+
+def check(server='http://localhost', path='/Public/', file_name='bench-ranges.bin', size=1024 * 1024):
+    """ Request ranges of a file from a running server, making sure bounded,
+    open, suffix and multiple ranges get only the requested bytes, and that
+    bad or outdated ranges are handled as in RFC 7233. """
+    print('HTTP range requests check\n%s\n' % ('#' * 70))
+    data = os.urandom(size)
+    stream = sqlfs.create_file_handle(mode='write', est_length=size)
+    stream.write(data)
+    stream.close()
+    sqlfs.create_file(path, file_name, stream)
+    url = '%s/files/download/%s/%s' % (server, utils.encode_str_to_hexed_b64(path + file_name), file_name)
+    failures = 0
+    def expect(headers, status, content=None):
+        req = requests.get(url, headers=headers)
+        ok = req.status_code == status and (content is None or req.content == content)
+        print('%s%d %s' % (str(headers).ljust(56), req.status_code, 'ok' if ok else 'FAILED'))
+        return (0 if ok else 1), req
+    for headers, status, content in [
+            ({}, 200, data),
+            ({'Range': 'bytes=100-199'}, 206, data[100:200]),
+            ({'Range': 'bytes=%d-' % (size - 10)}, 206, data[-10:]),
+            ({'Range': 'bytes=-500'}, 206, data[-500:]),
+            ({'Range': 'bytes=0-%d' % (size * 2)}, 206, data),
+            ({'Range': 'bytes=%d-' % size}, 416, b''),
+            ({'Range': 'bytes=10-5'}, 200, data),
+            ({'Range': 'lines=1-2'}, 200, data)]:
+        failed, req = expect(headers, status, content)
+        failures += failed
+    # Multiple ranges
+    failed, req = expect({'Range': 'bytes=0-9,-10'}, 206)
+    parts = req.content.split(('--' + req.headers.get('Content-Type', '').split('boundary=')[-1]).encode('utf-8'))
+    if failed or len(parts) != 4 or not parts[1].endswith(b'\r\n\r\n' + data[:10] + b'\r\n') \
+            or not parts[2].endswith(b'\r\n\r\n' + data[-10:] + b'\r\n'):
+        failures += 1
+        print('Multipart response malformed')
+    # Validators
+    etag, mtime = req.headers.get('ETag'), req.headers.get('Last-Modified')
+    failures += expect({'Range': 'bytes=0-9', 'If-Range': etag}, 206, data[:10])[0]
+    failures += expect({'Range': 'bytes=0-9', 'If-Range': mtime}, 206, data[:10])[0]
+    failures += expect({'Range': 'bytes=0-9', 'If-Range': '"outdated"'}, 200, data)[0]
+    failures += expect({'Range': 'bytes=0-9', 'If-Range': 'W/%s' % etag}, 200, data)[0]
+    print('%d failures\n' % failures)
+    sqlfs.remove(path + file_name)
+    return failures == 0
+
+check()
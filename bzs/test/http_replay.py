@@ -0,0 +1,92 @@
+
+import bisect
+import itertools
+import os
+import random
+import requests
+import time
+
+from bzs import sqlfs
+from bzs import utils
+
+class CachingClient:
+    """ Client keeping responses with their validators, as browsers do. """
+
+    def __init__(self, revalidate=True):
+        self.cache = dict() # url -> (etag, last-modified, immutable, content)
+        self.revalidate = revalidate
+        self.bytes_received = 0
+        self.requests = 0
+        self.not_modified = 0
+        self.skipped = 0
+        return
+
+    def get(self, url):
+        cached = self.cache.get(url, None)
+        if cached and cached[2]:
+            self.skipped += 1 # Immutable, not even asked for
+            return cached[3]
+        headers = dict()
+        if cached and self.revalidate:
+            if cached[0]:
+                headers['If-None-Match'] = cached[0]
+            if cached[1]:
+                headers['If-Modified-Since'] = cached[1]
+        req = requests.get(url, headers=headers)
+        self.requests += 1
+        self.bytes_received += len(req.content)
+        if req.status_code == 304:
+            self.not_modified += 1
+            return cached[3]
+        if self.revalidate:
+            self.cache[url] = (req.headers.get('ETag'), req.headers.get('Last-Modified'),
+                'immutable' in req.headers.get('Cache-Control', ''), req.content)
+        return req.content
+    pass
+
+def benchmark(server='http://localhost', path='/Public/', count=64, requests_n=2000, seed=0):
+    """ Replay visits to files of which a few are far more popular, as on a
+    share, with clients that cache nothing, that revalidate with ETags, that
+    are given links carrying the hash of the content, and that are given
+    links by hash. Prints bytes sent by the server and time taken by each
+    client. """
+    print('Revisit-heavy replay of %d requests over %d files\n%s\n' % (requests_n, count, '#' * 70))
+    rand = random.Random(seed)
+    sqlfs.create_directory(path, 'bench-replay')
+    path = path + 'bench-replay/'
+    files = list()
+    for i in range(0, count):
+        data = os.urandom(rand.randint(4 * 1024, 2 * 1024**2))
+        stream = sqlfs.create_file_handle(mode='write', est_length=len(data))
+        stream.write(data)
+        stream.close()
+        sqlfs.create_file(path, 'file-%d.bin' % i, stream)
+        files.append((path + 'file-%d.bin' % i, 'file-%d.bin' % i))
+    # Popularity follows a Zipf distribution
+    cumulative = list(itertools.accumulate(1.0 / (i + 1) for i in range(0, count)))
+    trace = list(bisect.bisect(cumulative, rand.random() * cumulative[-1]) for i in range(0, requests_n))
+    stats = dict((item['file-name'], item['file-hash']) for item in sqlfs.list_directory(path))
+    print('Client          Requests  304s      Skipped   MB sent   Saved     Time s')
+    baseline = None
+    for name, client, mode in [
+            ('no cache', CachingClient(revalidate=False), 'path'),
+            ('validators', CachingClient(), 'path'),
+            ('versioned', CachingClient(), 'versioned'),
+            ('by hash', CachingClient(), 'hash')]:
+        tm = time.time()
+        for idx in trace:
+            if mode == 'hash':
+                link = utils.get_blob_link(stats[files[idx][1]], files[idx][1])
+            else:
+                link = utils.get_download_link(files[idx][0], files[idx][1], stats[files[idx][1]] if mode == 'versioned' else None)
+            client.get(server + link)
+        tm = time.time() - tm
+        baseline = baseline or client.bytes_received
+        print('%s%s%s%s%s%s%.2f' % (name.ljust(16), str(client.requests).ljust(10), str(client.not_modified).ljust(10),
+            str(client.skipped).ljust(10), ('%.1f' % (client.bytes_received / 1024**2)).ljust(10),
+            ('%.1f%%' % (100.0 - 100.0 * client.bytes_received / baseline)).ljust(10), tm))
+    print('')
+    sqlfs.remove(path)
+    return
+
+benchmark()
@@ -69,6 +69,7 @@ class Usergroup:
             mem = mem.handle
         if mem not in self.members:
             self.members.add(mem)
+            self.master.membership_changed()
         return
     def remove_member(self, mem):
         if type(mem) != str:
@@ -79,6 +80,7 @@ class Usergroup:
         if mem.handle not in self.members:
             return
         self.members.remove(mem.handle)
+        self.master.membership_changed()
         self.save_data()
         mem.save_data()
         return
@@ -89,6 +91,7 @@ class Usergroup:
         mem.usergroups.add(self.handle)
         self.members.add(mem.handle)
         self.joining.remove(mem.handle)
+        self.master.membership_changed()
         self.save_data()
         mem.save_data()
         return
@@ -140,6 +143,7 @@ class UserManagerType:
         self.users_cookies = dict() # string -> string(handle)
         self.usergroups    = dict() # string -> Usergroup
         self.usr_db        = database # Database
+        self.members_gen   = 0 # Increased upon changes of users and memberships
         # Done attribution, now selecting users
         for item in self.usr_db.execute("SELECT handle, data FROM users;"):
             handle, bin_data = item
@@ -198,6 +202,7 @@ class UserManagerType:
 
     def add_usergroup(self, n_grp):
         self.usergroups[n_grp.handle] = n_grp
+        self.membership_changed()
         return
 
     def remove_user(self, usr):
@@ -209,6 +214,7 @@ class UserManagerType:
         if usr.cookie:
             del self.users_cookies[usr.cookie]
         del self.users[usr.handle]
+        self.membership_changed()
         self.usr_db.execute("DELETE FROM users WHERE handle = %s;", (usr.handle,))
         # Unlink usergroups
         for rm_grp in usr.usergroups:
@@ -237,6 +243,7 @@ class UserManagerType:
         # Removing usergroup from database
         self.usr_db.execute("DELETE FROM usergroups WHERE handle = %s;", (grp.handle,))
         del self.usergroups[grp.handle]
+        self.membership_changed()
         # Expunge usergroup's data
         sqlfs.remove('/Groups/%s/' % grp.handle)
         sqlfs.expunge_user_ownership(grp.handle)
@@ -330,7 +337,7 @@ class UserManagerType:
             usr_description=usr_desc,
             master=self
         )
-        self.usergroups['public'].members.add(usr.handle)
+        self.usergroups['public'].add_member(usr.handle)
         self.usergroups['public'].save_data()
         self.add_user(usr)
         usr.save_data()
@@ -403,6 +410,12 @@ class UserManagerType:
         joiner.save_data()
         return
 
+    def membership_changed(self):
+        """ Mark users or usergroup memberships as changed, which invalidates
+        cached permissions. """
+        self.members_gen += 1
+        return
+
     def select_member(self, handles, user):
         """ Select the most appropriate handle in handles that match handle's
         ownership or permissions. """
@@ -488,6 +501,9 @@ def join_usergroup(handle, joiner):
 def select_member(handles, user):
     return UserManager.select_member(handles, user)
 
+def get_membership_generation():
+    return UserManager.members_gen
+
 def get_user_by_name(name):
     return UserManager.get_user_by_name(name)
 
@@ -1,8 +1,10 @@
 
 import base64
 import binascii
+import email.utils
 import gzip
 import hashlib
+import hmac
 import mako
 import mako.template
 import math
@@ -10,6 +12,7 @@ import mimetypes
 import random
 import re
 import time
+import urllib.parse
 import uuid
 
 from . import const
@@ -205,3 +208,155 @@ def is_unsafe_string(src, *args):
         if i in ar:
             return True
     return False
+
+################################################################################
+# HTTP operations
+
+http_max_ranges = 32 # Requests with more ranges are served as a whole
+http_immutable = 'private, max-age=31536000, immutable' # Cache-Control of links tied to a content
+http_immutable_public = 'public, max-age=31536000, immutable' # Cache-Control of content by hash, shared by all users
+http_boot_tag = '%x' % int(time.time()) # Templates may change upon restarts, so do pages made from them
+
+def parse_http_range(header, length):
+    """Parse the 'Range' header of a request for content of 'length' bytes,
+    as in RFC 7233. Returns a list of (first, last) byte positions, both
+    included, of which overlapping or adjacent ranges are merged. Returns None
+    if the header should be ignored, as it is missing, malformed or asks for
+    too many ranges, and an empty list if no range could be satisfied."""
+    if not header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    items = list(item.strip() for item in spec.split(',') if item.strip())
+    if not items:
+        return None
+    ranges = list()
+    for item in items:
+        m = re.match(r'^(\d*)-(\d*)$', item)
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        if not m.group(1):
+            # Suffix range, the last N bytes
+            suffix = int(m.group(2))
+            if suffix > 0 and length > 0:
+                ranges.append((max(0, length - suffix), length - 1))
+            continue
+        first = int(m.group(1))
+        last = int(m.group(2)) if m.group(2) else length - 1
+        if m.group(2) and last < first:
+            return None
+        if first < length:
+            ranges.append((first, min(last, length - 1)))
+    ranges.sort()
+    ret_result = list()
+    for first, last in ranges:
+        if ret_result and first <= ret_result[-1][1] + 1:
+            ret_result[-1] = (ret_result[-1][0], max(ret_result[-1][1], last))
+        else:
+            ret_result.append((first, last))
+    if len(ret_result) > http_max_ranges:
+        return None
+    return ret_result
+
+def format_http_date(tm):
+    """Format time in float since epoch as an HTTP date."""
+    return email.utils.formatdate(tm, usegmt=True)
+
+def parse_http_date(data):
+    """Parse an HTTP date into float since epoch, or None if malformed."""
+    try:
+        ret_result = email.utils.parsedate_to_datetime(data).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+    return ret_result
+
+def get_download_link(path, file_name, file_hash=None):
+    """Link to download the file 'path'. Links given the hash of the content
+    are tied to that content, and could be cached by clients forever."""
+    ret_result = '/files/download/%s/%s' % (encode_str_to_hexed_b64(path), urllib.parse.quote(file_name))
+    if file_hash:
+        ret_result += '?v=%s' % file_hash[:16]
+    return ret_result
+
+def sign_blob_link(file_hash, expiry):
+    """Token authorising download of content of 'file_hash' until 'expiry',
+    in seconds since epoch."""
+    msg = ('%s/%d' % (file_hash, expiry)).encode('utf-8')
+    return hmac.new(const.get_const('blob-link-secret').encode('utf-8'), msg, hashlib.sha256).hexdigest()[:32]
+
+def check_blob_link(file_hash, expiry, token):
+    """Whether 'token' authorises download of content of 'file_hash' now."""
+    try:
+        expiry = int(expiry)
+    except (TypeError, ValueError):
+        return False
+    if expiry < time.time():
+        return False
+    return hmac.compare_digest(sign_blob_link(file_hash, expiry), token or '')
+
+def sign_upload_challenge(f_hash, f_size, handle, offset, length, expiry):
+    """Token binding a challenge for bytes from 'offset' to 'offset' + 'length'
+    of content of 'f_hash' and 'f_size' to user 'handle' until 'expiry'."""
+    # Same secret as blob links, messages of both could never be alike
+    msg = ('upload/%s/%d/%s/%d/%d/%d' % (f_hash, f_size, handle, offset, length, expiry)).encode('utf-8')
+    return hmac.new(const.get_const('blob-link-secret').encode('utf-8'), msg, hashlib.sha256).hexdigest()[:32]
+
+def make_upload_challenge(f_hash, f_size, handle):
+    """Range of content of 'f_hash' and 'f_size' chosen at random, which user
+    'handle' has to hash to prove having the content, as a dict() of 'offset',
+    'length', 'expiry' and 'token', which are to be given back with the
+    proof."""
+    length = min(f_size, const.get_const('upload-challenge-size'))
+    offset = random.SystemRandom().randint(0, f_size - length)
+    expiry = int(time.time() + const.get_const('upload-challenge-lifetime'))
+    return dict(offset=offset, length=length, expiry=expiry,
+        token=sign_upload_challenge(f_hash, f_size, handle, offset, length, expiry))
+
+def check_upload_challenge(f_hash, f_size, handle, challenge):
+    """Whether 'challenge' was made by make_upload_challenge() for the same
+    content and user, and has not expired."""
+    try:
+        offset, length, expiry = int(challenge['offset']), int(challenge['length']), int(challenge['expiry'])
+        token = str(challenge['token'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    if expiry < time.time():
+        return False
+    return hmac.compare_digest(sign_upload_challenge(f_hash, f_size, handle, offset, length, expiry), token)
+
+def get_blob_link(file_hash, file_name=''):
+    """Link to download content of 'file_hash' by anyone having the link,
+    wherever the content is stored. Links expire at the end of the next
+    lifetime, so that all links to the same content minted within the same
+    lifetime are the same, and could be cached as one. 'file_name' is only
+    what clients save the content as."""
+    lifetime = const.get_const('blob-link-lifetime')
+    expiry = int((time.time() // lifetime + 2) * lifetime)
+    return '/blob/%s/%s?e=%d&t=%s' % (file_hash, urllib.parse.quote(file_name), expiry, sign_blob_link(file_hash, expiry))
+
+def make_etag(data):
+    """Strong entity tag of 'data', in bytes."""
+    return '"%s"' % hashlib.sha256(data).hexdigest()
+
+def http_not_modified(headers, etags, mtime=None):
+    """Whether a GET request with 'headers' could be answered with 304 Not
+    Modified, as in RFC 7232, for content of which the entity tags are in
+    'etags' and the time last modified, in float since epoch, is 'mtime'.
+    Entity tags are compared weakly, and If-Modified-Since is ignored if
+    If-None-Match is given."""
+    if_none_match = headers.get('If-None-Match', None)
+    if if_none_match is not None:
+        etags = set(etag[2:] if etag.startswith('W/') else etag for etag in etags if etag)
+        if if_none_match.strip() == '*':
+            return len(etags) > 0
+        for etag in if_none_match.split(','):
+            etag = etag.strip()
+            if (etag[2:] if etag.startswith('W/') else etag) in etags:
+                return True
+        return False
+    if_modified_since = headers.get('If-Modified-Since', None)
+    if if_modified_since is None or mtime is None:
+        return False
+    since = parse_http_date(if_modified_since)
+    return since is not None and int(mtime) <= since
@@ -0,0 +1,24 @@
+
+import sys
+
+print('')
+print('SQLFS Blob Migration')
+print('=' * 60)
+print('Moving content of large objects, sparse rows and chunks to the')
+print('blob store on local filesystem. This could be interrupted and run')
+print('again later.')
+print('')
+
+from bzs import sqlfs
+
+def progress(done, total, moved):
+    sys.stdout.write('\r%d / %d files' % (done, total))
+    sys.stdout.flush()
+    return
+
+moved = sqlfs.migrate_to_blobs(callback=progress)
+
+print('')
+print('Moved %d files.' % moved)
+print('Set BZS_SQLFS_STORAGE_ENGINE=blob so that new files are stored there too.')
+print('')
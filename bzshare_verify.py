@@ -0,0 +1,25 @@
+
+import sys
+
+print('')
+print('SQLFS Storage Verification')
+print('=' * 60)
+print('Reading content of all stored files and comparing it with the')
+print('recorded hashes. Chunks are hashed in parallel, set')
+print('BZS_SQLFS_HASH_THREADS to limit the threads used.')
+print('')
+
+from bzs import sqlfs
+
+def progress(done, total, ok):
+    sys.stdout.write('\r%d / %d files' % (done, total))
+    sys.stdout.flush()
+    return
+
+failed = sqlfs.verify_storage(callback=progress)
+
+print('')
+for f_uuid in failed:
+    print('Mismatch: %s' % f_uuid)
+print('%d files did not match.' % len(failed))
+print('')